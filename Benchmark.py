@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark.py
+
+End-to-end throughput benchmark of the fiTaxonomy pipeline stages, run against the
+local stand-in servers of StandIn.py instead of the live NCBI, Wikipedia and FluidInfo
+services. No ~/.fluidDBcredentials needed.
+
+Each stage runs in its own child process, so that its peak RSS can be told apart,
+while the stand-in servers keep running in the parent process. Reported per stage:
+*   taxa/s
+*   requests per taxon, to each of the stand-ins
+*   p50/p99 latency of the requests, as observed by the stand-ins
+*   bytes sent and connections opened, to each of the stand-ins
+*   peak RSS of the child process
+The JSON results also hold the timers and counters of Instrumentation.py for each stage.
+
+Stages:
+*   taxa-serial:    PopulateTaxa with iterTaxa and one FluidInfo request per taxon.
+*   taxa-prefetch:  PopulateTaxa with iterTaxaPrefetch and the BatchedValuesWriter.
+*   taxa-taxdump:   PopulateTaxa with the local taxdump as source, also writing a TaxonSnapshot.
+*   taxa-sync:      Same again, with the DiffValuesWriter. Nothing changed since taxa-taxdump,
+                    so it shows the cost of a refresh run.
+*   taxa-sharded-sync: The same refresh run with PopulateTaxa --processes --sync, from Efetch.
+                    Its totals of added, changed and unchanged tags must match those of taxa-sync.
+*   linkout:        PopulateLinkOut over the objects written by the previous stages.
+*   linkout-snapshot: PopulateLinkOut over the TaxonSnapshot written by taxa-taxdump.
+
+Example, with 20ms of latency added to every NCBI/Wikipedia response:
+    python Benchmark.py --species 2000 --latency 20
+
+"""
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import resource
+import multiprocessing
+
+from fom.session import Fluid
+from fom.mapping import Object, tag_value
+
+import HttpTransport
+import RequestScheduler
+import Instrumentation
+import PopulateTaxa
+import PopulateLinkOut
+from StandIn import FluidInfoStandIn, EutilsStandIn, MakeSyntheticTaxdump
+from TaxDump import iterTaxdump
+from FluidWriter import BatchedValuesWriter, DiffValuesWriter
+from TaxonSnapshot import TaxonSnapshot, TaxonSnapshotWriter
+
+
+# Namespace of the benchmark user on the FluidInfo stand-in.
+sBenchUser = u'benchmark'
+
+lStages = ['taxa-serial', 'taxa-prefetch', 'taxa-taxdump', 'taxa-sync', 'taxa-sharded-sync', 'linkout', 'linkout-snapshot']
+
+# Counters of the DiffValuesWriter that must be the same for taxa-sync and taxa-sharded-sync.
+lSyncCounters = ['sync_tags_added', 'sync_tags_changed', 'sync_tags_unchanged', 'sync_objects_unchanged']
+
+
+def Percentile(lValues, fPercent):
+    """
+        Returns the given percentile of a list of numbers, by the nearest-rank method.
+    """
+    if not lValues:
+        return 0.0
+    lSorted = sorted(lValues)
+    iRank = max(0, int(round(fPercent/100.0*len(lSorted) + 0.5)) - 1)
+    return lSorted[min(iRank, len(lSorted) - 1)]
+
+
+def BindStandIn(urlFluid, urlEutils, urlWikipediaApi):
+    """
+        Points the module globals of PopulateTaxa and PopulateLinkOut at the stand-ins,
+        doing what their __main__ sections do with the real services.
+    """
+    fdb = Fluid(urlFluid)
+    fdb.login(sBenchUser, u'secret')
+    fdb.bind()
+    HttpTransport.BindFluid(fdb)
+
+    PopulateTaxa.urlEsearch = urlEutils + "esearch.fcgi"
+    PopulateTaxa.urlEfetch = urlEutils + "efetch.fcgi"
+    PopulateTaxa.fdb = fdb
+    PopulateTaxa.sUserNS = sBenchUser
+
+    sNcbiNS = sBenchUser + u'/taxonomy/ncbi'
+    PopulateLinkOut.urlElink = urlEutils + "elink.fcgi"
+    PopulateLinkOut.urlWikipediaApi = urlWikipediaApi
+    PopulateLinkOut.fdb = fdb
+    PopulateLinkOut.sUserNS = sBenchUser
+    PopulateLinkOut.sNcbiNS = sNcbiNS
+    class NcbiTaxon(Object):
+        TaxId = tag_value(sNcbiNS + u'/TaxId')
+        ScientificName = tag_value(sNcbiNS + u'/ScientificName')
+    class WikipediaPage(Object):
+        RelatedTaxon = tag_value(sNcbiNS + u'/LinkOut/related-NcbiTaxon')
+        PageId = tag_value(sBenchUser + u'/wikipedia/pageid')
+    class BbcPage(Object):
+        RelatedTaxon = tag_value(sNcbiNS + u'/LinkOut/related-NcbiTaxon')
+        Url = tag_value(sBenchUser + u'/bbcwildlife/url')
+    class LinkOutProvider(Object):
+        Id = tag_value(sNcbiNS + u'/LinkOut/Provider/Id')
+        Name = tag_value(sNcbiNS + u'/LinkOut/Provider/Name')
+        NameAbbr = tag_value(sNcbiNS + u'/LinkOut/Provider/NameAbbr')
+        Url = tag_value(sNcbiNS + u'/LinkOut/Provider/Url')
+    PopulateLinkOut.NcbiTaxon = NcbiTaxon
+    PopulateLinkOut.WikipediaPage = WikipediaPage
+    PopulateLinkOut.BbcPage = BbcPage
+    PopulateLinkOut.LinkOutProvider = LinkOutProvider
+    return fdb
+
+
+def RunStage(sStage, args, sDumpDir, sSnapshotPath):
+    """
+        Runs one pipeline stage, as the scripts do it.
+        Returns the number of taxa handled.
+    """
+    sTerm = "species[Rank] AND PRI[TXDV]"
+    if sStage in ('linkout', 'linkout-snapshot'):
+        if sStage == 'linkout-snapshot':
+            oTaxa = TaxonSnapshot(sSnapshotPath)
+        else:
+            oTaxa = PopulateLinkOut.NcbiTaxon.filter(u'has ' + PopulateLinkOut.NcbiTaxon.__dict__['TaxId'].tagpath)
+        resolver = PopulateLinkOut.WikipediaTitleResolver()
+        providers = PopulateLinkOut.ProviderCache()
+        writer = BatchedValuesWriter(PopulateLinkOut.fdb, batchsize=args.batchsize, workers=args.workers,
+                                     oncommit=providers.OnCommit, onfailure=providers.OnFailure)
+        PopulateLinkOut.RunWorkerPool(PopulateLinkOut.IterBatches(oTaxa, args.elinkbatch),
+                                      lambda lBatch: PopulateLinkOut.HandleLinkOutBatch(lBatch, resolver, writer, providers),
+                                      args.workers)
+        writer.Close()
+        resolver.Close()
+        return len(oTaxa)
+
+    if sStage == 'taxa-sharded-sync':
+        # The options of PopulateTaxa.py --processes N --sync
+        argsTaxa = argparse.Namespace(chunksize=100, streaming=False, apikey=None, timeout=60.0, connecttimeout=10.0,
+                                      cache=None, cachesize=0, offline=False, batchsize=args.batchsize,
+                                      writers=args.workers, flushinterval=5.0, sync=True, processes=args.processes,
+                                      metrics=None, metricsinterval=3600.0)
+        # Keep the progress line out of the report.
+        sys.stderr = open(os.devnull, 'w')
+        return PopulateTaxa.ImportSharded(argsTaxa, [sTerm])
+
+    writer = None
+    tree = None
+    snapshot = None
+    if sStage == 'taxa-serial':
+        itSpecies = PopulateTaxa.iterTaxa(term=sTerm, chunksize=100)
+    elif sStage == 'taxa-prefetch':
+        itSpecies = PopulateTaxa.iterTaxaPrefetch(term=sTerm, chunksize=500, prefetch=4)
+    else:
+        itSpecies = iterTaxdump(sDumpDir, rank="species", division="PRI", lineage=False)
+        tree = itSpecies.tree
+        if sStage == 'taxa-taxdump':
+            snapshot = TaxonSnapshotWriter(sSnapshotPath)
+    if sStage == 'taxa-sync':
+        writer = DiffValuesWriter(PopulateTaxa.fdb, PopulateTaxa.GetTaxonExtractor().tagpaths.values(),
+                                  batchsize=args.batchsize, workers=args.workers)
+    elif sStage != 'taxa-serial':
+        writer = BatchedValuesWriter(PopulateTaxa.fdb, batchsize=args.batchsize, workers=args.workers)
+
+    iCount = 0
+    xmlTaxonData = itSpecies.GetFirst()
+    while xmlTaxonData is not None:
+        PopulateTaxa.ImportTaxon(xmlTaxonData, writer, None, tree, None, snapshot)
+        iCount += 1
+        xmlTaxonData = itSpecies.GetNext()
+    if writer is not None:
+        writer.Close()
+    if snapshot is not None:
+        snapshot.Close()
+    return iCount
+
+
+def StageProcess(sStage, args, sDumpDir, sSnapshotPath, urls, queue):
+    """
+        Body of the child process of a stage. Puts a result dict into queue.
+    """
+    try:
+        # The scripts are chatty: Keep their output out of the report.
+        sys.stdout = open(os.devnull, 'w')
+        BindStandIn(*urls)
+        tStart = time.time()
+        iTaxa = RunStage(sStage, args, sDumpDir, sSnapshotPath)
+        fSeconds = time.time() - tStart
+        # ru_maxrss is in kilobytes on Linux
+        iPeakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        queue.put({'taxa': iTaxa, 'seconds': fSeconds, 'peakrss_mb': iPeakRss/1024.0,
+                   'metrics': Instrumentation.metrics.Snapshot()})
+    except Exception, e:
+        queue.put({'error': repr(e)})
+
+
+def RequestStats(server, iTaxa):
+    """
+        Summarizes the requests recorded by a stand-in server since its last ResetStats().
+    """
+    lSeconds = [fSeconds for (sPath, fSeconds) in server.requests]
+    return { 'requests'       : len(lSeconds)
+            ,'requests_per_taxon' : len(lSeconds)/float(iTaxa) if iTaxa else 0.0
+            ,'p50_ms'         : Percentile(lSeconds, 50)*1000
+            ,'p99_ms'         : Percentile(lSeconds, 99)*1000
+            ,'bytes_out'      : server.bytesOut
+            ,'connections'    : server.connections }
+
+
+def PrintReport(lResults):
+    print "%-18s %7s %9s %8s %11s %11s %9s %9s %9s %9s %8s" % ('stage', 'taxa', 'taxa/s', 'seconds', 'ncbi req/tx',
+                                                               'fluid req/tx', 'ncbi p50', 'ncbi p99', 'fluid p50',
+                                                               'fluid p99', 'rss MB')
+    for dictResult in lResults:
+        if 'error' in dictResult:
+            print "%-18s failed with: %s" % (dictResult['stage'], dictResult['error'])
+            continue
+        print "%-18s %7d %9.1f %8.2f %11.2f %11.2f %7.1fms %7.1fms %7.1fms %7.1fms %8.1f" % (
+            dictResult['stage'], dictResult['taxa'], dictResult['taxa_per_second'], dictResult['seconds'],
+            dictResult['ncbi']['requests_per_taxon'], dictResult['fluidinfo']['requests_per_taxon'],
+            dictResult['ncbi']['p50_ms'], dictResult['ncbi']['p99_ms'],
+            dictResult['fluidinfo']['p50_ms'], dictResult['fluidinfo']['p99_ms'], dictResult['peakrss_mb'])
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Measure the throughput of the fiTaxonomy scripts against local stand-in servers.")
+    parser.add_argument('--taxdump', metavar='DIR',
+                        help="Taxdump directory used as fixture. Defaults to a synthetic one, see --species")
+    parser.add_argument('--species', metavar='N', type=int, default=1000,
+                        help="Number of species of the synthetic fixture.")
+    parser.add_argument('--latency', metavar='MS', type=float, default=0.0,
+                        help="Latency added to every NCBI/Wikipedia response, in milliseconds.")
+    parser.add_argument('--fluidlatency', metavar='MS', type=float, default=0.0,
+                        help="Latency added to every FluidInfo response, in milliseconds.")
+    parser.add_argument('--rate', metavar='N', type=float, default=1000.0,
+                        help="Requests per second allowed by the RequestScheduler to the stand-ins.")
+    parser.add_argument('--stages', metavar='LIST', default=','.join(lStages),
+                        help='Comma-separated stages to run, in that order. Choose from: ' + ', '.join(lStages))
+    parser.add_argument('--batchsize', metavar='N', type=int, default=100,
+                        help="Taxa per batched FluidInfo request.")
+    parser.add_argument('--workers', metavar='N', type=int, default=4,
+                        help="Concurrent writer/LinkOut worker threads.")
+    parser.add_argument('--elinkbatch', metavar='N', type=int, default=200,
+                        help="TaxIds per Elink request.")
+    parser.add_argument('--processes', metavar='N', type=int, default=2,
+                        help="Worker processes of the taxa-sharded-sync stage.")
+    parser.add_argument('--json', metavar='FILE',
+                        help="Also write the results to this JSON file.")
+    args = parser.parse_args()
+
+    lRun = [sStage.strip() for sStage in args.stages.split(',') if sStage.strip()]
+    for sStage in lRun:
+        if sStage not in lStages:
+            parser.error("Unknown stage: " + sStage)
+
+    sTempDir = tempfile.mkdtemp(prefix='fiTaxonomy-bench-')
+    sSnapshotPath = os.path.join(sTempDir, 'taxa.snapshot')
+    sDumpDir = args.taxdump
+    if sDumpDir is None:
+        sDumpDir = sTempDir
+        MakeSyntheticTaxdump(sDumpDir, args.species)
+
+    fluid = FluidInfoStandIn(latency=args.fluidlatency/1000.0).Start()
+    eutils = EutilsStandIn(sDumpDir, latency=args.latency/1000.0).Start()
+    RequestScheduler.dictHostRates['127.0.0.1'] = args.rate
+    urls = (fluid.url, eutils.urlEutils, eutils.urlWikipediaApi)
+
+    lResults = []
+    try:
+        for sStage in lRun:
+            fluid.ResetStats()
+            eutils.ResetStats()
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=StageProcess, args=(sStage, args, sDumpDir, sSnapshotPath, urls, queue))
+            process.start()
+            dictResult = queue.get()
+            process.join()
+            dictResult['stage'] = sStage
+            if 'error' not in dictResult:
+                dictResult['taxa_per_second'] = dictResult['taxa']/dictResult['seconds'] if dictResult['seconds'] else 0.0
+                dictResult['ncbi'] = RequestStats(eutils, dictResult['taxa'])
+                dictResult['fluidinfo'] = RequestStats(fluid, dictResult['taxa'])
+            lResults.append(dictResult)
+    finally:
+        fluid.Stop()
+        eutils.Stop()
+        shutil.rmtree(sTempDir)
+
+    PrintReport(lResults)
+    dictSync = dict([(dictResult['stage'], dictResult) for dictResult in lResults
+                     if (dictResult['stage'] in ('taxa-sync', 'taxa-sharded-sync')) and ('error' not in dictResult)])
+    if len(dictSync) == 2:
+        lTotals = [[dictSync[sStage]['metrics']['counters'].get(sCounter, 0) for sCounter in lSyncCounters]
+                   for sStage in ('taxa-sync', 'taxa-sharded-sync')]
+        if lTotals[0] == lTotals[1]:
+            print "Sync totals of taxa-sync and taxa-sharded-sync match:", ', '.join(['%s %d' % item for item in zip(lSyncCounters, lTotals[0])])
+        else:
+            print "Sync totals of taxa-sync and taxa-sharded-sync DIFFER:"
+            for (sCounter, iSerial, iSharded) in zip(lSyncCounters, lTotals[0], lTotals[1]):
+                print "    %-24s %9d %9d" % (sCounter, iSerial, iSharded)
+    if args.json:
+        fileJson = open(args.json, 'w')
+        json.dump({'latency_ms': args.latency, 'fluidlatency_ms': args.fluidlatency, 'stages': lResults}, fileJson, indent=2)
+        fileJson.close()
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+FluidWriter.py
+
+Batched and concurrent writing of tag values into FluidInfo.
+
+Instead of one "PUT VALUES" request per object, the taggings of many objects are
+gathered and sent together in a single request, by a pool of worker threads:
+    http://api.fluidinfo.com/html/api.html#values_PUT
+
+The DiffValuesWriter first reads the current values of each batch with a single
+"GET VALUES" request, and only writes the tags whose values changed:
+    http://api.fluidinfo.com/html/api.html#values_GET
+
+"""
+
+
+import time
+import threading
+import Queue
+
+import Instrumentation
+
+
+def AboutQuery(sAbout):
+    """
+        Returns the FluidInfo query matching the object with the given about tag value.
+        Backslashes and double quotes in sAbout are escaped.
+    """
+    return u'fluiddb/about = "' + sAbout.replace(u'\\', u'\\\\').replace(u'"', u'\\"') + u'"'
+
+
+class BatchedValuesWriter:
+    """Gathers the taggings of many objects and writes them with batched "PUT VALUES" requests.
+
+       Put() only queues the tagging. Full batches are handed over to a pool of worker threads,
+       while partial batches are sent once they're older than the flush interval.
+       If all workers are busy and the queue of pending batches is full, Put() blocks, so that
+       whoever is producing the taggings can't run away from the writes.
+
+       If a batch fails, its objects are retried one by one, so that a single bad record
+       doesn't lose the whole batch. Those that still fail are reported through OnFailure()
+       and onfailure(), and collected in the list self.failures
+
+        @param fdb:             The fom Fluid session to write through.
+
+        @param batchsize:       Maximum number of objects per request. Defaults to 100.
+
+        @param workers:         Number of worker threads sending requests concurrently. Defaults to 4.
+
+        @param flushinterval:   Seconds after which a partial batch is sent anyway. Defaults to 5.0
+
+        @param maxpending:      Maximum number of batches waiting for a worker before Put() blocks.
+                                Defaults to twice the number of workers.
+
+        @param oncommit:        Optional callable, called as oncommit(sAbout, context) from the worker
+                                threads, for each object whose tagging was written.
+
+        @param onfailure:       Optional callable, called as onfailure(sAbout, context) from the worker
+                                threads, for each object whose tagging couldn't be written.
+    """
+    def __init__(self, fdb, batchsize=100, workers=4, flushinterval=5.0, maxpending=None, oncommit=None, onfailure=None):
+        self.fdb = fdb
+        self.oncommit = oncommit
+        self.onfailure = onfailure
+        self.batchsize = batchsize
+        self.flushinterval = flushinterval
+        if maxpending is None:
+            maxpending = 2*workers
+        self.lock = threading.Lock()
+        self.batch = []
+        self.tBatchStarted = None
+        self.queue = Queue.Queue(maxsize=maxpending)
+        self.failures = []
+        self.committed = 0
+        self.stopping = threading.Event()
+
+        self.threads = []
+        for i in xrange(workers):
+            thread = threading.Thread(target=self.Worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        self.flusher = threading.Thread(target=self.Flusher)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def Put(self, sAbout, dictTagging, context=None):
+        """
+            Queue the tagging of an object for writing.
+
+            @param sAbout: The about tag value of the object. It gets created if it doesn't exist yet.
+            @param dictTagging: The tag paths and values, with the structure required by the "PUT VALUES" API:
+                                    dict[<tagpath>]={u'value': <tagvalue>}
+            @param context: Anything the caller wants handed back to oncommit() or onfailure().
+        """
+        lBatch = None
+        self.lock.acquire()
+        try:
+            if not self.batch:
+                self.tBatchStarted = time.time()
+            self.batch.append((sAbout, dictTagging, context))
+            if len(self.batch) >= self.batchsize:
+                lBatch = self.TakeBatch()
+        finally:
+            self.lock.release()
+        # Blocks while the queue is full, outside the lock!
+        if lBatch:
+            self.queue.put(lBatch)
+
+    def TakeBatch(self):
+        """
+            Take out the batch being gathered. Must be called with self.lock held.
+        """
+        lBatch = self.batch
+        self.batch = []
+        self.tBatchStarted = None
+        return lBatch
+
+    def Flush(self):
+        """
+            Send the partial batch being gathered and wait until all queued batches were written.
+        """
+        self.lock.acquire()
+        try:
+            lBatch = self.TakeBatch()
+        finally:
+            self.lock.release()
+        if lBatch:
+            self.queue.put(lBatch)
+        self.queue.join()
+
+    def Close(self):
+        """
+            Flush and stop the worker threads.
+        """
+        self.Flush()
+        self.stopping.set()
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.flusher.join()
+
+    def Flusher(self):
+        """
+            Body of the thread that sends partial batches once they're older than the flush interval.
+        """
+        while not self.stopping.wait(self.flushinterval/2.0):
+            lBatch = None
+            self.lock.acquire()
+            try:
+                if self.batch and (time.time() - self.tBatchStarted >= self.flushinterval):
+                    lBatch = self.TakeBatch()
+            finally:
+                self.lock.release()
+            if lBatch:
+                self.queue.put(lBatch)
+
+    def Worker(self):
+        """
+            Body of the worker threads. A None item tells them to stop.
+        """
+        while True:
+            lBatch = self.queue.get()
+            try:
+                if lBatch is None:
+                    return
+                self.SendBatch(lBatch)
+            finally:
+                self.queue.task_done()
+
+    def SendBatch(self, lBatch):
+        """
+            Send a batch taken from the queue. Overridden by subclasses that don't simply write it.
+        """
+        self.WriteBatch(lBatch)
+
+    def WriteBatch(self, lBatch):
+        """
+            Write a batch of taggings with a single request, falling back to one request
+            per object if it fails.
+        """
+        lQueries = [[AboutQuery(sAbout), dictTagging] for (sAbout, dictTagging, context) in lBatch]
+        tStart = time.time()
+        try:
+            self.fdb.values('PUT', payload={'queries': lQueries})
+        except Exception, e:
+            Instrumentation.Count('fluidinfo_errors')
+            if len(lBatch) == 1:
+                (sAbout, dictTagging, context) = lBatch[0]
+                self.OnFailure(sAbout, dictTagging, context, e)
+                return
+            print "Batch of", len(lBatch), "objects failed with:", repr(e), " Retrying one by one."
+            for item in lBatch:
+                self.WriteBatch([item])
+            return
+        Instrumentation.AddTime('fluidinfo_write', time.time() - tStart)
+        Instrumentation.Count('fluidinfo_objects', len(lBatch))
+        self.lock.acquire()
+        try:
+            self.committed += len(lBatch)
+        finally:
+            self.lock.release()
+        if self.oncommit is not None:
+            for (sAbout, dictTagging, context) in lBatch:
+                self.oncommit(sAbout, context)
+
+    def OnFailure(self, sAbout, dictTagging, context, e):
+        """
+            Called for each object whose tagging couldn't be written.
+        """
+        print "Failed to write about:", sAbout, "with:", repr(e)
+        self.lock.acquire()
+        try:
+            self.failures.append((sAbout, e))
+        finally:
+            self.lock.release()
+        if self.onfailure is not None:
+            self.onfailure(sAbout, context)
+
+
+def SameValue(value, otherValue):
+    """
+        Whether two tag values are equal. Sets of strings are compared regardless of their order.
+    """
+    if isinstance(value, list) and isinstance(otherValue, list):
+        return set(value) == set(otherValue)
+    if isinstance(value, basestring) and isinstance(otherValue, basestring):
+        return value == otherValue
+    # Python doesn't tell 1 and 1.0 or True and 1 apart, but FluidInfo does.
+    return (type(value) == type(otherValue)) and (value == otherValue)
+
+
+class DiffValuesWriter(BatchedValuesWriter):
+    """BatchedValuesWriter that only writes the tags whose values changed.
+
+       Before writing a batch, the current values of its objects are read with a single
+       "GET VALUES" request. Tags holding the same value already are left out of the
+       "PUT VALUES" request, and objects without any changed tags aren't written at all,
+       so that refreshing an unchanged taxonomy costs reads but hardly any writes.
+       oncommit() is still called for those, since their tagging is in FluidInfo.
+
+       The counts of added, changed and unchanged tags are kept in self.added,
+       self.changed and self.unchanged, and the number of objects left alone in
+       self.skipped. Tags missing from the new tagging are never deleted.
+
+       If the read fails, the whole batch is written, as BatchedValuesWriter does.
+
+        @param tagpaths:    The tag paths to compare. Tags outside of it are always written.
+
+        @param volatile:    Tag paths that are only written together with other changes,
+                            e.g. a timestamp of the last update.
+
+       See BatchedValuesWriter for the other parameters.
+    """
+    def __init__(self, fdb, tagpaths, volatile=(), **kwargs):
+        self.tagpaths = list(tagpaths)
+        self.volatile = set(volatile)
+        self.added = 0
+        self.changed = 0
+        self.unchanged = 0
+        self.skipped = 0
+        BatchedValuesWriter.__init__(self, fdb, **kwargs)
+
+    def ReadBatch(self, lBatch):
+        """
+            Returns the current values of the objects of a batch, as dict[<about>][<tagpath>] = <value>
+            Objects that don't exist yet are missing.
+        """
+        sQuery = u' or '.join([AboutQuery(sAbout) for (sAbout, dictTagging, context) in lBatch])
+        with Instrumentation.Timer('fluidinfo_read'):
+            response = self.fdb.values.get(sQuery, [u'fluiddb/about'] + self.tagpaths)
+        dictCurrent = dict()
+        for dictTags in response.value[u'results'][u'id'].itervalues():
+            sAbout = dictTags.pop(u'fluiddb/about')[u'value']
+            dictCurrent[sAbout] = dict([(sTagPath, dictValue[u'value']) for (sTagPath, dictValue) in dictTags.iteritems()])
+        return dictCurrent
+
+    def SendBatch(self, lBatch):
+        try:
+            dictCurrent = self.ReadBatch(lBatch)
+        except Exception, e:
+            Instrumentation.Count('fluidinfo_errors')
+            print "Reading the values of a batch of", len(lBatch), "objects failed with:", repr(e), " Writing all of them."
+            self.WriteBatch(lBatch)
+            return
+
+        lChanged = []
+        lUnchanged = []
+        iAdded = iChanged = iUnchanged = 0
+        for (sAbout, dictTagging, context) in lBatch:
+            dictValues = dictCurrent.get(sAbout, {})
+            dictChanged = dict()
+            for (sTagPath, dictValue) in dictTagging.iteritems():
+                if sTagPath in self.volatile:
+                    continue
+                if sTagPath not in dictValues:
+                    iAdded += 1
+                elif SameValue(dictValue[u'value'], dictValues[sTagPath]):
+                    iUnchanged += 1
+                    continue
+                else:
+                    iChanged += 1
+                dictChanged[sTagPath] = dictValue
+            if dictChanged:
+                for sTagPath in self.volatile.intersection(dictTagging):
+                    dictChanged[sTagPath] = dictTagging[sTagPath]
+                lChanged.append((sAbout, dictChanged, context))
+            else:
+                lUnchanged.append((sAbout, dictTagging, context))
+
+        Instrumentation.Count('sync_tags_added', iAdded)
+        Instrumentation.Count('sync_tags_changed', iChanged)
+        Instrumentation.Count('sync_tags_unchanged', iUnchanged)
+        Instrumentation.Count('sync_objects_unchanged', len(lUnchanged))
+        self.lock.acquire()
+        try:
+            self.added += iAdded
+            self.changed += iChanged
+            self.unchanged += iUnchanged
+            self.skipped += len(lUnchanged)
+        finally:
+            self.lock.release()
+        if self.oncommit is not None:
+            for (sAbout, dictTagging, context) in lUnchanged:
+                self.oncommit(sAbout, context)
+        if lChanged:
+            self.WriteBatch(lChanged)
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+HttpCache.py
+
+Persistent on-disk cache for the responses of the NCBI E-Utilities and the Wikipedia API.
+
+Responses are keyed on the endpoint plus the normalized (sorted) request parameters,
+and stored zlib-compressed in a local SQLite file. Entries expire after a per-endpoint
+time-to-live, and the least recently used ones are evicted once the cache grows over
+its size limit.
+
+In "offline" mode the network is never touched: Requests missing in the cache fail
+with a CacheMiss error. This allows to replay a previous run at disk speed.
+
+Usage:
+    import HttpCache
+    HttpCache.Install('~/.fiTaxonomy-cache.sqlite')
+    tree = ElementTree.parse(HttpCache.urlopen(url, data))
+
+Until Install() is called, urlopen() just goes to the network.
+Either way, the network requests go through the shared RequestScheduler.
+
+"""
+
+
+import os.path
+import time
+import zlib
+import urllib
+import urllib2
+import urlparse
+import sqlite3
+import threading
+from StringIO import StringIO
+
+import RequestScheduler
+import Instrumentation
+
+
+# Time-to-live in seconds, per endpoint.
+# Query results change more often than the records they refer to.
+dictDefaultTTL = { 'esearch.fcgi' : 24*3600
+                  ,'efetch.fcgi'  : 7*24*3600
+                  ,'elink.fcgi'   : 7*24*3600
+                  ,'api.php'      : 30*24*3600 }
+
+# Seconds to wait for the SQLite file, while another process is writing into it.
+iBusyTimeout = 60
+
+# Parameters that make a request unsuitable for being answered from the cache.
+# Their results live on the Entrez history server, which forgets them after a while,
+# so these are only answered from the cache in offline mode.
+lVolatileParams = ['usehistory']
+
+
+class CacheMiss(urllib2.URLError):
+    """Raised in offline mode, for requests that aren't in the cache."""
+    pass
+
+
+def NormalizeRequest(url, data=None):
+    """
+        Returns the cache key for a request: the endpoint followed by its sorted parameters.
+        Parameters may be given either in the url or as POST data; both are treated the same.
+    """
+    (sEndpoint, sep, sQuery) = url.partition('?')
+    lParams = urlparse.parse_qsl(sQuery, keep_blank_values=True)
+    if data:
+        lParams.extend(urlparse.parse_qsl(data, keep_blank_values=True))
+    lParams.sort()
+    return sEndpoint + '?' + urllib.urlencode(lParams)
+
+
+class ResponseCache:
+    """SQLite backed cache of HTTP responses.
+
+        @param sPath:       The SQLite file. Created if it doesn't exist.
+
+        @param maxbytes:    Size limit for the compressed responses. Defaults to 1GB.
+
+        @param dictTTL:     Time-to-live in seconds, keyed by the last path component of the endpoint.
+                            Defaults to dictDefaultTTL. Endpoints not listed there never expire.
+
+        @param offline:     If True, never touch the network. Defaults to False.
+    """
+    def __init__(self, sPath, maxbytes=1024*1024*1024, dictTTL=None, offline=False):
+        self.maxbytes = maxbytes
+        self.dictTTL = dictTTL if dictTTL is not None else dictDefaultTTL
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        # The connection is shared by the threads of the caller, hence the lock.
+        self.lock = threading.Lock()
+        # The worker processes of PopulateTaxa.py --processes all share the file: Wait for
+        # each other's writes rather than failing with "database is locked", and with
+        # write-ahead logging, at least the readers don't block the writer.
+        self.db = sqlite3.connect(os.path.expanduser(sPath), timeout=iBusyTimeout, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS responses
+                           ( key      TEXT PRIMARY KEY
+                            ,stored   REAL
+                            ,accessed REAL
+                            ,size     INTEGER
+                            ,body     BLOB )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.db.commit()
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def GetTTL(self, sEndpoint):
+        """
+            Time-to-live for the responses of the given endpoint. None means forever.
+        """
+        return self.dictTTL.get(sEndpoint.rstrip('/').split('/')[-1])
+
+    def Lookup(self, sKey, sEndpoint):
+        """
+            Returns the cached response body for the key, or None if missing or expired.
+        """
+        self.lock.acquire()
+        try:
+            row = self.db.execute("SELECT stored, body FROM responses WHERE key=?", (sKey,)).fetchone()
+            if row is None:
+                return None
+            (tStored, body) = row
+            iTTL = self.GetTTL(sEndpoint)
+            if (not self.offline) and (iTTL is not None) and (time.time() - tStored > iTTL):
+                return None
+            self.db.execute("UPDATE responses SET accessed=? WHERE key=?", (time.time(), sKey))
+            self.db.commit()
+        finally:
+            self.lock.release()
+        return zlib.decompress(str(body))
+
+    def Store(self, sKey, sBody):
+        """
+            Stores a response body, evicting the least recently used ones if over the size limit.
+        """
+        body = zlib.compress(sBody)
+        tNow = time.time()
+        self.lock.acquire()
+        try:
+            row = self.db.execute("SELECT size FROM responses WHERE key=?", (sKey,)).fetchone()
+            if row is not None:
+                self.size -= row[0]
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                            (sKey, tNow, tNow, len(body), sqlite3.Binary(body)))
+            self.size += len(body)
+            if self.size > self.maxbytes:
+                self.Evict()
+            self.db.commit()
+        finally:
+            self.lock.release()
+
+    def Evict(self):
+        """
+            Deletes the least recently used responses until the cache is down to 90% of its size limit.
+            Must be called with self.lock held.
+        """
+        iTarget = int(self.maxbytes * 0.9)
+        lEvicted = []
+        for (sKey, iSize) in self.db.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            if self.size <= iTarget:
+                break
+            lEvicted.append((sKey,))
+            self.size -= iSize
+        self.db.executemany("DELETE FROM responses WHERE key=?", lEvicted)
+
+    def urlopen(self, url, data=None, stream=False, keydata=None):
+        """
+            Drop-in replacement for urllib2.urlopen(), answering from the cache when possible.
+            Returns a file-like object with the response body.
+
+            @param stream: Ignored, since the whole response is needed to store it.
+
+            @param keydata: Parameters to key the response on instead of data. See urlopen()
+        """
+        sKey = NormalizeRequest(url, data if keydata is None else keydata)
+        sEndpoint = sKey.partition('?')[0]
+        sParams = '&' + sKey.partition('?')[2]
+        bVolatile = len([p for p in lVolatileParams if ('&'+p+'=') in sParams]) > 0
+
+        if self.offline or not bVolatile:
+            sBody = self.Lookup(sKey, sEndpoint)
+            if sBody is not None:
+                self.hits += 1
+                Instrumentation.Count('cache_hits')
+                return StringIO(sBody)
+
+        self.misses += 1
+        Instrumentation.Count('cache_misses')
+        if self.offline:
+            raise CacheMiss("Not in the cache: " + sKey)
+        sBody = RequestScheduler.urlopen(url, data).read()
+        self.Store(sKey, sBody)
+        return StringIO(sBody)
+
+
+# The cache used by urlopen(), if any.
+cache = None
+
+def Install(sPath, maxbytes=1024*1024*1024, dictTTL=None, offline=False):
+    """
+        Makes urlopen() use a ResponseCache stored at sPath. See ResponseCache for the parameters.
+    """
+    global cache
+    cache = ResponseCache(sPath, maxbytes, dictTTL, offline)
+    return cache
+
+def urlopen(url, data=None, stream=False, keydata=None):
+    """
+        Drop-in replacement for urllib2.urlopen(), that goes through the installed cache, if any.
+
+        @param stream: Without cache, read the response while it's being parsed.
+                       See RequestScheduler.urlopen()
+
+        @param keydata: Optional parameters to key the response on in the cache, instead of data.
+                        For requests referring to results on the Entrez history server, whose
+                        WebEnv changes with every run, e.g. the Esearch term plus retstart/retmax.
+    """
+    if cache is None:
+        return RequestScheduler.urlopen(url, data, stream)
+    return cache.urlopen(url, data, stream, keydata)
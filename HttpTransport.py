@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""
+HttpTransport.py
+
+Shared HTTP transport for all the requests of the fiTaxonomy scripts: the E-Utilities,
+the Wikipedia API and FluidInfo.
+
+*   Connections are kept alive and pooled per host, so that a TCP connection, and for
+    https a TLS session, isn't set up anew for every single request.
+*   Responses are requested gzip-compressed, and decompressed while they're being read,
+    so that an XML parser can consume them straight off the socket.
+*   Separate timeouts for connecting and for waiting on the server.
+
+Usage:
+    import HttpTransport
+    HttpTransport.Install(timeout=60.0)         # Optional
+    sBody = HttpTransport.urlopen(url, data).read()
+    HttpTransport.BindFluid(fdb)                # Sends the requests of a fom session through it
+
+RequestScheduler.urlopen() goes through this transport.
+
+"""
+
+
+import time
+import zlib
+import socket
+import httplib
+import urllib2
+import urlparse
+import threading
+from StringIO import StringIO
+
+import Instrumentation
+
+
+# Redirects followed by urlopen(), like urllib2.urlopen() does.
+lRedirectCodes = [301, 302, 303, 307, 308]
+iMaxRedirects = 5
+
+# Read size of the compressed responses.
+iReadSize = 64*1024
+
+
+class ConnectionPool:
+    """Idle keep-alive connections to one host, ready to be reused.
+
+        @param sScheme:         "http" or "https"
+
+        @param sHost:           Host name.
+
+        @param iPort:           Port, or None for the default one of the scheme.
+
+        @param maxidle:         Maximum number of idle connections kept. Defaults to 8.
+
+        @param idletimeout:     Seconds after which an idle connection is dropped rather than
+                                reused, since the server has most likely closed it by then. Defaults to 15.
+    """
+    def __init__(self, sScheme, sHost, iPort=None, maxidle=8, idletimeout=15.0):
+        self.scheme = sScheme
+        self.host = sHost
+        self.port = iPort
+        self.maxidle = maxidle
+        self.idletimeout = idletimeout
+        # List of (connection, time it became idle), the most recent last.
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def Get(self, fConnectTimeout):
+        """
+            Returns a tuple (connection, whether it was reused).
+            New connections aren't connected yet.
+        """
+        tNow = time.time()
+        self.lock.acquire()
+        try:
+            while self.idle:
+                (conn, tIdle) = self.idle.pop()
+                if tNow - tIdle < self.idletimeout:
+                    return (conn, True)
+                conn.close()
+        finally:
+            self.lock.release()
+        if self.scheme == 'https':
+            conn = httplib.HTTPSConnection(self.host, self.port, timeout=fConnectTimeout)
+        else:
+            conn = httplib.HTTPConnection(self.host, self.port, timeout=fConnectTimeout)
+        return (conn, False)
+
+    def Put(self, conn):
+        """
+            Return a connection whose last response was read completely.
+        """
+        self.lock.acquire()
+        try:
+            if len(self.idle) < self.maxidle:
+                self.idle.append((conn, time.time()))
+                return
+        finally:
+            self.lock.release()
+        conn.close()
+
+    def Close(self):
+        self.lock.acquire()
+        try:
+            for (conn, tIdle) in self.idle:
+                conn.close()
+            self.idle = []
+        finally:
+            self.lock.release()
+
+
+class HttpResponse:
+    """File-like response body, decompressed while it's being read.
+
+       The connection goes back to its pool as soon as the body was read completely.
+       A response closed before that closes its connection too.
+
+        @param code:    The HTTP status code.
+        @param url:     The requested URL.
+    """
+    def __init__(self, pool, conn, response, url):
+        self.pool = pool
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.code = response.status
+        self.msg = response.reason
+        self.headers = response.msg
+        self.decompressor = None
+        if (response.getheader('content-encoding') or '').lower() == 'gzip':
+            # 16 + MAX_WBITS: Expect the gzip header and trailer
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = ''
+        self.exhausted = False
+        # Seconds spent waiting for the body so far, e.g. to tell them apart from the parsing.
+        self.readseconds = 0.0
+        # See Measure()
+        self.timer = None
+        self.timerseconds = 0.0
+        self.bytesread = 0
+
+    def Measure(self, sTimer, fSeconds):
+        """
+            Record the request into the given Instrumentation timer once the body was read,
+            including the time spent reading it, and count the body into http_bytes_in.
+
+            @param fSeconds: Seconds already spent on the request, e.g. waiting for the headers.
+        """
+        self.timer = sTimer
+        self.timerseconds = fSeconds
+
+    def Report(self):
+        if self.timer is not None:
+            Instrumentation.AddTime(self.timer, self.timerseconds + self.readseconds)
+            Instrumentation.Count('http_bytes_in', self.bytesread)
+            self.timer = None
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def ReadRaw(self, iSize):
+        """
+            Read up to iSize bytes off the wire, returning '' at the end of the body.
+        """
+        if self.exhausted:
+            return ''
+        tStart = time.time()
+        sRaw = self.response.read(iSize)
+        self.readseconds += time.time() - tStart
+        Instrumentation.Count('transport_bytes_in', len(sRaw))
+        if not sRaw:
+            self.exhausted = True
+            if self.response.will_close:
+                self.conn.close()
+            else:
+                self.pool.Put(self.conn)
+            self.conn = None
+        return sRaw
+
+    def read(self, iSize=-1):
+        """
+            Returns up to iSize bytes of the decompressed body, or all the rest with iSize < 0.
+        """
+        if self.decompressor is None:
+            if iSize < 0:
+                lParts = [self.buffer]
+                sRaw = self.ReadRaw(iReadSize)
+                while sRaw:
+                    lParts.append(sRaw)
+                    sRaw = self.ReadRaw(iReadSize)
+                self.buffer = ''
+                return self.Returned(''.join(lParts))
+            while (len(self.buffer) < iSize) and not self.exhausted:
+                self.buffer += self.ReadRaw(iSize - len(self.buffer))
+        else:
+            lParts = [self.buffer]
+            iBuffered = len(self.buffer)
+            while ((iSize < 0) or (iBuffered < iSize)) and not self.exhausted:
+                sRaw = self.ReadRaw(iReadSize)
+                sData = self.decompressor.decompress(sRaw) if sRaw else self.decompressor.flush()
+                lParts.append(sData)
+                iBuffered += len(sData)
+            self.buffer = ''.join(lParts)
+        if iSize < 0:
+            (sData, self.buffer) = (self.buffer, '')
+        else:
+            (sData, self.buffer) = (self.buffer[:iSize], self.buffer[iSize:])
+        return self.Returned(sData)
+
+    def Returned(self, sData):
+        """
+            Accounts for the body data returned by read(), reporting once all was returned.
+        """
+        self.bytesread += len(sData)
+        if self.exhausted and not self.buffer:
+            self.Report()
+        return sData
+
+    def close(self):
+        self.Report()
+        if self.conn is not None:
+            # The rest of the body would get in the way of the next request.
+            self.conn.close()
+            self.conn = None
+            self.exhausted = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+
+class Transport:
+    """Keep-alive HTTP client with per-host connection pools. Thread-safe.
+
+        @param timeout:         Seconds to wait for the server once connected. Defaults to 60.
+
+        @param connecttimeout:  Seconds to wait for a connection. Defaults to 10.
+
+        @param maxidle:         Maximum number of idle connections kept per host. Defaults to 8.
+
+        @param idletimeout:     Seconds an idle connection may be reused for. Defaults to 15.
+
+        @param gzip:            Whether to ask for gzip-compressed responses. Defaults to True.
+    """
+    def __init__(self, timeout=60.0, connecttimeout=10.0, maxidle=8, idletimeout=15.0, gzip=True):
+        self.timeout = timeout
+        self.connecttimeout = connecttimeout
+        self.maxidle = maxidle
+        self.idletimeout = idletimeout
+        self.gzip = gzip
+        self.pools = dict()
+        self.lock = threading.Lock()
+
+    def GetPool(self, sScheme, sHost, iPort):
+        """
+            Returns the ConnectionPool of a host, creating it on first use.
+        """
+        self.lock.acquire()
+        try:
+            key = (sScheme, sHost, iPort)
+            if key not in self.pools:
+                self.pools[key] = ConnectionPool(sScheme, sHost, iPort, self.maxidle, self.idletimeout)
+            return self.pools[key]
+        finally:
+            self.lock.release()
+
+    def Request(self, sMethod, url, body=None, headers=None, timeout=None):
+        """
+            Send a request and wait for the headers of its response.
+            Returns an HttpResponse, whatever its status code. Read it completely or close it.
+
+            A request on a reused connection that the server had meanwhile closed
+            is resent once on a new connection.
+
+            @param timeout: Overrides the timeout of the transport for this request.
+        """
+        urlParts = urlparse.urlsplit(url)
+        pool = self.GetPool(urlParts.scheme, urlParts.hostname, urlParts.port)
+        sPath = urlParts.path or '/'
+        if urlParts.query:
+            sPath += '?' + urlParts.query
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        dictHeaders = dict(headers or {})
+        if self.gzip and ('accept-encoding' not in [sKey.lower() for sKey in dictHeaders]):
+            dictHeaders['Accept-Encoding'] = 'gzip'
+        if (body is not None) and ('content-type' not in [sKey.lower() for sKey in dictHeaders]):
+            dictHeaders['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        while True:
+            (conn, bReused) = pool.Get(self.connecttimeout)
+            try:
+                if conn.sock is None:
+                    conn.connect()
+                    Instrumentation.Count('transport_connections')
+                else:
+                    Instrumentation.Count('transport_reused')
+                conn.sock.settimeout(timeout or self.timeout)
+                conn.request(sMethod, sPath, body, dictHeaders)
+                response = conn.getresponse()
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                if bReused and not isinstance(e, socket.timeout):
+                    continue
+                raise
+            Instrumentation.Count('transport_bytes_out', len(body or ''))
+            return HttpResponse(pool, conn, response, url)
+
+    def urlopen(self, url, data=None, timeout=None):
+        """
+            Drop-in replacement for urllib2.urlopen(), following redirects and raising
+            urllib2.HTTPError for error responses.
+            Returns the HttpResponse, to be read while it arrives.
+        """
+        sMethod = 'GET' if data is None else 'POST'
+        for iRedirect in xrange(iMaxRedirects + 1):
+            response = self.Request(sMethod, url, data, timeout=timeout)
+            if (response.code in lRedirectCodes) and response.headers.getheader('location'):
+                response.read()
+                url = urlparse.urljoin(url, response.headers.getheader('location'))
+                if response.code not in (307, 308):
+                    (sMethod, data) = ('GET', None)
+                continue
+            if response.code >= 400:
+                # Read the error page, so that the connection can be reused.
+                raise urllib2.HTTPError(url, response.code, response.msg, response.headers, StringIO(response.read()))
+            return response
+        raise urllib2.HTTPError(url, response.code, "Too many redirects", response.headers, StringIO(response.read()))
+
+    def Close(self):
+        """
+            Close all the idle connections.
+        """
+        self.lock.acquire()
+        try:
+            for pool in self.pools.itervalues():
+                pool.Close()
+        finally:
+            self.lock.release()
+
+
+class FluidHeaders(dict):
+    """Response headers as the requests library hands them out, and fom expects them:
+       Looked up regardless of case, with None for missing ones, e.g.
+       headers['content-type'] of a "204 No Content" response.
+       httplib's HTTPMessage raises a KeyError instead.
+    """
+    def __init__(self, message):
+        dict.__init__(self, [(sName.lower(), sValue) for (sName, sValue) in message.items()])
+
+    def __getitem__(self, sName):
+        return dict.get(self, sName.lower())
+
+    def __contains__(self, sName):
+        return dict.__contains__(self, sName.lower())
+
+    def get(self, sName, default=None):
+        return dict.get(self, sName.lower(), default)
+
+
+class FluidResponse:
+    """The parts of a response of the requests library that fom uses."""
+    def __init__(self, response, sBody):
+        self.status_code = response.code
+        self.headers = FluidHeaders(response.headers)
+        self.content = sBody
+        sCharset = 'utf-8'
+        for sParam in (response.headers.getheader('content-type') or '').split(';')[1:]:
+            (sKey, sep, sValue) = sParam.strip().partition('=')
+            if sKey.lower() == 'charset' and sValue:
+                sCharset = sValue.strip('"')
+        self.text = sBody.decode(sCharset, 'replace')
+
+
+class FluidSession:
+    """Stands in for the requests session of a fom FluidDB client, sending its
+       requests through the shared transport. See BindFluid()
+    """
+    def request(self, method, url, data=None, headers=None):
+        response = transport.Request(method, url, data, headers)
+        try:
+            sBody = response.read()
+        finally:
+            response.close()
+        return FluidResponse(response, sBody)
+
+
+# The transport used by urlopen() and the bound fom sessions.
+transport = Transport()
+
+def Install(timeout=60.0, connecttimeout=10.0, maxidle=8, idletimeout=15.0, gzip=True):
+    """
+        Replaces the transport used by urlopen() and the bound fom sessions. See Transport for the parameters.
+        Also to be called in a forked process, so that it doesn't share the connections of its parent.
+    """
+    global transport
+    transport = Transport(timeout=timeout, connecttimeout=connecttimeout, maxidle=maxidle,
+                          idletimeout=idletimeout, gzip=gzip)
+    return transport
+
+def urlopen(url, data=None, timeout=None):
+    """
+        Drop-in replacement for urllib2.urlopen(), going through the shared transport.
+    """
+    return transport.urlopen(url, data, timeout)
+
+def BindFluid(fdb):
+    """
+        Sends all the requests of a fom Fluid session through the shared transport.
+    """
+    fdb.db.session = FluidSession()
+    return fdb
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+ImportJournal.py
+
+Checkpoint journal and change index for resumable, incremental imports.
+
+The journal keeps, in a local SQLite file:
+*   The query being imported and the position up to which all its taxa were written.
+    With --resume, PopulateTaxa.py continues from there instead of starting over.
+*   The TaxIds committed since that checkpoint, so that those aren't written twice.
+*   A content hash of the tagging of every taxon written so far. Later runs skip
+    the taxa whose tagging hasn't changed since.
+
+"""
+
+
+import os.path
+import json
+import hashlib
+import sqlite3
+import threading
+
+
+def HashTagging(dictTagging):
+    """
+        Returns a content hash of a tagging dict, as used by the "PUT VALUES" API.
+        Independent of the order of the tags, but not of the order of set-valued tags.
+    """
+    return hashlib.sha1(json.dumps(dictTagging, sort_keys=True)).hexdigest()
+
+
+class ImportJournal:
+    """Checkpoint journal and change index of an import.
+
+        Committed() may be called from the worker threads of a BatchedValuesWriter.
+
+        @param sPath:   The SQLite file. Created if it doesn't exist.
+    """
+    def __init__(self, sPath):
+        # The connection is shared by the writer threads, hence the lock.
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.expanduser(sPath), check_same_thread=False)
+        # Write-ahead logging keeps the many small commits cheap.
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS checkpoint (query TEXT, offset INTEGER)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS committed (taxid INTEGER PRIMARY KEY)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS hashes (taxid INTEGER PRIMARY KEY, hash TEXT)")
+        self.db.commit()
+        self.unchanged = 0
+
+    def Start(self, sQuery, bResume=False):
+        """
+            Start importing the results of a query.
+
+            @param sQuery: Identifies what is being imported. e.g. the Esearch term
+            @param bResume: If True and the journal holds an unfinished import of the same query,
+                            continue that one.
+
+            Returns the position at which the import has to start.
+        """
+        self.lock.acquire()
+        try:
+            row = self.db.execute("SELECT query, offset FROM checkpoint").fetchone()
+            if bResume and (row is not None) and (row[0] == sQuery):
+                return row[1]
+            if bResume:
+                print "Nothing to resume for query:", sQuery
+            self.db.execute("DELETE FROM checkpoint")
+            self.db.execute("DELETE FROM committed")
+            self.db.execute("INSERT INTO checkpoint VALUES (?, 0)", (sQuery,))
+            self.db.commit()
+            return 0
+        finally:
+            self.lock.release()
+
+    def Checkpoint(self, iOffset):
+        """
+            Record that all the taxa before position iOffset were handled.
+            The caller has to make sure their writes completed, e.g. by flushing the writer.
+        """
+        self.lock.acquire()
+        try:
+            self.db.execute("UPDATE checkpoint SET offset=?", (iOffset,))
+            self.db.execute("DELETE FROM committed")
+            self.db.commit()
+        finally:
+            self.lock.release()
+
+    def Finish(self):
+        """
+            Record that the import is complete, so there's nothing left to resume.
+        """
+        self.lock.acquire()
+        try:
+            self.db.execute("DELETE FROM checkpoint")
+            self.db.execute("DELETE FROM committed")
+            self.db.commit()
+        finally:
+            self.lock.release()
+
+    def IsCommitted(self, iTaxId):
+        """
+            Whether the taxon was written since the last checkpoint.
+        """
+        self.lock.acquire()
+        try:
+            return self.db.execute("SELECT 1 FROM committed WHERE taxid=?", (iTaxId,)).fetchone() is not None
+        finally:
+            self.lock.release()
+
+    def IsUnchanged(self, iTaxId, sHash):
+        """
+            Whether the taxon was already written with a tagging of the given hash.
+        """
+        self.lock.acquire()
+        try:
+            row = self.db.execute("SELECT hash FROM hashes WHERE taxid=?", (iTaxId,)).fetchone()
+        finally:
+            self.lock.release()
+        return (row is not None) and (row[0] == sHash)
+
+    def Committed(self, iTaxId, sHash):
+        """
+            Record that the tagging of a taxon, with the given hash, was written.
+        """
+        self.lock.acquire()
+        try:
+            self.db.execute("INSERT OR IGNORE INTO committed VALUES (?)", (iTaxId,))
+            self.db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?)", (iTaxId, sHash))
+            self.db.commit()
+        finally:
+            self.lock.release()
+
+    def Close(self):
+        self.db.close()
@@ -0,0 +1,356 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation.py
+
+Counters, timers and progress reporting for the long-running imports, to tell whether
+a slow run is bound by the network, by XML parsing, by tag extraction or by the writes.
+
+All the modules record into the shared registry through the module-level functions:
+    Instrumentation.Count('http_bytes_in', len(sBody))
+    with Instrumentation.Timer('xml_parse'):
+        tree = ElementTree.parse(fileXml)
+
+A Reporter thread prints a progress line with rate and ETA every few seconds, and
+optionally writes snapshots of all the metrics into a file, either as JSON or, if the file
+name ends with ".prom", in the Prometheus text format, e.g. for the node_exporter textfile collector:
+    https://prometheus.io/docs/instrumenting/exposition_formats/
+
+"""
+
+
+import os
+import sys
+import json
+import time
+import threading
+
+
+# Prefix of the metric names in the Prometheus format.
+sPrometheusPrefix = 'fitaxonomy_'
+
+# Timers whose totals are compared in the progress line, to show where the time goes.
+lBreakdownTimers = [ ('http',    'network')
+                    ,('xml_parse', 'parse')
+                    ,('extract', 'extract')
+                    ,('fluidinfo_write', 'write') ]
+
+
+class Metrics:
+    """Thread-safe registry of counters and timers.
+
+       Counters are plain running totals. Timers keep the number of timed events,
+       their total seconds and the slowest one.
+       Timer names may be refined by a suffix after a dot, e.g. "http.efetch", which is
+       also added to the total of the plain name "http".
+       The snapshots of other registries, e.g. those of worker processes, can be added
+       with AddSource(). They are included in the totals.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict()
+        # name -> [count, seconds, max seconds]
+        self.timers = dict()
+        # source -> its latest Snapshot()
+        self.sources = dict()
+        self.tStarted = time.time()
+
+    def Count(self, sName, n=1):
+        self.lock.acquire()
+        try:
+            self.counters[sName] = self.counters.get(sName, 0) + n
+        finally:
+            self.lock.release()
+
+    def AddTime(self, sName, fSeconds):
+        self.lock.acquire()
+        try:
+            lNames = [sName]
+            if '.' in sName:
+                lNames.append(sName.split('.')[0])
+            for sKey in lNames:
+                timer = self.timers.get(sKey)
+                if timer is None:
+                    timer = self.timers[sKey] = [0, 0.0, 0.0]
+                timer[0] += 1
+                timer[1] += fSeconds
+                timer[2] = max(timer[2], fSeconds)
+        finally:
+            self.lock.release()
+
+    def AddSource(self, source, dictSnapshot):
+        """
+            Include the Snapshot() of another registry in the totals, replacing any
+            previous snapshot of the same source.
+        """
+        self.lock.acquire()
+        try:
+            self.sources[source] = dictSnapshot
+        finally:
+            self.lock.release()
+
+    def GetSeconds(self, sName):
+        return self.Snapshot()['timers'].get(sName, {'seconds': 0.0})['seconds']
+
+    def Snapshot(self):
+        """
+            Returns a copy of all the metrics, including those of the sources, as a dict ready for json.dumps()
+        """
+        self.lock.acquire()
+        try:
+            dictCounters = dict(self.counters)
+            dictTimers = dict([(sName, {'count': timer[0], 'seconds': timer[1], 'max': timer[2]})
+                               for (sName, timer) in self.timers.iteritems()])
+            for dictSource in self.sources.itervalues():
+                for (sName, value) in dictSource['counters'].iteritems():
+                    dictCounters[sName] = dictCounters.get(sName, 0) + value
+                for (sName, dictTimer) in dictSource['timers'].iteritems():
+                    dictTotal = dictTimers.setdefault(sName, {'count': 0, 'seconds': 0.0, 'max': 0.0})
+                    dictTotal['count'] += dictTimer['count']
+                    dictTotal['seconds'] += dictTimer['seconds']
+                    dictTotal['max'] = max(dictTotal['max'], dictTimer['max'])
+            return { 'uptime'   : time.time() - self.tStarted
+                    ,'counters' : dictCounters
+                    ,'timers'   : dictTimers }
+        finally:
+            self.lock.release()
+
+
+class Timer:
+    """Times the enclosed block into the given timer of the shared registry:
+            with Timer('xml_parse'):
+                ...
+       The time is recorded even if the block raises.
+    """
+    def __init__(self, sName):
+        self.sName = sName
+        self.tStart = None
+
+    def __enter__(self):
+        self.tStart = time.time()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        metrics.AddTime(self.sName, time.time() - self.tStart)
+        return False
+
+
+class Progress:
+    """Progress of an iteration over a known number of items, with rate and ETA.
+
+        @param total:   Expected number of items. May be set later, e.g. once iterTaxa.count is known.
+        @param start:   Number of items already done before, e.g. when resuming. Not counted into the rate.
+    """
+    def __init__(self, total=0, start=0):
+        self.total = total
+        self.done = start
+        self.lock = threading.Lock()
+        self.tStarted = time.time()
+        self.iStartDone = start
+        # (time, done) of the previous report, for the recent rate
+        self.tLast = self.tStarted
+        self.iLastDone = start
+
+    def Advance(self, n=1):
+        self.lock.acquire()
+        try:
+            self.done += n
+        finally:
+            self.lock.release()
+
+    def GetRate(self):
+        """
+            Returns the items per second since the start.
+        """
+        fElapsed = time.time() - self.tStarted
+        if fElapsed <= 0:
+            return 0.0
+        return (self.done - self.iStartDone)/fElapsed
+
+    def GetRecentRate(self):
+        """
+            Returns the items per second since the previous call.
+        """
+        tNow = time.time()
+        iDone = self.done
+        fRate = 0.0
+        if tNow > self.tLast:
+            fRate = (iDone - self.iLastDone)/(tNow - self.tLast)
+        self.tLast = tNow
+        self.iLastDone = iDone
+        return fRate
+
+    def GetEta(self):
+        """
+            Returns the estimated seconds left, or None if unknown.
+        """
+        fRate = self.GetRate()
+        if (not self.total) or (fRate <= 0):
+            return None
+        return max(0, self.total - self.done)/fRate
+
+
+def FormatDuration(fSeconds):
+    if fSeconds is None:
+        return '?'
+    iSeconds = int(fSeconds)
+    if iSeconds >= 3600:
+        return '%dh%02dm' % (iSeconds/3600, iSeconds%3600/60)
+    if iSeconds >= 60:
+        return '%dm%02ds' % (iSeconds/60, iSeconds%60)
+    return '%ds' % iSeconds
+
+
+def FormatPrometheus(dictSnapshot, dictProgress=None):
+    """
+        Renders a snapshot of the metrics in the Prometheus text exposition format.
+        Timer names refined with a dot become a "detail" label.
+        The plain timer of refined ones holds their totals, so that only what it holds
+        beyond them is written, unlabeled. Summing up all the series gives the total.
+    """
+    lLines = []
+    lLines.append('%suptime_seconds %f' % (sPrometheusPrefix, dictSnapshot['uptime']))
+    for (sName, value) in sorted(dictSnapshot['counters'].iteritems()):
+        lLines.append('# TYPE %s%s_total counter' % (sPrometheusPrefix, sName))
+        lLines.append('%s%s_total %s' % (sPrometheusPrefix, sName, value))
+    dictTimers = dict([(sName, dict(timer)) for (sName, timer) in dictSnapshot['timers'].iteritems()])
+    for (sName, timer) in dictSnapshot['timers'].iteritems():
+        (sBase, sep, sDetail) = sName.partition('.')
+        if sDetail and (sBase in dictTimers):
+            dictTimers[sBase]['count'] -= timer['count']
+            dictTimers[sBase]['seconds'] -= timer['seconds']
+            dictTimers[sBase]['refined'] = True
+    sLastType = None
+    for (sName, timer) in sorted(dictTimers.iteritems()):
+        if timer.get('refined') and (timer['count'] <= 0):
+            continue
+        (sBase, sep, sDetail) = sName.partition('.')
+        sLabels = '{detail="%s"}' % sDetail if sDetail else ''
+        if sBase != sLastType:
+            lLines.append('# TYPE %s%s_seconds summary' % (sPrometheusPrefix, sBase))
+            sLastType = sBase
+        lLines.append('%s%s_seconds_count%s %d' % (sPrometheusPrefix, sBase, sLabels, timer['count']))
+        lLines.append('%s%s_seconds_sum%s %f' % (sPrometheusPrefix, sBase, sLabels, timer['seconds']))
+    if dictProgress is not None:
+        for (sName, value) in sorted(dictProgress.iteritems()):
+            if value is not None:
+                lLines.append('%sprogress_%s %s' % (sPrometheusPrefix, sName, value))
+    return '\n'.join(lLines) + '\n'
+
+
+class Reporter:
+    """Background thread that reports the progress and snapshots the metrics periodically.
+
+        @param progress:    The Progress to report. May be None, to only write the snapshots.
+
+        @param interval:    Seconds between reports. Defaults to 10.
+
+        @param sPath:       Optional file to write the snapshots to. Overwritten with each one.
+                            Written in Prometheus text format if the name ends with ".prom", JSON otherwise.
+
+        @param label:       What is being counted, for the progress line. Defaults to "taxa".
+
+        @param output:      Stream for the progress lines. Defaults to stderr, so that
+                            they stay visible while stdout is redirected.
+    """
+    def __init__(self, progress=None, interval=10.0, sPath=None, label='taxa', output=None):
+        self.progress = progress
+        self.interval = interval
+        self.sPath = sPath
+        self.label = label
+        self.output = output or sys.stderr
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def Start(self):
+        self.thread = threading.Thread(target=self.Run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def Stop(self):
+        """
+            Stop the thread, with a last report.
+        """
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+        self.Report()
+
+    def Run(self):
+        while not self.stopping.wait(self.interval):
+            self.Report()
+
+    def GetProgress(self):
+        """
+            Returns a dict with the progress figures, or None if there's no progress to report.
+        """
+        if self.progress is None:
+            return None
+        return { 'done'         : self.progress.done
+                ,'total'        : self.progress.total
+                ,'rate'         : self.progress.GetRate()
+                ,'recent_rate'  : self.progress.GetRecentRate()
+                ,'eta_seconds'  : self.progress.GetEta() }
+
+    def FormatLine(self, dictProgress):
+        lParts = []
+        if dictProgress is not None:
+            sDone = '%d' % dictProgress['done']
+            if dictProgress['total']:
+                sDone += '/%d %s (%.1f%%)' % (dictProgress['total'], self.label, 100.0*dictProgress['done']/dictProgress['total'])
+            else:
+                sDone += ' ' + self.label
+            lParts.append(sDone)
+            lParts.append('%.1f/s now, %.1f/s average' % (dictProgress['recent_rate'], dictProgress['rate']))
+            lParts.append('ETA ' + FormatDuration(dictProgress['eta_seconds']))
+        # Time spent in each of the main activities, relative to each other. The activities
+        # overlap each other when running concurrently, so these are shares of effort, not of wall time.
+        lSeconds = [(sShort, metrics.GetSeconds(sTimer)) for (sTimer, sShort) in lBreakdownTimers]
+        fTotal = sum([fSeconds for (sShort, fSeconds) in lSeconds])
+        if fTotal > 0:
+            lParts.append(' '.join(['%s %d%%' % (sShort, round(100.0*fSeconds/fTotal)) for (sShort, fSeconds) in lSeconds]))
+        return '[progress] ' + ', '.join(lParts)
+
+    def Report(self):
+        dictProgress = self.GetProgress()
+        self.output.write(self.FormatLine(dictProgress) + '\n')
+        self.output.flush()
+        if self.sPath:
+            WriteSnapshot(self.sPath, dictProgress)
+
+
+def WriteSnapshot(sPath, dictProgress=None):
+    """
+        Writes a snapshot of the shared metrics into a file, replacing it atomically,
+        so that readers never see a partial one.
+    """
+    dictSnapshot = metrics.Snapshot()
+    if sPath.endswith('.prom'):
+        sContent = FormatPrometheus(dictSnapshot, dictProgress)
+    else:
+        dictSnapshot['progress'] = dictProgress
+        sContent = json.dumps(dictSnapshot, indent=2, sort_keys=True)
+    sTempPath = sPath + '.tmp'
+    fileSnapshot = open(sTempPath, 'w')
+    try:
+        fileSnapshot.write(sContent)
+    finally:
+        fileSnapshot.close()
+    os.rename(sTempPath, sPath)
+
+
+# The registry all modules record into.
+metrics = Metrics()
+
+def Count(sName, n=1):
+    """
+        Adds n to the given counter of the shared registry.
+    """
+    metrics.Count(sName, n)
+
+def AddTime(sName, fSeconds):
+    """
+        Adds an event of fSeconds to the given timer of the shared registry.
+    """
+    metrics.AddTime(sName, fSeconds)
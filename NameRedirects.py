@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+NameRedirects.py
+
+Redirect objects for the other names of the taxa: NCBI synonyms, Genbank common names
+and common names. Each name gets a FluidInfo object with that name as about tag value,
+tagged with the set of about tag values of the taxa it refers to:
+    about="human"  ./taxonomy/redirect-to = ["homo sapiens"]
+
+Across the whole taxonomy there are millions of such names, many of them shared by
+several taxa. So instead of writing a redirect for every name of every taxon, the names
+are collected into an on-disk dedup index while the taxa are being imported, and each
+name is written only once at the end, with all its targets merged into a single
+set-valued tag. The index keeps what was written, so that later runs only write the
+names whose targets changed.
+
+"""
+
+
+import os.path
+import sqlite3
+import hashlib
+import threading
+from itertools import groupby
+
+
+class RedirectIndex:
+    """On-disk dedup index of the redirects from names to taxa.
+
+       Add() the names of each imported taxon, then WriteRedirects() once all taxa are in.
+       The pairs (name, target) are kept across runs, since incremental imports skip the unchanged
+       taxa and don't Add() their names again. Delete the file to start afresh.
+
+       Names equal to the about tag value of any imported taxon aren't redirected,
+       since that object is the taxon itself.
+
+        @param sPath:       The SQLite file. Created if it doesn't exist.
+
+        @param buffersize:  Number of (name, target) pairs gathered in memory before they
+                            are merged into the index with a single transaction. Defaults to 10000.
+    """
+    def __init__(self, sPath, buffersize=10000):
+        self.buffersize = buffersize
+        self.db = sqlite3.connect(os.path.expanduser(sPath), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        # The primary keys do the deduplication, and hand out the pairs grouped by name.
+        self.db.execute("CREATE TABLE IF NOT EXISTS redirects (name TEXT, target TEXT, PRIMARY KEY (name, target)) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS taxa (about TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS written (name TEXT PRIMARY KEY, hash TEXT) WITHOUT ROWID")
+        self.db.commit()
+        self.pairs = set()
+        self.abouts = set()
+        # The names whose redirects were written, as (name, hash). Filled from the writer threads.
+        self.lock = threading.Lock()
+        self.written = []
+
+    def Add(self, sTargetAbout, lNames):
+        """
+            Record the names of an imported taxon.
+
+            @param sTargetAbout: The about tag value of the taxon.
+            @param lNames: Its other names, in any case. Duplicates don't matter.
+        """
+        self.abouts.add(sTargetAbout)
+        for sName in lNames:
+            sName = sName.lower()
+            if sName != sTargetAbout:
+                self.pairs.add((sName, sTargetAbout))
+        if len(self.pairs) >= self.buffersize:
+            self.Merge()
+
+    def Merge(self):
+        """
+            Merge the pairs gathered in memory into the index.
+        """
+        self.db.executemany("INSERT OR IGNORE INTO redirects VALUES (?, ?)", self.pairs)
+        self.db.executemany("INSERT OR IGNORE INTO taxa VALUES (?)", [(sAbout,) for sAbout in self.abouts])
+        self.db.commit()
+        self.pairs = set()
+        self.abouts = set()
+
+    def OnCommit(self, sName, sHash):
+        """
+            The oncommit callback for the BatchedValuesWriter used by WriteRedirects().
+        """
+        self.lock.acquire()
+        try:
+            self.written.append((sName, sHash))
+        finally:
+            self.lock.release()
+
+    def WriteRedirects(self, writer, sTagPath):
+        """
+            Queue the redirect of every name whose targets changed since they were last written,
+            then wait for the writes to complete.
+            Returns a tuple (number of names queued, number of unchanged names).
+
+            @param writer: A BatchedValuesWriter created with oncommit=self.OnCommit
+            @param sTagPath: The set-valued tag holding the targets, e.g. sUserNS+u'/taxonomy/redirect-to'
+        """
+        self.Merge()
+        iQueued = 0
+        iUnchanged = 0
+        # Only the main thread reads the index here. The writer threads only call OnCommit().
+        # Each row comes with the hash last written for its name, if any, so that
+        # the written names never have to be held in memory.
+        rows = self.db.execute("""SELECT redirects.name, redirects.target, written.hash
+                                  FROM redirects LEFT JOIN written ON written.name = redirects.name
+                                  WHERE redirects.name NOT IN (SELECT about FROM taxa)
+                                  ORDER BY redirects.name, redirects.target""")
+        for (sName, rowsTargets) in groupby(rows, lambda row: row[0]):
+            lRows = list(rowsTargets)
+            lTargets = [row[1] for row in lRows]
+            sHash = hashlib.sha1(u'\n'.join(lTargets).encode('utf-8')).hexdigest()
+            if lRows[0][2] == sHash:
+                iUnchanged += 1
+                continue
+            writer.Put(sName, {sTagPath: {u'value': lTargets}}, sHash)
+            iQueued += 1
+        writer.Flush()
+
+        self.lock.acquire()
+        try:
+            lWritten = self.written
+            self.written = []
+        finally:
+            self.lock.release()
+        self.db.executemany("INSERT OR REPLACE INTO written VALUES (?, ?)", lWritten)
+        self.db.commit()
+        return (iQueued, iUnchanged)
+
+    def Close(self):
+        self.Merge()
+        self.db.close()
@@ -22,10 +22,13 @@ Some pointers:
 """
 
 
-import sys
 import os.path
 import urllib
-import urllib2
+import argparse
+import shelve
+import threading
+import Queue
+from collections import OrderedDict
 
 try:
     from xml.etree import cElementTree as ElementTree
@@ -35,6 +38,13 @@ except ImportError, e:
 from fom.session import Fluid
 from fom.mapping import Object, Namespace, tag_value
 from fom.errors import Fluid412Error
+
+import HttpCache
+import HttpTransport
+import RequestScheduler
+import Instrumentation
+from FluidWriter import BatchedValuesWriter
+from TaxonSnapshot import TaxonSnapshot
     
 
 urlEutils = "http://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
@@ -43,27 +53,42 @@ urlElink = urlEutils + "elink.fcgi"
 urlWikipediaApi="http://en.wikipedia.org/w/api.php"
 
 
-def GetLinkOutData(idTax):
+def GetLinkOutDataBatch(lTaxIds):
     """
-        Uses Elink to get the LinkOut data for a given NCBI-Taxonomy-ID:
-        Returns an ElementTree with root at the <IdUrlSet> tag.
+        Uses a single Elink request to get the LinkOut data of a list of NCBI-Taxonomy-IDs.
+        Returns a dict mapping each TaxId to the list of its <ObjUrl> ElementTrees.
         
         http://www.ncbi.nlm.nih.gov/books/NBK25499/#chapter4.ELink
         
         See example XML data at: 
-            http://eutils.ncbi.nlm.nih.gov/entrez/eutils/elink.fcgi?dbfrom=taxonomy&id=9482&cmd=llinks
+            http://eutils.ncbi.nlm.nih.gov/entrez/eutils/elink.fcgi?dbfrom=taxonomy&id=9482,9606&cmd=llinks
     """
-    # Request NCBI taxon data for the given ID
     data = urllib.urlencode({ 'dbfrom' : 'taxonomy'
                              ,'cmd'    : 'llinks'
-                             ,'id'     : idTax
-                             ,'holding'   : 'iPhylo' }) # WARNING: We are currently limiting this to just one provider, for testing purposes!
-    # print data
-    tree = ElementTree.parse(urllib2.urlopen(urlElink, data ))
-    # tree.write(sys.stdout)
-    eUrlSet = tree.find(u'LinkSet/IdUrlList/IdUrlSet')
-    assert(eUrlSet is not None)
-    return eUrlSet
+                             ,'id'     : ','.join([str(iTax) for iTax in lTaxIds]) })
+    fileXml = HttpCache.urlopen(urlElink, data )
+    with Instrumentation.Timer('xml_parse'):
+        tree = ElementTree.parse(fileXml)
+    # There's one <IdUrlSet> per requested TaxId, even if it has no LinkOut entries.
+    dictObjUrls = dict()
+    for eUrlSet in tree.findall(u'LinkSet/IdUrlList/IdUrlSet'):
+        dictObjUrls[int(eUrlSet.find(u'Id').text)] = eUrlSet.findall(u'ObjUrl')
+    for iTaxId in lTaxIds:
+        assert(int(iTaxId) in dictObjUrls)
+    return dictObjUrls
+    
+def IterBatches(iterable, iBatchSize):
+    """
+        Yields the items of iterable in lists of up to iBatchSize items.
+    """
+    lBatch = []
+    for item in iterable:
+        lBatch.append(item)
+        if len(lBatch) >= iBatchSize:
+            yield lBatch
+            lBatch = []
+    if lBatch:
+        yield lBatch
     
 def LookupWikipediaTitle(iArticleId):
     """
@@ -78,14 +103,163 @@ def LookupWikipediaTitle(iArticleId):
                              ,'format' : 'xml'
                              ,'pageids': iArticleId })
     # print data
-    tree = ElementTree.parse(urllib2.urlopen(urlWikipediaApi, data ))
+    fileXml = HttpCache.urlopen(urlWikipediaApi, data )
+    with Instrumentation.Timer('xml_parse'):
+        tree = ElementTree.parse(fileXml)
     # tree.write(sys.stdout)
     ePage = tree.find(u'query/pages/page')
     return ePage.attrib['title']
 
-def HandleIPhyloLinks(oTaxon, elObjUrl):
+def LookupWikipediaTitles(lArticleIds):
+    """
+        Batched variant of LookupWikipediaTitle():
+        Converts up to 50 Page-IDs into article titles with a single request.
+        Returns a dict mapping each Page-ID to its title, or to None if there's no such page.
+        
+        See:
+            http://www.mediawiki.org/wiki/API:Query#Specifying_pages
+    """
+    assert(len(lArticleIds) <= 50)
+    data = urllib.urlencode({ 'action' : 'query'
+                             ,'format' : 'xml'
+                             ,'pageids': '|'.join([str(iArticleId) for iArticleId in lArticleIds]) })
+    fileXml = HttpCache.urlopen(urlWikipediaApi, data )
+    with Instrumentation.Timer('xml_parse'):
+        tree = ElementTree.parse(fileXml)
+    dictTitles = dict()
+    for ePage in tree.findall(u'query/pages/page'):
+        # Missing pages come without title
+        dictTitles[int(ePage.attrib['pageid'])] = ePage.attrib.get('title')
+    for iArticleId in lArticleIds:
+        dictTitles.setdefault(iArticleId, None)
+    return dictTitles
+
+class WikipediaTitleResolver:
+    """Memoizing, batching resolver of Wikipedia Page-IDs into article titles.
+    
+       Resolve() looks up many Page-IDs at once, 50 per MediaWiki request, skipping the ones
+       already known. Lookup() then answers single Page-IDs from the memo.
+       The memo is an in-process LRU, optionally backed by a persistent shelve file.
+       Missing pages are only memoized in-process, since they may be created later on.
+       It may be shared by several threads.
+       
+        @param memosize:    Maximum number of titles kept in the in-process memo. Defaults to 100000.
+        
+        @param sMemoPath:   Optional shelve file for persisting the memo across runs.
+    """
+    def __init__(self, memosize=100000, sMemoPath=None):
+        self.memosize = memosize
+        self.memo = OrderedDict()
+        # Guards the memos, but not the requests.
+        self.lock = threading.RLock()
+        self.persistent = None
+        if sMemoPath:
+            self.persistent = shelve.open(os.path.expanduser(sMemoPath))
+        
+    def Remember(self, iArticleId, sTitle):
+        """
+            Put a title into the memo, as the most recently used one.
+        """
+        self.lock.acquire()
+        try:
+            self.memo.pop(iArticleId, None)
+            self.memo[iArticleId] = sTitle
+            if len(self.memo) > self.memosize:
+                self.memo.popitem(last=False)
+        finally:
+            self.lock.release()
+            
+    def Recall(self, iArticleId):
+        """
+            Returns a tuple (bKnown, sTitle) from the memo.
+        """
+        self.lock.acquire()
+        try:
+            if iArticleId in self.memo:
+                sTitle = self.memo[iArticleId]
+                self.Remember(iArticleId, sTitle)
+                return (True, sTitle)
+            if self.persistent is not None:
+                # Memo files of earlier versions may still hold missing pages as None.
+                sTitle = self.persistent.get(str(iArticleId))
+                if sTitle is not None:
+                    self.Remember(iArticleId, sTitle)
+                    return (True, sTitle)
+            return (False, None)
+        finally:
+            self.lock.release()
+        
+    def Resolve(self, lArticleIds):
+        """
+            Returns a dict mapping each of the given Page-IDs to its title, or None if there's no such page.
+        """
+        dictTitles = dict()
+        lUnknown = []
+        for iArticleId in set(lArticleIds):
+            (bKnown, sTitle) = self.Recall(iArticleId)
+            if bKnown:
+                dictTitles[iArticleId] = sTitle
+            else:
+                lUnknown.append(iArticleId)
+        for lBatch in IterBatches(lUnknown, 50):
+            for (iArticleId, sTitle) in LookupWikipediaTitles(lBatch).iteritems():
+                self.lock.acquire()
+                try:
+                    self.Remember(iArticleId, sTitle)
+                    if (self.persistent is not None) and (sTitle is not None):
+                        self.persistent[str(iArticleId)] = sTitle
+                finally:
+                    self.lock.release()
+                dictTitles[iArticleId] = sTitle
+        return dictTitles
+        
+    def Lookup(self, iArticleId):
+        """
+            Returns the title of a single Page-ID, or None if there's no such page.
+        """
+        return self.Resolve([iArticleId])[iArticleId]
+        
+    def Close(self):
+        self.lock.acquire()
+        try:
+            if self.persistent is not None:
+                self.persistent.close()
+                self.persistent = None
+        finally:
+            self.lock.release()
+
+def GetWikipediaPageId(eObjUrl):
+    """
+        Returns the Wikipedia PageId/ArticleId of an iPhylo Wikipedia LinkOut entry,
+        or None if the <ObjUrl> is something else.
+    """
+    if (eObjUrl.find("Provider/Name").text == 'iPhylo') and (eObjUrl.find("LinkName").text == 'Wikipedia'):
+        # TODO: The following line is so ugly!
+        return int(eObjUrl.find("Url").text.split(u'=')[1])
+    return None
+
+def AddTagging(dictTaggings, sAbout, sTagPath, value):
     """
+        Adds a tag value for the object with the given about tag value to dictTaggings,
+        which maps about tag values to the tagging dicts required by the "PUT VALUES" API:
+            dictTaggings[<about>][<tagpath>]={u'value': <tagvalue>}
+    """
+    dictTaggings.setdefault(sAbout, dict())[sTagPath] = {u'value': value}
+
+def HandleIPhyloLinks(sTaxonAbout, elObjUrl, resolver=None):
+    """
+        Collects the tag values derived from the iPhylo LinkOut entries of a taxon,
+        both for the taxon itself and for the related WikipediaPage/BbcPage objects.
+        Doesn't write anything, so that all of them can be written together.
+        
+        Returns a dict mapping about tag values to their tagging dicts. See AddTagging()
+        
+        @param sTaxonAbout: The about tag value of the taxon.
+        @param elObjUrl: The <ObjUrl> ElementTrees of the taxon, as sent by Elink.
+        @param resolver: Optional WikipediaTitleResolver to look up the Wikipedia titles with.
+                         Defaults to a request per title with LookupWikipediaTitle()
     """
+    dictTaggings = dict()
     ###############################################
     # Check existance of Wikipedia LinkOut entry 
     # Provider is iPhylo, but it also provides links to "BBC Wildlife Finder"
@@ -97,42 +271,236 @@ def HandleIPhyloLinks(oTaxon, elObjUrl):
         if (eObjUrl.find("Provider/Name").text == 'iPhylo'):
             if (eObjUrl.find("LinkName").text == 'Wikipedia'):
                 # Extract the Wikipedia PageId/ArticleId from the url
-                # TODO: The following line is so ugly!
                 sWikiRawUrl = eObjUrl.find("Url").text
-                iWikiPageId = int(sWikiRawUrl.split(u'=')[1])
-                sWikiTitle = LookupWikipediaTitle(iWikiPageId)
+                iWikiPageId = GetWikipediaPageId(eObjUrl)
+                if resolver is not None:
+                    sWikiTitle = resolver.Lookup(iWikiPageId)
+                    if sWikiTitle is None:
+                        print "Wikipedia has no article with ArticleID:", iWikiPageId
+                        continue
+                else:
+                    sWikiTitle = LookupWikipediaTitle(iWikiPageId)
                 print "Jay! Found a Wikipedia link to ArticleID:",iWikiPageId," with title:",sWikiTitle
-                oTaxon.set(sNcbiNS + u'/LinkOut/wikipedia', sWikiRawUrl)
+                AddTagging(dictTaggings, sTaxonAbout, sNcbiNS + u'/LinkOut/wikipedia', sWikiRawUrl)
                 # Sometimes the iPhylo-linked Wikipedia Title doesn't match this Taxon's about value,
                 # in such cases we add a "related-wikipedia" tag pointing to the iPhylo Wikipedia article.
                 # Example: Taxon('homo sapiens') is linked by iPhylo to Wikipedia('Human')
-                if (sWikiTitle.lower() != oTaxon.about):
-                    oTaxon.set(sNcbiNS + u'/LinkOut/related-wikipedia', sWikiTitle.lower())
-                oWP = WikipediaPage(about=sWikiTitle.lower())
-                oWP.RelatedTaxon = oTaxon.about
-                oWP.PageId = iWikiPageId
-                oWP.save()
+                if (sWikiTitle.lower() != sTaxonAbout):
+                    AddTagging(dictTaggings, sTaxonAbout, sNcbiNS + u'/LinkOut/related-wikipedia', sWikiTitle.lower())
+                AddTagging(dictTaggings, sWikiTitle.lower(), WikipediaPage.__dict__['RelatedTaxon'].tagpath, sTaxonAbout)
+                AddTagging(dictTaggings, sWikiTitle.lower(), WikipediaPage.__dict__['PageId'].tagpath, iWikiPageId)
 
             elif (eObjUrl.find("LinkName").text == 'BBC Wildlife Finder'):
                 sBbcUrl = eObjUrl.find("Url").text
                 # TODO: The following line is so ugly!
                 sBbcTitle = sBbcUrl.split(u'/')[-1]
                 print "Jay! Found a BBC link:", sBbcUrl," with title:",sBbcTitle
-                oTaxon.set(sNcbiNS + u'/LinkOut/bbcwildlife', sBbcUrl)
+                AddTagging(dictTaggings, sTaxonAbout, sNcbiNS + u'/LinkOut/bbcwildlife', sBbcUrl)
                 # Sometimes the iPhylo-linked BBC Title doesn't match this Taxon's about value,
                 # in such cases we add a "related-bbcwildlife" tag pointing to the iPhylo BBC article.
                 # Example: Taxon('homo sapiens') is linked by iPhylo to BBC('Human')
-                if (sBbcTitle.lower() != oTaxon.about):
-                    oTaxon.set(sNcbiNS + u'/LinkOut/related-bbcwildlife', sBbcTitle.lower())
-                oBP = BbcPage(about=sBbcTitle.lower())
-                oBP.RelatedTaxon = oTaxon.about
-                oBP.Url = sBbcUrl
-                oBP.save()
+                if (sBbcTitle.lower() != sTaxonAbout):
+                    AddTagging(dictTaggings, sTaxonAbout, sNcbiNS + u'/LinkOut/related-bbcwildlife', sBbcTitle.lower())
+                AddTagging(dictTaggings, sBbcTitle.lower(), BbcPage.__dict__['RelatedTaxon'].tagpath, sTaxonAbout)
+                AddTagging(dictTaggings, sBbcTitle.lower(), BbcPage.__dict__['Url'].tagpath, sBbcUrl)
+    return dictTaggings
+
+class ProviderCache:
+    """The LinkOut providers seen so far in this run, keyed by their Provider/Id.
+    
+       The LinkOutProvider object of each provider is queued for writing the first time
+       it's seen, so that it's written once per run, instead of once for every link of every taxon.
+       A provider only counts as written once the writer committed its object. If the write
+       fails, it's queued again the next time the provider is seen.
+       It may be shared by several threads.
+       
+       The writer must report back to OnCommit() and OnFailure(), e.g.
+           providers = ProviderCache()
+           writer = BatchedValuesWriter(fdb, oncommit=providers.OnCommit, onfailure=providers.OnFailure)
+    """
+    def __init__(self):
+        # Provider/Id -> about tag value of the provider object, once it's written
+        self.abouts = dict()
+        # Provider/Id -> about tag value of the provider object, while its write is queued
+        self.pending = dict()
+        self.lock = threading.Lock()
+        
+    def Register(self, eObjUrl, writer):
+        """
+            Returns the about tag value of the provider of an <ObjUrl>, the full provider name
+            in lowercase, and queues its LinkOutProvider object if it's neither written nor queued yet.
+            
+            @param writer: The BatchedValuesWriter to queue the provider object into.
+        """
+        eProvider = eObjUrl.find('Provider')
+        iProviderId = int(eProvider.find('Id').text)
+        self.lock.acquire()
+        try:
+            sAbout = self.abouts.get(iProviderId) or self.pending.get(iProviderId)
+            if sAbout is not None:
+                return sAbout
+            sAbout = eProvider.find('Name').text.lower()
+            self.pending[iProviderId] = sAbout
+        finally:
+            self.lock.release()
+        dictTagging = {LinkOutProvider.__dict__['Id'].tagpath: {u'value': iProviderId}}
+        for sField in ('Name', 'NameAbbr', 'Url'):
+            eField = eProvider.find(sField)
+            if (eField is not None) and eField.text:
+                dictTagging[LinkOutProvider.__dict__[sField].tagpath] = {u'value': unicode(eField.text)}
+        # Outside the lock, since it may block.
+        writer.Put(sAbout, dictTagging, context=iProviderId)
+        return sAbout
+
+    def OnCommit(self, sAbout, context):
+        """
+            The writer's oncommit callback. The context of a provider object is its Provider/Id,
+            that of the taxa is None.
+        """
+        if context is None:
+            return
+        self.lock.acquire()
+        try:
+            self.abouts[context] = self.pending.pop(context, sAbout)
+        finally:
+            self.lock.release()
+
+    def OnFailure(self, sAbout, context):
+        """
+            The writer's onfailure callback. Forgets the failed provider, so that it's queued again.
+        """
+        if context is None:
+            return
+        self.lock.acquire()
+        try:
+            self.pending.pop(context, None)
+        finally:
+            self.lock.release()
+
+def HandleProviderLinks(dictTaggings, sTaxonAbout, elObjUrl, providers, writer):
+    """
+        Adds the LinkOut entries of all the providers of a taxon to dictTaggings, as two set-valued tags
+        of the taxon: The about tag values of the providers, and the urls of the entries.
+        
+        @param dictTaggings: [out] Tag values by about tag value. See AddTagging()
+        @param sTaxonAbout: The about tag value of the taxon.
+        @param elObjUrl: The <ObjUrl> ElementTrees of the taxon, as sent by Elink.
+        @param providers: The ProviderCache.
+        @param writer: The BatchedValuesWriter to queue new provider objects into.
+    """
+    lProviders = []
+    lUrls = []
+    for eObjUrl in elObjUrl:
+        sProvider = providers.Register(eObjUrl, writer)
+        if sProvider not in lProviders:
+            lProviders.append(sProvider)
+        sUrl = eObjUrl.find("Url").text
+        if sUrl and (sUrl not in lUrls):
+            lUrls.append(unicode(sUrl))
+    if lProviders:
+        AddTagging(dictTaggings, sTaxonAbout, sNcbiNS + u'/LinkOut/providers', lProviders)
+    if lUrls:
+        AddTagging(dictTaggings, sTaxonAbout, sNcbiNS + u'/LinkOut/urls', lUrls)
+
+def HandleLinkOutBatch(lTaxa, resolver, writer, providers=None):
+    """
+        Does the whole LinkOut stage for a batch of NcbiTaxon objects, or of SnapshotTaxon read from a TaxonSnapshot:
+        A single Elink request, the Wikipedia titles resolved in as few requests as possible,
+        and all the resulting taggings queued into the writer, with a single tagging per object.
+        
+        @param providers: Optional ProviderCache. If given, the LinkOut entries of all providers are
+                          tagged onto the taxa, see HandleProviderLinks(). Otherwise just those of iPhylo.
+    """
+    # Beware that each read of oTaxon.TaxId or oTaxon.about is a request to FluidInfo, unless it's a SnapshotTaxon!
+    lTaxIds = [oTaxon.TaxId for oTaxon in lTaxa]
+    lAbouts = [oTaxon.about for oTaxon in lTaxa]
+    # Get LinkOut items of the whole batch in a single request.
+    dictObjUrls = GetLinkOutDataBatch(lTaxIds)
+    # Resolve the Wikipedia titles of the whole batch in as few requests as possible.
+    lPageIds = [GetWikipediaPageId(eObjUrl) for elObjUrl in dictObjUrls.itervalues() for eObjUrl in elObjUrl]
+    resolver.Resolve([iPageId for iPageId in lPageIds if iPageId is not None])
+    for (sAbout, iTaxId) in zip(lAbouts, lTaxIds):
+        elObjUrl = dictObjUrls[iTaxId]
+        print "Taxon:", sAbout, "with TaxId", iTaxId, "has", len(elObjUrl), "LinkOut entries."
+        with Instrumentation.Timer('extract'):
+            dictTaggings = HandleIPhyloLinks(sAbout, elObjUrl, resolver)
+            if providers is not None:
+                HandleProviderLinks(dictTaggings, sAbout, elObjUrl, providers, writer)
+        for (sObjAbout, dictTagging) in dictTaggings.iteritems():
+            writer.Put(sObjAbout, dictTagging)
+
+def RunWorkerPool(iterable, fnWork, iWorkers):
+    """
+        Calls fnWork(item) for every item of iterable, from a pool of iWorkers threads.
+        Pulls items out of iterable only as fast as the workers handle them.
+        Returns the list of (item, exception) for the items that failed.
+    """
+    queue = Queue.Queue(maxsize=iWorkers)
+    lFailures = []
+    def Worker():
+        while True:
+            item = queue.get()
+            try:
+                if item is None:
+                    return
+                fnWork(item)
+            except Exception, e:
+                print "Failed with:", repr(e)
+                lFailures.append((item, e))
+            finally:
+                queue.task_done()
+    lThreads = [threading.Thread(target=Worker) for i in xrange(iWorkers)]
+    for thread in lThreads:
+        thread.daemon = True
+        thread.start()
+    for item in iterable:
+        queue.put(item)
+    for thread in lThreads:
+        queue.put(None)
+    for thread in lThreads:
+        thread.join()
+    return lFailures
     
 
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description="Imports NCBI LinkOut data into FluidInfo.")
+    parser.add_argument('--cache', metavar='FILE',
+                        help="Keep the Elink and Wikipedia responses in the SQLite file FILE, for later runs.")
+    parser.add_argument('--cachesize', metavar='MB', type=int, default=1024,
+                        help="Size limit of the response cache. Defaults to 1024MB.")
+    parser.add_argument('--offline', action='store_true',
+                        help="Replay the responses stored in the cache, without touching the network.")
+    parser.add_argument('--apikey', metavar='KEY',
+                        help="NCBI API key, which raises the allowed E-Utilities request rate from 3 to 10 per second.")
+    parser.add_argument('--timeout', metavar='SECONDS', type=float, default=60.0,
+                        help="Seconds to wait for a response, once connected. Defaults to 60.")
+    parser.add_argument('--connecttimeout', metavar='SECONDS', type=float, default=10.0,
+                        help="Seconds to wait for a connection. Defaults to 10.")
+    parser.add_argument('--elinkbatch', metavar='N', type=int, default=200,
+                        help="Number of taxa per Elink request. Defaults to 200.")
+    parser.add_argument('--titlememo', metavar='FILE',
+                        help="Keep the resolved Wikipedia titles in the shelve file FILE, for later runs.")
+    parser.add_argument('--workers', metavar='N', type=int, default=4,
+                        help="Number of batches of taxa handled concurrently. Defaults to 4.")
+    parser.add_argument('--batchsize', metavar='N', type=int, default=100,
+                        help="Number of objects written to FluidInfo per request. Defaults to 100.")
+    parser.add_argument('--snapshot', metavar='FILE',
+                        help="Iterate over the taxa of the snapshot FILE written by PopulateTaxa.py --snapshot, instead of querying FluidInfo for them.")
+    parser.add_argument('--metrics', metavar='FILE',
+                        help="Write snapshots of the timers and counters to FILE, in Prometheus text format if it ends with '.prom', JSON otherwise.")
+    parser.add_argument('--metricsinterval', metavar='SECONDS', type=float, default=10.0,
+                        help="Seconds between progress reports and metrics snapshots. Defaults to 10.")
+    args = parser.parse_args()
+
+    HttpTransport.Install(timeout=args.timeout, connecttimeout=args.connecttimeout)
+    RequestScheduler.Install(apikey=args.apikey, timeout=args.timeout)
+    if args.cache:
+        HttpCache.Install(args.cache, maxbytes=args.cachesize*1024*1024, offline=args.offline)
+    elif args.offline:
+        parser.error("--offline requires --cache")
+
     #############################
     # Bind to FluidInfo instance
     fileCredentials = open(os.path.expanduser('~/.fluidDBcredentials'), 'r')
@@ -143,6 +511,7 @@ if __name__ == "__main__":
     fdb = Fluid()  # The main instance
     fdb.login(username, password)
     fdb.bind()
+    HttpTransport.BindFluid(fdb)
     nsRoot = Namespace(username)
     
     sUserNS = nsRoot.path     
@@ -176,37 +545,32 @@ if __name__ == "__main__":
     ##########################################
     # Query NCBI-Taxonomy objects in FluidInfo
 
-    oTaxa = NcbiTaxon.filter(u'has '+ NcbiTaxon.__dict__['TaxId'].tagpath)
+    if args.snapshot:
+        # No requests at all, and the TaxId and about tag value of each taxon are at hand.
+        oTaxa = TaxonSnapshot(args.snapshot)
+        print "Read", len(oTaxa), "taxa from the snapshot", args.snapshot
+    else:
+        oTaxa = NcbiTaxon.filter(u'has '+ NcbiTaxon.__dict__['TaxId'].tagpath)
+        print "Found", len(oTaxa), "objects with a", NcbiTaxon.__dict__['TaxId'].tagpath, "tag:"
+    resolver = WikipediaTitleResolver(sMemoPath=args.titlememo)
+    providers = ProviderCache()
+    writer = BatchedValuesWriter(fdb, batchsize=args.batchsize, workers=args.workers,
+                                 oncommit=providers.OnCommit, onfailure=providers.OnFailure)
+    progress = Instrumentation.Progress(len(oTaxa))
+    reporter = Instrumentation.Reporter(progress, interval=args.metricsinterval, sPath=args.metrics).Start()
     
-    print "Found", len(oTaxa), "objects with a", NcbiTaxon.__dict__['TaxId'].tagpath, "tag:"
-    for oTaxon in oTaxa:
-        print "Taxon:", oTaxon.about
-        # Get LinkOut items. WARNING: Currently limited to iPhylo provider, for testing purposes.
-        elObjUrl = GetLinkOutData(oTaxon.TaxId).findall('ObjUrl')
-        print oTaxon.TaxId, "has", len(elObjUrl), "LinkOut entries."
+    def HandleBatch(lBatch):
+        HandleLinkOutBatch(lBatch, resolver, writer, providers)
+        progress.Advance(len(lBatch))
+    lFailures = RunWorkerPool(IterBatches(oTaxa, args.elinkbatch), HandleBatch, args.workers)
         
-        HandleIPhyloLinks(oTaxon, elObjUrl)
-        
-
-        
-#        for eObjUrl in elObjUrl:
-#            
-#            ##########################################
-#            # Create FluidInfoObject for the provider
-#            # using full provider name as about tag value
-#            oProv = LinkOutProvider(about=eObjUrl.find('Provider/Name').text.lower())
-#            oProv.Id = int(eObjUrl.find('Provider/Id').text)
-#            oProv.Name = unicode(eObjUrl.find('Provider/Name').text)
-#            oProv.NameAbbr = unicode(eObjUrl.find('Provider/NameAbbr').text)
-#            oProv.Url = unicode(eObjUrl.find('Provider/Url').text)
-#            oProv.save()
-#            print "Created/updated LinkOut provider data on about:",oProv.about," with uid:", oProv.uid
-#            
-#    # Put some usefull info on the description-tag of the namespace objects.
-#    Namespace(sUserNS+u'/taxonomy/ncbi/LinkOut')._set_description( u'NCBI LinkOut data.')
-#    Namespace(sUserNS+u'/taxonomy/ncbi/LinkOut/Provider')._set_description( u'LinkOut Provider data')
-    
-    
-    
-    
+    writer.Close()
+    resolver.Close()
+    reporter.Stop()
+    print "Written", writer.committed, "objects, including", len(providers.abouts), "LinkOut providers.", len(writer.failures), "failed."
+    print len(lFailures), "batches of taxa failed."
 
+    if providers.abouts:
+        # Put some usefull info on the description-tag of the namespace objects.
+        Namespace(sUserNS+u'/taxonomy/ncbi/LinkOut')._set_description( u'NCBI LinkOut data.')
+        Namespace(sUserNS+u'/taxonomy/ncbi/LinkOut/Provider')._set_description( u'LinkOut Provider data')
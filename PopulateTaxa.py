@@ -21,8 +21,13 @@ Currently it processes all the species of division primates, whose scientific na
 
 import sys
 import os.path
+import re
 import urllib
-import urllib2
+import argparse
+import threading
+import Queue
+import time
+from StringIO import StringIO
 
 try:
     from xml.etree import cElementTree as ElementTree
@@ -31,6 +36,17 @@ except ImportError, e:
     
 from fom.session import Fluid
 from fom.mapping import Namespace
+
+from TaxDump import iterTaxdump
+from FluidWriter import BatchedValuesWriter, DiffValuesWriter
+import HttpCache
+import HttpTransport
+import RequestScheduler
+import Instrumentation
+from ImportJournal import ImportJournal, HashTagging
+from NameRedirects import RedirectIndex
+from TaxonSnapshot import TaxonSnapshotWriter
+from ShardCoordinator import ShardCoordinator
     
 
 urlEutils = "http://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
@@ -55,7 +71,9 @@ def GetTaxonData(lTaxIds):
                              ,'mode'  : 'xml'
                              ,'id'    : ','.join([str(iTax) for iTax in lTaxIds]) })
     # print data
-    tree = ElementTree.parse(urllib2.urlopen(urlEfetch, data ))
+    fileXml = HttpCache.urlopen(urlEfetch, data )
+    with Instrumentation.Timer('xml_parse'):
+        tree = ElementTree.parse(fileXml)
     # tree.write(sys.stdout)
     # Beware to match only <Taxon> items at the
     # first level, but not the ones inside <LineageEx> !
@@ -64,6 +82,60 @@ def GetTaxonData(lTaxIds):
     return elTaxon
 
 
+def IterTaxaXml(fileXml, iExpected=None):
+    """
+        Incrementally parses an Efetch response and yields each top-level <Taxon>
+        ElementTree as soon as it is complete, instead of building the whole tree first.
+        
+        Memory usage stays flat regardless of the number of taxa in the response,
+        since each <Taxon> is cleared as soon as the next one is requested.
+        WARNING: So don't keep references to the yielded ElementTrees around!
+        
+        @param fileXml:   File-like object with the Efetch XML response.
+        @param iExpected: If given, the number of <Taxon> records the response must contain.
+    """
+    iDepth = 0
+    iFound = 0
+    eRoot = None
+    # Only the parsing is timed, neither what the caller does in between, nor the time
+    # spent waiting for the data of a response that is read while it arrives.
+    tStart = time.time()
+    fReadStart = getattr(fileXml, 'readseconds', 0.0)
+    for (event, elem) in ElementTree.iterparse(fileXml, events=('start', 'end')):
+        if event == 'start':
+            if eRoot is None:
+                eRoot = elem
+            iDepth += 1
+        else:
+            iDepth -= 1
+            # Beware to match only <Taxon> items at the
+            # first level, but not the ones inside <LineageEx> !
+            if iDepth == 1 and elem.tag == 'Taxon':
+                iFound += 1
+                Instrumentation.AddTime('xml_parse', time.time() - tStart - (getattr(fileXml, 'readseconds', 0.0) - fReadStart))
+                yield elem
+                elem.clear()
+                eRoot.clear()
+                tStart = time.time()
+                fReadStart = getattr(fileXml, 'readseconds', 0.0)
+    if iExpected is not None:
+        assert(iFound == iExpected)
+
+
+def IterTaxonData(lTaxIds):
+    """
+        Streaming variant of GetTaxonData():
+        Given a list of NCBI-Taxonomy-IDs, it uses Efetch to get their Taxon data
+        in a single request, but yields the <Taxon> ElementTrees one by one while
+        the response is being parsed. See IterTaxaXml().
+    """
+    data = urllib.urlencode({ 'db'    : 'taxonomy'
+                             ,'mode'  : 'xml'
+                             ,'id'    : ','.join([str(iTax) for iTax in lTaxIds]) })
+    # Decompressed and parsed while it arrives.
+    return IterTaxaXml(HttpCache.urlopen(urlEfetch, data, stream=True), len(lTaxIds))
+
+
 
 class iterTaxa:
     """Forward iterator for Taxonomy query results.
@@ -89,13 +161,20 @@ class iterTaxa:
                                 http://www.ncbi.nlm.nih.gov/books/NBK3837/#EntrezHelp.Indexed_Fields_Query_Translat
                             
         @param chunksize:   Number of results per API-query. Defaults to 20. Those are cached and iterated one by one
+        
+        @param streaming:   If True, the Efetch responses are parsed incrementally with IterTaxaXml(),
+                            so that memory usage doesn't grow with the chunksize.
+                            Beware that each returned Taxon is then only valid until the next one is requested.
+                            Defaults to False.
     """
-    def __init__(self, term, chunksize=20):
+    def __init__(self, term, chunksize=20, streaming=False):
         self.term = term
         self.chunksize = chunksize
+        self.streaming = streaming
         self.start = 0
         self.count = 0
-        self.cache = []
+        # Iterator over the Taxa of the current chunk
+        self.cache = iter(())
         
     def GetNextChunk(self):
         """
@@ -106,7 +185,9 @@ class iterTaxa:
                                  ,'retstart': self.start
                                  ,'retmax'  : self.chunksize  })
         #print "Debug: ", data
-        tree = ElementTree.parse(urllib2.urlopen(urlEsearch, data ))
+        fileXml = HttpCache.urlopen(urlEsearch, data )
+        with Instrumentation.Timer('xml_parse'):
+            tree = ElementTree.parse(fileXml)
         #tree.write(sys.stdout)
         
         # Extract the TaxId values
@@ -114,7 +195,10 @@ class iterTaxa:
         # If we got any TaxIds, then we'll Efetch the corresponding Taxon data
         # in a chunk as big as the one returned by Esearch.
         if len(lTaxIds):
-            self.cache = GetTaxonData(lTaxIds)
+            if self.streaming:
+                self.cache = IterTaxonData(lTaxIds)
+            else:
+                self.cache = iter(GetTaxonData(lTaxIds))
             self.count = int(tree.find("Count").text)
         
         
@@ -123,134 +207,510 @@ class iterTaxa:
             Get the next Taxon that matches the query.
             Returns None if there are no matches left.
         """
-        if (len(self.cache)==0):
+        xmlTaxonData = next(self.cache, None)
+        if xmlTaxonData is None:
+            self.cache = iter(())
             self.GetNextChunk()
+            xmlTaxonData = next(self.cache, None)
                 
-        if (len(self.cache)):
+        if xmlTaxonData is not None:
             self.start += 1
-            return self.cache.pop(0)
-        else:
-            return None
+        return xmlTaxonData
         
-    def GetFirst(self):
+    def GetFirst(self, iStart=0):
         """
             Get the first Taxon that matches the query.
             Returns None if query didn't match or succeed.
+            
+            @param iStart: Start at that position of the results instead, e.g. to resume an interrupted import.
         """
-        self.start = 0
-        del self.cache[:]
+        self.start = iStart
+        self.cache = iter(())
         return self.GetNext()
 
 
 
-            
-def ImportTaxonAttribute(dictTagging, xmlTaxonData, sAttrName, typecast=unicode, aslist=False, sTagName=None ):
-    """
-        Does the actual transfer of values from the XML into FluidInfo tags.
-        It actually doesn't tag yet, but it transfers the data into a dict(), which will later be used to do the taggin in a single API request.
+class iterTaxaPrefetch(iterTaxa):
+    """Forward iterator for Taxonomy query results, with background prefetching.
+    
+       Same interface as iterTaxa, but the query is run only once, storing its results
+       on the Entrez history server (usehistory=y). Then Efetch pages through those
+       results by WebEnv/query_key, instead of re-running Esearch for every chunk.
+       
+       A background thread keeps up to "prefetch" chunks ready in a bounded queue, so
+       that the network round trips overlap with the importing of the current chunk.
+       The chunks are queued as raw XML and only parsed when their turn comes.
+       
+       The count of query results is available as soon as GetFirst() returns.
+    
+       Documentation of the history server:
+           http://www.ncbi.nlm.nih.gov/books/NBK25499/#chapter4.Using_the_Entrez_History_Server
+
+        @param term:        Query term using Entrez syntax operating on NCBI-Taxonomy database.
+                            See iterTaxa.
+                                
+        @param chunksize:   Number of results per Efetch request. Defaults to 500.
         
-        @note It prepends the tag-path in sUserNS to the tags to be imported. sUserNS is currently just the user-namespace.
+        @param prefetch:    Maximum number of chunks fetched ahead of the one being iterated. Defaults to 4.
         
-        @param dictTagging: [out] The dict containing the tag paths and values that will later be committed into FluidInfo.
-                            It has the structure required by the "PUT VALUES" API of FluidInfo as documented here:
-                                http://api.fluidinfo.com/html/api.html#values_PUT
-                            Example:
-                                dict[<tagpath>]={u'value': <tagvalue>}
-
-        @param xmlTaxonData: An ElementTree containing the <Taxon> XML branch sent by NCBI.
-                             See example XML: eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=taxonomy&id=9913&mode=xml
-
-        @param sAttrName: String with XPath to the item that should be transferred. 
-                          Root is at <Taxon>. 
-                          e.g. To get the TaxId use sAttrName="TaxId"
-                          
-        @param typecast: Python data type for the XML string to be casted to.
-                         Defaults to unicode.
-                         e.g. typecast=int
-                         
-        @param aslist: Boolean. 
-                       If False (the default), then sAttrName should yield only a single XML item that will be treated as a scalar.
-                       If True, then all the items referred by sAttrName will be assembled into a list/set.
-
-        @param sTagName: The FluidInfo tag path  (relative to the prefix sUserNS).
-                         Defaults to the XPath given in sAttrName.
-                          
+        @param streaming:   See iterTaxa.
     """
-    
-    elAttr = xmlTaxonData.findall(sAttrName)
-
-    # Relative tag-path defaults to XPath
-    if (sTagName is None):
-        sTagName = sAttrName
+    def __init__(self, term, chunksize=500, prefetch=4, streaming=False):
+        iterTaxa.__init__(self, term, chunksize, streaming)
+        self.prefetch = prefetch
+        self.webenv = None
+        self.querykey = None
+        self.queue = None
+        self.thread = None
+        self.stopping = threading.Event()
         
-    TagValue = None
+    def RunQuery(self):
+        """
+            Run the Esearch query once, storing the results on the history server.
+        """
+        data = urllib.urlencode({ 'db'        : 'taxonomy'
+                                 ,'term'      : self.term
+                                 ,'usehistory': 'y'
+                                 ,'retmax'    : 0  })
+        fileXml = HttpCache.urlopen(urlEsearch, data )
+        with Instrumentation.Timer('xml_parse'):
+            tree = ElementTree.parse(fileXml)
+        self.count = int(tree.find("Count").text)
+        self.webenv = tree.find("WebEnv").text
+        self.querykey = tree.find("QueryKey").text
         
-    if aslist:
-        TagValue = [typecast(item.text.strip()) for item in elAttr]
-        if len(TagValue)==0:
-            TagValue = None
-    else:
-        assert( len(elAttr)<2 )
-        if len(elAttr)==1:
-            TagValue = typecast(elAttr[0].text)
+    def FetchChunk(self, iStart):
+        """
+            Efetch the Taxon data of the query results starting at retstart=iStart.
+            Returns the raw XML response.
+        """
+        data = urllib.urlencode({ 'db'        : 'taxonomy'
+                                 ,'mode'      : 'xml'
+                                 ,'WebEnv'    : self.webenv
+                                 ,'query_key' : self.querykey
+                                 ,'retstart'  : iStart
+                                 ,'retmax'    : self.chunksize  })
+        # Cached by the query term rather than by the WebEnv, which is new with every run.
+        keydata = urllib.urlencode({ 'db'        : 'taxonomy'
+                                    ,'mode'      : 'xml'
+                                    ,'term'      : self.term
+                                    ,'retstart'  : iStart
+                                    ,'retmax'    : self.chunksize  })
+        return HttpCache.urlopen(urlEfetch, data, keydata=keydata ).read()
+        
+    def QueuePut(self, item):
+        """
+            Blocking put into the bounded queue, that gives up if the iterator is being stopped.
+            Returns False if it gave up.
+        """
+        while not self.stopping.is_set():
+            try:
+                self.queue.put(item, timeout=0.5)
+                return True
+            except Queue.Full:
+                pass
+        return False
+        
+    def Prefetcher(self, iStart):
+        """
+            Body of the background thread: Fetches the chunks one after the other into the queue.
+            Any exception is handed over through the queue, to be raised by GetNextChunk().
+            A None item marks the end of the results.
+        """
+        try:
+            for iChunkStart in xrange(iStart, self.count, self.chunksize):
+                if not self.QueuePut((iChunkStart, self.FetchChunk(iChunkStart))):
+                    return
+        except Exception, e:
+            self.QueuePut(e)
+            return
+        self.QueuePut(None)
+        
+    def Stop(self):
+        """
+            Stop the background thread, if any, discarding the prefetched chunks.
+        """
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+        self.stopping.clear()
+        self.queue = None
+        
+    def GetNextChunk(self):
+        """
+            Take the next chunk out of the prefetch queue, waiting for it if necessary.
+        """
+        if self.queue is None:
+            return
+        # Time spent waiting here means the prefetching can't keep up with the network.
+        with Instrumentation.Timer('prefetch_wait'):
+            item = self.queue.get()
+        if item is None:
+            # End of results. Let the background thread finish.
+            self.Stop()
+        elif isinstance(item, Exception):
+            self.Stop()
+            raise item
+        else:
+            (iChunkStart, sXml) = item
+            iExpected = min(self.chunksize, self.count - iChunkStart)
+            if self.streaming:
+                self.cache = IterTaxaXml(StringIO(sXml), iExpected)
+            else:
+                # Beware to match only <Taxon> items at the
+                # first level, but not the ones inside <LineageEx> !
+                with Instrumentation.Timer('xml_parse'):
+                    elTaxon = ElementTree.fromstring(sXml).findall('Taxon')
+                assert(len(elTaxon) == iExpected)
+                self.cache = iter(elTaxon)
+        
+    def GetFirst(self, iStart=0):
+        """
+            Run the query and get the first Taxon that matches it.
+            Returns None if query didn't match or succeed.
+            
+            @param iStart: Start at that position of the results instead, e.g. to resume an interrupted import.
+        """
+        self.Stop()
+        self.start = iStart
+        self.cache = iter(())
+        self.RunQuery()
+        if self.count > iStart:
+            self.queue = Queue.Queue(maxsize=self.prefetch)
+            self.thread = threading.Thread(target=self.Prefetcher, args=(iStart,))
+            # Don't keep the process alive just because of the prefetching
+            self.thread.daemon = True
+            self.thread.start()
+        return self.GetNext()
+
+
+
+            
+###################################
+# Declarative map of the tags imported from each <Taxon> record:
+#   (XPath relative to <Taxon>, typecast, aslist, tag name relative to ./taxonomy/ncbi)
+#   - typecast: Python data type for the XML string to be casted to, e.g. int
+#   - aslist:   If False, the XPath yields at most a single XML item, treated as a scalar.
+#               If True, all the items it yields are assembled into a list/set.
+# Adding fields here doesn't add any scans of the records, see TaxonExtractor.
+lTaxonFields = [ ("ScientificName",                 unicode, False, u"ScientificName")
+                ,("TaxId",                          int,     False, u"TaxId")
+                ,("ParentTaxId",                    int,     False, u"ParentTaxId")
+                ,("Rank",                           unicode, False, u"Rank")
+                ,("Division",                       unicode, False, u"Division")
+                ,("OtherNames/GenbankCommonName",   unicode, False, u"GenbankCommonName")
+                ,("OtherNames/Synonym",             unicode, True,  u"Synonyms")
+                ,("OtherNames/CommonName",          unicode, True,  u"CommonNames")
+                ,("LineageEx/Taxon/ScientificName", unicode, True,  u"Lineage")
+                # NOTE: FluidInfo only implements "sets of strings", there's not support for "sets of integers"!
+                #       Therefore we have to import the following as unicode!
+                ,("LineageEx/Taxon/TaxId",          unicode, True,  u"LineageIds") ]
+
+# Fields derived from the TaxonomyTree instead, when ImportTaxon() is given one.
+lLineageFields = [u"Lineage", u"LineageIds"]
+
+# Fields holding the other names of a taxon, which get redirect objects. See NameRedirects.py
+lRedirectFields = [u"GenbankCommonName", u"Synonyms", u"CommonNames"]
+
+# WARNING: For the time being, we'll discard any unusual taxa with digits in their scientific names.
+reWeirdName = re.compile(u'[0-9:]')
+
+
+class TaxonExtractor:
+    """Single-pass extractor of the tagging of <Taxon> records, compiled from a field map.
     
-    # Do NOT tag if not XML-item was found!
-    # We want to avoid empty-valued tags, since those would ruin FluidInfo queries with "has" operator.
-    if TagValue is not None:
-        # Generate the dict-in-dict structure required for the
-        # "values" parameter of fdb.values.put():
-        #      dict[tagpath]={'values', tagvalue}
-        dictTagging[sUserNS+u"/taxonomy/ncbi/"+sTagName] = {u'value': TagValue}
+       The XPaths of all the fields are merged into a tree of element tags, so that each
+       record is walked only once, descending only into the branches holding any fields.
+       All tag paths are assembled once, on construction, and are available as
+       self.tagpaths[<tag name>]
+       
+        @param lFields:     Field map like lTaxonFields. Only simple paths of element tags are supported.
+        
+        @param sNamespace:  Namespace the tag names are relative to, e.g. sUserNS+u"/taxonomy/ncbi"
         
+        @param skip:        Tag names of the field map not to extract. Their tag paths are still assembled.
+    """
+    def __init__(self, lFields, sNamespace, skip=()):
+        self.tagpaths = dict()
+        self.root = dict()
+        for (sXPath, typecast, aslist, sTagName) in lFields:
+            sTagPath = sNamespace + u"/" + sTagName
+            self.tagpaths[sTagName] = sTagPath
+            if sTagName in skip:
+                continue
+            lSteps = sXPath.split('/')
+            node = self.root
+            for sStep in lSteps[:-1]:
+                node = node.setdefault(sStep, dict())
+                # A field can't be both a value and the parent of other fields.
+                assert(isinstance(node, dict))
+            assert(lSteps[-1] not in node)
+            node[lSteps[-1]] = (sTagPath, typecast, aslist)
+            
+    def Walk(self, eParent, node, dictTagging):
+        for eChild in eParent:
+            entry = node.get(eChild.tag)
+            if entry is None:
+                continue
+            if isinstance(entry, dict):
+                self.Walk(eChild, entry, dictTagging)
+                continue
+            (sTagPath, typecast, aslist) = entry
+            if aslist:
+                dictValue = dictTagging.get(sTagPath)
+                if dictValue is None:
+                    dictValue = dictTagging[sTagPath] = {u'value': []}
+                dictValue[u'value'].append(typecast(eChild.text.strip()))
+            else:
+                assert(sTagPath not in dictTagging)
+                dictTagging[sTagPath] = {u'value': typecast(eChild.text)}
+                
+    def Extract(self, xmlTaxonData):
+        """
+            Returns the tagging of a <Taxon> ElementTree, with the structure required by the "PUT VALUES" API:
+                dict[<tagpath>]={u'value': <tagvalue>}
+            Fields without any XML items aren't tagged at all, since empty-valued tags
+            would ruin FluidInfo queries with the "has" operator.
+        """
+        dictTagging = dict()
+        self.Walk(xmlTaxonData, self.root, dictTagging)
+        return dictTagging
+
+
+# Compiled TaxonExtractors, by namespace and whether they extract the lineage.
+dictExtractors = dict()
+
+def GetTaxonExtractor(bLineage=True):
+    """
+        Returns the TaxonExtractor of lTaxonFields for the current sUserNS, compiling it on first use.
         
-def containsAny(str, set):
-    """Check whether 'str' contains ANY of the chars in 'set'"""
-    return 1 in [c in str for c in set]
+        @param bLineage: Whether to extract the lLineageFields from the <LineageEx> items.
+    """
+    key = (sUserNS, bLineage)
+    extractor = dictExtractors.get(key)
+    if extractor is None:
+        extractor = TaxonExtractor(lTaxonFields, sUserNS + u"/taxonomy/ncbi", () if bLineage else lLineageFields)
+        dictExtractors[key] = extractor
+    return extractor
     
-def ImportTaxon(xmlTaxonData):
+def ImportTaxon(xmlTaxonData, writer=None, journal=None, tree=None, redirects=None, snapshot=None):
     """
         Imports a "NCBI Taxonomy" record from a XML <Taxon> tree into FluidInfo.
         
         Warning: Heavy work in progress!
+        
+        @param writer: Optional BatchedValuesWriter to queue the tagging into.
+                       If None, the tagging is written right away with its own request.
+                       
+        @param journal: Optional ImportJournal. Taxa already committed since its last checkpoint,
+                        or whose tagging hasn't changed since it was last written, are skipped.
+                        Otherwise the written tagging gets a "timestamp-lastupdate" tag.
+                        When used together with a writer, the writer must have been created
+                        with oncommit=CommitToJournal(journal)
+                        
+        @param tree: Optional TaxonomyTree to derive the Lineage and LineageIds tags from,
+                     instead of the <LineageEx> items of the XML.
+                     
+        @param redirects: Optional RedirectIndex to add the other names of the taxon to.
+                          The redirect objects are only written once all taxa are in.
+                          
+        @param snapshot: Optional TaxonSnapshotWriter to add the taxon to.
     """
 
     assert( xmlTaxonData is not None)
     
-    ScientificName = unicode(xmlTaxonData.find("ScientificName").text)
-
-    dictTagging = dict()
+    # All the tags in a single walk over the record. See lTaxonFields.
+    with Instrumentation.Timer('extract'):
+        extractor = GetTaxonExtractor(bLineage=(tree is None))
+        dictTagging = extractor.Extract(xmlTaxonData)
+        iTaxId = dictTagging[extractor.tagpaths[u"TaxId"]][u'value']
+        if tree is not None:
+            lLineage = tree.GetLineage(iTaxId)
+            if len(lLineage):
+                dictTagging[extractor.tagpaths[u"Lineage"]] = {u'value': tree.GetLineageNames(iTaxId)}
+                # NOTE: FluidInfo only implements "sets of strings", there's not support for "sets of integers"!
+                dictTagging[extractor.tagpaths[u"LineageIds"]] = {u'value': [unicode(iAncestor) for iAncestor in lLineage]}
+    
+    ScientificName = dictTagging[extractor.tagpaths[u"ScientificName"]][u'value']
     
     # WARNING: For the time being, we'll discard any unusual taxa with digits in their scientific names.
-    if containsAny(ScientificName, '0123456789:'):
+    if reWeirdName.search(ScientificName):
         print "Not importing weird taxon:", ScientificName
+        Instrumentation.Count('taxa_skipped')
         return
 
     # Assign about tag value. Lowercase!
     sAbout = ScientificName.lower()
 
-    ImportTaxonAttribute(dictTagging, xmlTaxonData, "ScientificName", typecast=unicode)
-    ImportTaxonAttribute(dictTagging, xmlTaxonData, "TaxId", typecast=int)
-    ImportTaxonAttribute(dictTagging, xmlTaxonData, "ParentTaxId", typecast=int)
-    ImportTaxonAttribute(dictTagging, xmlTaxonData, "Rank", typecast=unicode)
-    ImportTaxonAttribute(dictTagging, xmlTaxonData, "Division", typecast=unicode)
-    ImportTaxonAttribute(dictTagging, xmlTaxonData, "OtherNames/GenbankCommonName", typecast=unicode, sTagName=u"GenbankCommonName")
-    
-    ImportTaxonAttribute(dictTagging, xmlTaxonData, "OtherNames/Synonym", typecast=unicode, aslist=True, sTagName=u"Synonyms")
-    ImportTaxonAttribute(dictTagging, xmlTaxonData, "OtherNames/CommonName", typecast=unicode, aslist=True, sTagName=u"CommonNames")
-    
-    ImportTaxonAttribute(dictTagging, xmlTaxonData, "LineageEx/Taxon/ScientificName", typecast=unicode, aslist=True, sTagName=u"Lineage")
-    # NOTE: FluidInfo only implements "sets of strings", there's not support for "sets of integers"!
-    #       Therefore we have to import the following as unicode!
-    ImportTaxonAttribute(dictTagging, xmlTaxonData, "LineageEx/Taxon/TaxId", typecast=unicode, aslist=True, sTagName=u"LineageIds")
-    
- 
+    if redirects is not None:
+        # Even for the taxa skipped below, in case the index is newer than the journal.
+        lNames = []
+        for sTagName in lRedirectFields:
+            dictValue = dictTagging.get(extractor.tagpaths[sTagName])
+            if dictValue is None:
+                continue
+            if isinstance(dictValue[u'value'], list):
+                lNames.extend(dictValue[u'value'])
+            else:
+                lNames.append(dictValue[u'value'])
+        # Merges into the on-disk index every now and then.
+        with Instrumentation.Timer('redirect_index'):
+            redirects.Add(sAbout, lNames)
+
+    if snapshot is not None:
+        # Even for the taxa skipped below, which are in FluidInfo all the same.
+        dictRank = dictTagging.get(extractor.tagpaths[u"Rank"])
+        dictDivision = dictTagging.get(extractor.tagpaths[u"Division"])
+        dictParent = dictTagging.get(extractor.tagpaths[u"ParentTaxId"])
+        snapshot.Add(iTaxId, dictParent[u'value'] if dictParent else 0,
+                     dictRank[u'value'] if dictRank else None, dictDivision[u'value'] if dictDivision else None,
+                     sAbout, ScientificName)
+
+    if journal is not None:
+        with Instrumentation.Timer('journal'):
+            bCommitted = journal.IsCommitted(iTaxId)
+            if not bCommitted:
+                # Hash before adding the timestamp, which changes every time!
+                sHash = HashTagging(dictTagging)
+                bUnchanged = journal.IsUnchanged(iTaxId, sHash)
+        if bCommitted:
+            Instrumentation.Count('taxa_skipped')
+            return
+        if bUnchanged:
+            journal.unchanged += 1
+            Instrumentation.Count('taxa_unchanged')
+            return
+        dictTagging[sUserNS+u'/taxonomy/ncbi/timestamp-lastupdate'] = {u'value': unicode(time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()))}
+
+    Instrumentation.Count('taxa_imported')
 
     ##################################
     # Create and do all the tagging in
     # a single call to the FluidInfo-API!
-    fdb.values.put( query='fluiddb/about = "'+sAbout+'"',values=dictTagging)
+    # ... or even batched together with many other taxa.
+    if writer is not None:
+        writer.Put(sAbout, dictTagging, (iTaxId, sHash) if journal is not None else None)
+    else:
+        with Instrumentation.Timer('fluidinfo_write'):
+            fdb.values.put( query='fluiddb/about = "'+sAbout+'"',values=dictTagging)
+        Instrumentation.Count('fluidinfo_objects')
+        if journal is not None:
+            journal.Committed(iTaxId, sHash)
     
-    print "Imported TaxId:", dictTagging[sUserNS+u'/taxonomy/ncbi/TaxId'][u'value'], " as about:",sAbout # , " with uid:", oTaxon.uid
+    print "Imported TaxId:", iTaxId, " as about:",sAbout # , " with uid:", oTaxon.uid
+
+
+def GetResultCount(sTerm):
+    """
+        Returns the number of results of an Esearch query on the NCBI-Taxonomy database.
+    """
+    data = urllib.urlencode({ 'db'      : 'taxonomy'
+                             ,'term'    : sTerm
+                             ,'retmax'  : 0  })
+    fileXml = HttpCache.urlopen(urlEsearch, data )
+    with Instrumentation.Timer('xml_parse'):
+        tree = ElementTree.parse(fileXml)
+    return int(tree.find("Count").text)
+
+
+class ShardImporter:
+    """Imports the shards handed out by a ShardCoordinator, inside one of its worker processes.
+    
+       Each process pages through its shards with its own iterTaxa, honoring --chunksize and
+       --streaming, and writes with its own BatchedValuesWriter.
+       The allowed request rates are split evenly among the processes.
+       
+        @param args: The parsed command line options.
+    """
+    def __init__(self, args):
+        self.chunksize = args.chunksize or 100
+        self.streaming = args.streaming
+        # Not the connections inherited from the coordinator.
+        HttpTransport.Install(timeout=args.timeout, connecttimeout=args.connecttimeout)
+        RequestScheduler.Install(apikey=args.apikey, timeout=args.timeout, ratefactor=1.0/args.processes)
+        if args.cache:
+            # The SQLite connection inherited from the coordinator can't be used across processes.
+            HttpCache.Install(args.cache, maxbytes=args.cachesize*1024*1024, offline=args.offline)
+        self.writer = MakeTaxonWriter(args)
+        
+    def Run(self, sTerm, iStart, cursor):
+        itTaxa = iterTaxa(term=sTerm, chunksize=self.chunksize, streaming=self.streaming)
+        xmlTaxonData = itTaxa.GetFirst(iStart)
+        while (xmlTaxonData is not None) and cursor.Claim():
+            ImportTaxon(xmlTaxonData, self.writer)
+            xmlTaxonData = itTaxa.GetNext()
+        self.writer.Flush()
+        
+    def Finish(self):
+        self.writer.Close()
+        return (self.writer.committed, [(sAbout, repr(e)) for (sAbout, e) in self.writer.failures])
+
+
+def ImportSharded(args, lTerms):
+    """
+        Imports the results of the given Esearch terms with a pool of args.processes
+        worker processes. See ShardCoordinator.py
+        Returns the number of results handled.
+    """
+    iChunkSize = args.chunksize or 100
+    coordinator = ShardCoordinator(lambda: ShardImporter(args), args.processes, minsplit=iChunkSize)
+    lCounts = [GetResultCount(sTerm) for sTerm in lTerms]
+    iTotal = sum(lCounts)
+    print "Total number of results: ", iTotal
+    # Just a couple of shards per process up front, the rebalancing takes care of the rest.
+    iShardSize = max(iChunkSize, iTotal/(2*args.processes) + 1)
+    for (sTerm, iCount) in zip(lTerms, lCounts):
+        print "Sharding", iCount, "results of:", sTerm
+        coordinator.AddTerm(sTerm, iCount, iShardSize)
+        
+    # Fork before starting the reporter thread.
+    coordinator.Start()
+    progress = Instrumentation.Progress(iTotal)
+    reporter = Instrumentation.Reporter(progress, interval=args.metricsinterval, sPath=args.metrics).Start()
+    (iWritten, lFailures) = coordinator.Run(progress)
+    reporter.Stop()
+    
+    print "Written", iWritten, "taxa by", args.processes, "processes.", len(lFailures), "failed:"
+    for (sAbout, sError) in lFailures:
+        print "   ", sAbout, sError
+    print coordinator.splits, "shards were split for rebalancing.", len(coordinator.failures), "shards failed:"
+    for (sTerm, iStart, iStop, sError) in coordinator.failures:
+        print "    Positions", iStart, "to", iStop, "of:", sTerm, sError
+    if args.sync:
+        # The workers' counts, as merged into the metrics, including their final ones.
+        dictCounters = Instrumentation.metrics.Snapshot()['counters']
+        print "Tags added:", dictCounters.get('sync_tags_added', 0), " changed:", dictCounters.get('sync_tags_changed', 0), \
+              " unchanged:", dictCounters.get('sync_tags_unchanged', 0), " Taxa up to date:", dictCounters.get('sync_objects_unchanged', 0)
+    return progress.done
+
+
+def MakeTaxonWriter(args, oncommit=None):
+    """
+        Returns the writer for the taggings of ImportTaxon(), as chosen by the command line options:
+        With --sync a DiffValuesWriter that compares the tags of lTaxonFields with the current ones,
+        otherwise a BatchedValuesWriter.
+    """
+    if args.sync:
+        # The timestamp of the journal changes every time, so it's only written along with actual changes.
+        return DiffValuesWriter(fdb, GetTaxonExtractor().tagpaths.values(),
+                                volatile=[sUserNS+u'/taxonomy/ncbi/timestamp-lastupdate'],
+                                batchsize=args.batchsize, workers=args.writers, flushinterval=args.flushinterval,
+                                oncommit=oncommit)
+    return BatchedValuesWriter(fdb, batchsize=args.batchsize, workers=args.writers, flushinterval=args.flushinterval,
+                               oncommit=oncommit)
+
+
+def CommitToJournal(journal):
+    """
+        Returns the oncommit callback for a BatchedValuesWriter, that records
+        the taxa queued by ImportTaxon() as committed into the given ImportJournal.
+    """
+    def OnCommit(sAbout, context):
+        if context is not None:
+            (iTaxId, sHash) = context
+            journal.Committed(iTaxId, sHash)
+    return OnCommit
 
     
 
@@ -258,6 +718,75 @@ def ImportTaxon(xmlTaxonData):
     
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description="Imports NCBI Taxonomy data into FluidInfo.")
+    parser.add_argument('--taxdump', metavar='DIR',
+                        help="Read the taxa from the unpacked NCBI taxdump files in DIR, instead of querying Esearch/Efetch.")
+    parser.add_argument('--subtree', metavar='TAXID', type=int,
+                        help="Import the species below the taxon TAXID, instead of the primate species. e.g. 9443 for the Primates")
+    parser.add_argument('--prefetch', metavar='N', type=int, default=0,
+                        help="Page through the Esearch results on the Entrez history server, prefetching up to N chunks in the background.")
+    parser.add_argument('--chunksize', metavar='N', type=int,
+                        help="Number of taxa per Efetch request.")
+    parser.add_argument('--streaming', action='store_true',
+                        help="Parse the Efetch responses incrementally, keeping memory usage flat regardless of the chunksize.")
+    parser.add_argument('--batchsize', metavar='N', type=int, default=100,
+                        help="Number of taxa written to FluidInfo per request. Defaults to 100.")
+    parser.add_argument('--writers', metavar='N', type=int, default=4,
+                        help="Number of concurrent FluidInfo write requests. Defaults to 4.")
+    parser.add_argument('--flushinterval', metavar='SECONDS', type=float, default=5.0,
+                        help="Write partial batches once they're older than this. Defaults to 5 seconds.")
+    parser.add_argument('--cache', metavar='FILE',
+                        help="Keep the E-Utilities responses in the SQLite file FILE, for later runs.")
+    parser.add_argument('--cachesize', metavar='MB', type=int, default=1024,
+                        help="Size limit of the response cache. Defaults to 1024MB.")
+    parser.add_argument('--offline', action='store_true',
+                        help="Replay the responses stored in the cache, without touching the network.")
+    parser.add_argument('--apikey', metavar='KEY',
+                        help="NCBI API key, which raises the allowed E-Utilities request rate from 3 to 10 per second.")
+    parser.add_argument('--timeout', metavar='SECONDS', type=float, default=60.0,
+                        help="Seconds to wait for a response, once connected. Defaults to 60.")
+    parser.add_argument('--connecttimeout', metavar='SECONDS', type=float, default=10.0,
+                        help="Seconds to wait for a connection. Defaults to 10.")
+    parser.add_argument('--journal', metavar='FILE',
+                        help="Keep a checkpoint journal and an index of the written taxa in the SQLite file FILE. Unchanged taxa are skipped.")
+    parser.add_argument('--resume', action='store_true',
+                        help="Continue the interrupted import recorded in the journal.")
+    parser.add_argument('--checkpoint', metavar='N', type=int, default=1000,
+                        help="Record a checkpoint in the journal every N taxa. Defaults to 1000.")
+    parser.add_argument('--metrics', metavar='FILE',
+                        help="Write snapshots of the timers and counters to FILE, in Prometheus text format if it ends with '.prom', JSON otherwise.")
+    parser.add_argument('--metricsinterval', metavar='SECONDS', type=float, default=10.0,
+                        help="Seconds between progress reports and metrics snapshots. Defaults to 10.")
+    parser.add_argument('--redirects', metavar='FILE',
+                        help="Create redirect objects for the synonyms and common names, deduplicated through the index in FILE.")
+    parser.add_argument('--redirectbatch', metavar='N', type=int, default=1000,
+                        help="Number of redirect objects written to FluidInfo per request. Defaults to 1000.")
+    parser.add_argument('--snapshot', metavar='FILE',
+                        help="Also write a local snapshot of the imported taxa to FILE, for PopulateLinkOut.py --snapshot")
+    parser.add_argument('--sync', action='store_true',
+                        help="Read the current tags of each batch of taxa first, and only write the tags that changed.")
+    parser.add_argument('--processes', metavar='N', type=int, default=1,
+                        help="Import with a pool of N worker processes, each importing shards of the Esearch results.")
+    parser.add_argument('--divisions', metavar='CODES',
+                        help="With --processes, import the species of these comma-separated divisions instead of the primates. e.g. PRI,MAM,ROD")
+    args = parser.parse_args()
+
+    HttpTransport.Install(timeout=args.timeout, connecttimeout=args.connecttimeout)
+    RequestScheduler.Install(apikey=args.apikey, timeout=args.timeout)
+    if args.cache:
+        HttpCache.Install(args.cache, maxbytes=args.cachesize*1024*1024, offline=args.offline)
+    elif args.offline:
+        parser.error("--offline requires --cache")
+    if args.resume and not args.journal:
+        parser.error("--resume requires --journal")
+    if (args.processes > 1) and (args.taxdump or args.journal or args.redirects or args.snapshot or args.prefetch):
+        # Prefetching would run ahead past the end of the shards, which the coordinator moves while they're imported.
+        parser.error("--processes can't be combined with --taxdump, --journal, --redirects, --snapshot or --prefetch")
+    if args.snapshot and args.resume:
+        parser.error("--snapshot can't be combined with --resume, since it must hold all the taxa")
+    if args.divisions and not (args.processes > 1):
+        parser.error("--divisions requires --processes")
+
     #############################
     # Bind to FluidInfo instance
     fileCredentials = open(os.path.expanduser('~/.fluidDBcredentials'), 'r')
@@ -268,6 +797,7 @@ if __name__ == "__main__":
     fdb = Fluid()  # The main instance
     fdb.login(username, password)
     fdb.bind()
+    HttpTransport.BindFluid(fdb)
     nsUser = Namespace(username)
     
     sUserNS = nsUser.path     # Ugly use of a global, I know. :-)
@@ -276,18 +806,101 @@ if __name__ == "__main__":
     # we use additonal query criteria to limit the result to just a few items!!
 
     # Import all primate species:
-    itSpecies = iterTaxa(term="species[Rank] AND PRI[TXDV]", chunksize=100)
-
-    # Import just two species: Bos taurus, Homo sapiens
-    # itSpecies = iterEsearch("species[Rank] AND (9913[UID] OR 9606[UID])")
-
-
-    xmlTaxonData = itSpecies.GetFirst()
-    print "Total number of results: ", itSpecies.count
-
-    while xmlTaxonData is not None:
-        ImportTaxon(xmlTaxonData)
-        xmlTaxonData = itSpecies.GetNext()
+    sTerm = "species[Rank] AND PRI[TXDV]"
+    if args.subtree:
+        sTerm = "species[Rank] AND txid%d[Subtree]" % args.subtree
+    if args.processes > 1:
+        lTerms = [sTerm]
+        if args.divisions:
+            sBaseTerm = "species[Rank]"
+            if args.subtree:
+                sBaseTerm = "species[Rank] AND txid%d[Subtree]" % args.subtree
+            lTerms = [sBaseTerm + " AND %s[TXDV]" % sCode.strip() for sCode in args.divisions.split(',')]
+        ImportSharded(args, lTerms)
+    else:
+        tree = None
+        if args.taxdump:
+            # The lineages are derived from the taxonomy tree, so don't bother building the <LineageEx>
+            if args.subtree:
+                itSpecies = iterTaxdump(args.taxdump, rank="species", subtree=args.subtree, lineage=False)
+            else:
+                itSpecies = iterTaxdump(args.taxdump, rank="species", division="PRI", lineage=False)
+            tree = itSpecies.tree
+        elif args.prefetch > 0:
+            itSpecies = iterTaxaPrefetch(term=sTerm, chunksize=args.chunksize or 500,
+                                         prefetch=args.prefetch, streaming=args.streaming)
+        else:
+            itSpecies = iterTaxa(term=sTerm, chunksize=args.chunksize or 100,
+                                 streaming=args.streaming)
+
+        # Import just two species: Bos taurus, Homo sapiens
+        # itSpecies = iterEsearch("species[Rank] AND (9913[UID] OR 9606[UID])")
+
+
+        journal = None
+        iStart = 0
+        oncommit = None
+        if args.journal:
+            journal = ImportJournal(args.journal)
+            # Both sources enumerate the same taxa, but not in the same order!
+            iStart = journal.Start(sTerm + (" from taxdump" if args.taxdump else ""), args.resume)
+            oncommit = CommitToJournal(journal)
+            if iStart:
+                print "Resuming at position:", iStart
+
+        xmlTaxonData = itSpecies.GetFirst(iStart)
+        print "Total number of results: ", itSpecies.count
+
+        writer = MakeTaxonWriter(args, oncommit)
+        redirects = None
+        if args.redirects:
+            redirects = RedirectIndex(args.redirects)
+        snapshot = None
+        if args.snapshot:
+            snapshot = TaxonSnapshotWriter(args.snapshot)
+        progress = Instrumentation.Progress(itSpecies.count, iStart)
+        reporter = Instrumentation.Reporter(progress, interval=args.metricsinterval, sPath=args.metrics).Start()
+
+        while xmlTaxonData is not None:
+            ImportTaxon(xmlTaxonData, writer, journal, tree, redirects, snapshot)
+            progress.Advance()
+            if (journal is not None) and (itSpecies.start % args.checkpoint == 0):
+                # All the taxa handed out so far must be written before the checkpoint.
+                writer.Flush()
+                if not writer.failures:
+                    journal.Checkpoint(itSpecies.start)
+                # Otherwise the checkpoint stays before the first failed taxon, for --resume to retry
+                # it. The taxa written since are in the journal, and get skipped then.
+                if redirects is not None:
+                    # The names of the taxa before the checkpoint won't be added again when resuming.
+                    redirects.Merge()
+            xmlTaxonData = itSpecies.GetNext()
+        
+        writer.Close()
+        reporter.Stop()
+        print "Written", writer.committed, "taxa.", len(writer.failures), "failed:"
+        for (sAbout, e) in writer.failures:
+            print "   ", sAbout, repr(e)
+        if args.sync:
+            print "Tags added:", writer.added, " changed:", writer.changed, " unchanged:", writer.unchanged, " Taxa up to date:", writer.skipped
+        if redirects is not None:
+            # Only now that all the taxa are in, each name is written once with all its targets.
+            redirectWriter = BatchedValuesWriter(fdb, batchsize=args.redirectbatch, workers=args.writers,
+                                                 flushinterval=args.flushinterval, oncommit=redirects.OnCommit)
+            (iQueued, iUnchanged) = redirects.WriteRedirects(redirectWriter, sUserNS+u'/taxonomy/redirect-to')
+            redirectWriter.Close()
+            redirects.Close()
+            print "Written", redirectWriter.committed, "of", iQueued, "redirect objects.", iUnchanged, "were unchanged.", len(redirectWriter.failures), "failed."
+        if snapshot is not None:
+            snapshot.Close()
+            print "Written a snapshot of", snapshot.count, "taxa to", args.snapshot
+        if journal is not None:
+            print "Skipped", journal.unchanged, "unchanged taxa."
+            if writer.failures:
+                print "Run again with --resume to retry the failed taxa."
+            else:
+                journal.Finish()
+            journal.Close()
         
         
     # Put some usefull info on the description-tag of the namespace objects.
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+RequestScheduler.py
+
+Shared scheduler for the requests to the NCBI E-Utilities and the Wikipedia API,
+that keeps within the request rates allowed by those providers.
+
+*   A token bucket per host enforces the request rate. NCBI allows 3 requests per second,
+    or 10 with an API key:
+        http://www.ncbi.nlm.nih.gov/books/NBK25497/#chapter2.Usage_Guidelines_and_Requiremen
+*   The number of concurrent requests per host adapts itself: It grows while requests
+    succeed, so that slow responses don't keep the rate below the allowed one, and
+    halves as soon as the provider complains.
+*   Throttled (429), failed (5xx) and broken requests are retried with exponential
+    backoff and jitter, honoring any Retry-After header.
+*   The requests go through the keep-alive connections of the shared HttpTransport.
+
+Usage:
+    import RequestScheduler
+    RequestScheduler.Install(apikey='...')     # Optional
+    sBody = RequestScheduler.urlopen(url, data).read()
+    # Or, to parse the response while it arrives:
+    tree = ElementTree.parse(RequestScheduler.urlopen(url, data, stream=True))
+
+"""
+
+
+import time
+import random
+import socket
+import httplib
+import urllib
+import urllib2
+import urlparse
+import threading
+from StringIO import StringIO
+
+import HttpTransport
+import Instrumentation
+
+
+# Allowed requests per second, per host.
+dictHostRates = { 'eutils.ncbi.nlm.nih.gov' : 3.0
+                 ,'en.wikipedia.org'        : 10.0 }
+
+# Hosts that accept an NCBI API key, and the rate they allow with it.
+dictApiKeyRates = { 'eutils.ncbi.nlm.nih.gov' : 10.0 }
+
+# Rate for hosts not listed above.
+fDefaultRate = 3.0
+
+
+class TokenBucket:
+    """Thread-safe token bucket, refilled at a fixed rate.
+
+        @param rate:    Tokens per second.
+        @param burst:   Maximum number of tokens saved up. Defaults to 1, i.e. no bursts at all.
+    """
+    def __init__(self, rate, burst=1.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.tLast = time.time()
+        self.lock = threading.Lock()
+
+    def Acquire(self):
+        """
+            Take a token, waiting for it if necessary.
+        """
+        while True:
+            self.lock.acquire()
+            try:
+                tNow = time.time()
+                self.tokens = min(self.burst, self.tokens + (tNow - self.tLast)*self.rate)
+                self.tLast = tNow
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                fWait = (1.0 - self.tokens)/self.rate
+            finally:
+                self.lock.release()
+            time.sleep(fWait)
+
+
+class HostScheduler:
+    """Rate limit and adaptive concurrency limit for the requests to one host.
+
+       The concurrency limit grows additively on success, and shrinks multiplicatively
+       when the host throttles or fails, like TCP congestion control does.
+
+        @param rate:            Allowed requests per second.
+        @param maxconcurrency:  Upper bound of the concurrency limit.
+    """
+    def __init__(self, rate, maxconcurrency):
+        self.bucket = TokenBucket(rate)
+        self.maxconcurrency = maxconcurrency
+        self.limit = 1.0
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def Acquire(self):
+        """
+            Wait for a free slot and for the rate limit. To be paired with Release().
+        """
+        self.condition.acquire()
+        try:
+            while self.active >= int(self.limit):
+                self.condition.wait()
+            self.active += 1
+        finally:
+            self.condition.release()
+        self.bucket.Acquire()
+
+    def Release(self, bThrottled=False):
+        """
+            Free the slot taken by Acquire(), adapting the concurrency limit.
+
+            @param bThrottled: Whether the host throttled or failed the request.
+        """
+        self.condition.acquire()
+        try:
+            self.active -= 1
+            if bThrottled:
+                self.limit = max(1.0, self.limit/2.0)
+            else:
+                self.limit = min(float(self.maxconcurrency), self.limit + 1.0/self.limit)
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+
+class RequestScheduler:
+    """Rate-limited, retrying replacement for urllib2.urlopen(), shared by all threads.
+
+        @param apikey:          Optional NCBI API key, sent along with the requests to the E-Utilities.
+
+        @param retries:         Number of times a failed request is retried. Defaults to 5.
+
+        @param backoff:         Seconds to wait before the first retry. Doubled on each further retry. Defaults to 1.0
+
+        @param maxbackoff:      Upper bound of the wait between retries, in seconds. Defaults to 60.
+
+        @param maxconcurrency:  Upper bound of the concurrent requests per host. Defaults to 8.
+
+        @param timeout:         Socket timeout in seconds. Defaults to 60.
+
+        @param ratefactor:      Fraction of the allowed rates to use. e.g. 1/N for each of N processes
+                                sharing the same allowance. Defaults to 1.0
+    """
+    def __init__(self, apikey=None, retries=5, backoff=1.0, maxbackoff=60.0, maxconcurrency=8, timeout=60.0, ratefactor=1.0):
+        self.apikey = apikey
+        self.ratefactor = ratefactor
+        self.retries = retries
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+        self.maxconcurrency = maxconcurrency
+        self.timeout = timeout
+        self.hosts = dict()
+        self.lock = threading.Lock()
+
+    def GetHost(self, sHost):
+        """
+            Returns the HostScheduler of a host, creating it on first use.
+        """
+        self.lock.acquire()
+        try:
+            if sHost not in self.hosts:
+                fRate = dictHostRates.get(sHost, fDefaultRate)
+                if self.apikey and (sHost in dictApiKeyRates):
+                    fRate = dictApiKeyRates[sHost]
+                self.hosts[sHost] = HostScheduler(fRate*self.ratefactor, self.maxconcurrency)
+            return self.hosts[sHost]
+        finally:
+            self.lock.release()
+
+    def GetBackoff(self, iAttempt, e=None):
+        """
+            Seconds to wait before retrying, after iAttempt failed attempts.
+            Honors the Retry-After header of the failed response, if any.
+        """
+        if isinstance(e, urllib2.HTTPError):
+            sRetryAfter = e.info().getheader('Retry-After')
+            if sRetryAfter and sRetryAfter.isdigit():
+                return float(sRetryAfter)
+        # "Full jitter" keeps the retries of concurrent requests apart.
+        return random.uniform(0, min(self.maxbackoff, self.backoff * 2**iAttempt))
+
+    def urlopen(self, url, data=None, stream=False):
+        """
+            Drop-in replacement for urllib2.urlopen().
+            Returns a file-like object with the whole response body.
+
+            @param stream: Return as soon as the response headers arrived, with a file-like object
+                           that reads the body off the connection. Only failures until then are retried.
+        """
+        urlParts = urlparse.urlparse(url)
+        sHost = urlParts.hostname
+        # Timers per endpoint, e.g. "http.efetch.fcgi"
+        sTimer = 'http.' + (urlParts.path.rsplit('/', 1)[-1] or sHost)
+        host = self.GetHost(sHost)
+        if self.apikey and (sHost in dictApiKeyRates):
+            sKeyParam = urllib.urlencode({'api_key': self.apikey})
+            if data is not None:
+                data = data + '&' + sKeyParam
+            else:
+                url = url + ('&' if '?' in url else '?') + sKeyParam
+
+        iAttempt = 0
+        while True:
+            host.Acquire()
+            bThrottled = True
+            tStart = time.time()
+            try:
+                response = HttpTransport.urlopen(url, data, self.timeout)
+                if not stream:
+                    sBody = response.read()
+                bThrottled = False
+                Instrumentation.Count('http_requests')
+                Instrumentation.Count('http_bytes_out', len(data or ''))
+                if stream:
+                    # The body is timed and counted as it's read off the connection.
+                    response.Measure(sTimer, time.time() - tStart)
+                    return response
+                Instrumentation.AddTime(sTimer, time.time() - tStart)
+                Instrumentation.Count('http_bytes_in', len(sBody))
+                return StringIO(sBody)
+            except urllib2.HTTPError, e:
+                # Client errors other than throttling won't get any better by retrying.
+                if (e.code != 429) and (e.code < 500):
+                    bThrottled = False
+                    raise
+                if iAttempt >= self.retries:
+                    raise
+            except (urllib2.URLError, socket.error, httplib.HTTPException), e:
+                if iAttempt >= self.retries:
+                    raise
+            finally:
+                host.Release(bThrottled)
+            fWait = self.GetBackoff(iAttempt, e)
+            print "Request to", sHost, "failed with:", str(e), " Retrying in", round(fWait, 1), "seconds."
+            Instrumentation.Count('http_retries')
+            time.sleep(fWait)
+            iAttempt += 1
+
+
+# The scheduler used by urlopen()
+scheduler = RequestScheduler()
+
+def Install(apikey=None, retries=5, maxconcurrency=8, timeout=60.0, ratefactor=1.0):
+    """
+        Replaces the scheduler used by urlopen(). See RequestScheduler for the parameters.
+    """
+    global scheduler
+    scheduler = RequestScheduler(apikey=apikey, retries=retries, maxconcurrency=maxconcurrency, timeout=timeout,
+                                 ratefactor=ratefactor)
+    return scheduler
+
+def urlopen(url, data=None, stream=False):
+    """
+        Drop-in replacement for urllib2.urlopen(), going through the shared scheduler.
+    """
+    return scheduler.urlopen(url, data, stream)
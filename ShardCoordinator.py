@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+ShardCoordinator.py
+
+Spreads an import over a pool of worker processes, so that XML parsing and request
+handling aren't bound to a single CPU.
+
+The work is split into shards, each one a range of positions [start, stop) within the
+results of an Esearch term, e.g. the species of one division. The shards are handed out
+to the workers through a queue. A worker claims the positions of its shard one by one
+from shared memory, so that the coordinator can cut a shard short at any time: Whenever
+a worker runs out of shards while others are still busy, the shard with the most work
+left is split in two, and its second half queued for the idle worker. That keeps all
+the workers busy until the very end, however unevenly the work was split up front.
+
+The workers report their progress and metrics and, once done, the number of objects they
+wrote, their failures and their final metrics, which the coordinator merges.
+
+"""
+
+
+import os
+import Queue
+import multiprocessing
+
+import Instrumentation
+
+
+class ShardCursor:
+    """Hands out the positions of a shard to the worker process importing it.
+
+       The position bounds live in shared memory, so that the coordinator can lower
+       the stop of the shard while it's being imported. See ShardCoordinator.Split()
+
+        @param bounds:          The shared array of bounds: bounds[2*iShard] is the next position
+                                to claim, bounds[2*iShard+1] the stop of the shard.
+
+        @param iShard:          Index of the shard.
+
+        @param events:          Queue to report the progress to.
+
+        @param reportevery:     Number of claimed positions per progress report. Defaults to 100.
+    """
+    def __init__(self, bounds, iShard, events, reportevery=100):
+        self.bounds = bounds
+        self.iShard = iShard
+        self.events = events
+        self.reportevery = reportevery
+        self.unreported = 0
+        # The position claimed last, if any.
+        self.claimed = None
+
+    def Claim(self):
+        """
+            Claim the next position of the shard.
+            Returns False once the shard is exhausted, or was cut short there.
+        """
+        lock = self.bounds.get_lock()
+        lock.acquire()
+        try:
+            iPosition = self.bounds[2*self.iShard]
+            if iPosition >= self.bounds[2*self.iShard + 1]:
+                return False
+            self.bounds[2*self.iShard] = iPosition + 1
+        finally:
+            lock.release()
+        self.claimed = iPosition
+        self.unreported += 1
+        if self.unreported >= self.reportevery:
+            self.Report()
+        return True
+
+    def Report(self):
+        if self.unreported:
+            # Along with the metrics of the worker process, for the coordinator to merge.
+            self.events.put(('progress', self.iShard, (self.unreported, os.getpid(), Instrumentation.metrics.Snapshot())))
+            self.unreported = 0
+
+
+def WorkerProcess(fnMakeWorker, tasks, events, bounds):
+    """
+        Body of the worker processes: Runs the shards taken from the tasks queue until it
+        gets None, then reports its summary.
+    """
+    # A fresh registry: The one inherited from the coordinator holds its counts, which
+    # would be merged in again, and maybe a lock held by one of its threads at the fork.
+    Instrumentation.metrics = Instrumentation.Metrics()
+    worker = fnMakeWorker()
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        (iShard, sTerm, iStart) = task
+        events.put(('start', iShard, os.getpid()))
+        cursor = ShardCursor(bounds, iShard, events)
+        try:
+            worker.Run(sTerm, iStart, cursor)
+        except Exception, e:
+            cursor.Report()
+            # The position claimed last may not have been written.
+            iFailed = cursor.claimed if cursor.claimed is not None else iStart
+            events.put(('failed', iShard, (iFailed, repr(e))))
+            continue
+        cursor.Report()
+        events.put(('done', iShard, None))
+    (iWritten, lFailures) = worker.Finish()
+    # The final metrics, including those of the writes after the last claim.
+    events.put(('exit', os.getpid(), (iWritten, lFailures, Instrumentation.metrics.Snapshot())))
+
+
+class ShardCoordinator:
+    """Runs shards of an import on a pool of worker processes, rebalancing them as they go.
+
+       The workers are made by fnMakeWorker(), called once inside each worker process.
+       They must have the methods:
+            Run(sTerm, iStart, cursor):     Import the results of sTerm from position iStart on, one per
+                                            successful cursor.Claim(), until it returns False or the
+                                            results are exhausted. All writes must be complete on return.
+            Finish():                       Returns a tuple (number of objects written, list of failures),
+                                            which must be picklable.
+
+        @param fnMakeWorker:    Factory of the workers. Called in the worker processes, after the fork.
+
+        @param processes:       Number of worker processes.
+
+        @param minsplit:        Shards are only split if both halves get at least that many positions.
+                                Defaults to 100.
+
+        @param maxshards:       Upper bound of the number of shards, including the split ones.
+                                Defaults to 64 per process.
+    """
+    def __init__(self, fnMakeWorker, processes, minsplit=100, maxshards=None):
+        self.fnMakeWorker = fnMakeWorker
+        self.processes = processes
+        self.minsplit = minsplit
+        self.maxshards = maxshards or 64*processes
+        self.bounds = multiprocessing.Array('l', 2*self.maxshards)
+        self.tasks = multiprocessing.Queue()
+        self.events = multiprocessing.Queue()
+        # iShard -> sTerm, for all shards
+        self.terms = []
+        # Shard indexes queued but not started yet, and started but not done yet.
+        self.queued = set()
+        self.running = set()
+        # (sTerm, start, stop, error) of the shards that failed, with the positions they didn't import.
+        self.failures = []
+        self.splits = 0
+        # The worker processes, once started.
+        self.workers = []
+
+    def AddShard(self, sTerm, iStart, iStop):
+        """
+            Queue a new shard. Returns False if there are too many shards already.
+        """
+        iShard = len(self.terms)
+        if iShard >= self.maxshards:
+            return False
+        self.terms.append(sTerm)
+        self.bounds[2*iShard] = iStart
+        self.bounds[2*iShard + 1] = iStop
+        self.queued.add(iShard)
+        self.tasks.put((iShard, sTerm, iStart))
+        return True
+
+    def AddTerm(self, sTerm, iCount, iShardSize):
+        """
+            Queue the iCount results of an Esearch term, in shards of about iShardSize positions.
+        """
+        iShards = max(1, (iCount + iShardSize - 1)/iShardSize)
+        for i in xrange(iShards):
+            self.AddShard(sTerm, i*iCount/iShards, (i + 1)*iCount/iShards)
+
+    def Split(self):
+        """
+            Split the running shard with the most positions left in two, queueing its second half.
+            Returns False if no shard is worth splitting.
+        """
+        lock = self.bounds.get_lock()
+        lock.acquire()
+        try:
+            iLargest = None
+            iLeft = 0
+            for iShard in self.running:
+                iShardLeft = self.bounds[2*iShard + 1] - self.bounds[2*iShard]
+                if iShardLeft > iLeft:
+                    (iLargest, iLeft) = (iShard, iShardLeft)
+            if (iLargest is None) or (iLeft < 2*self.minsplit) or (len(self.terms) >= self.maxshards):
+                return False
+            iStop = self.bounds[2*iLargest + 1]
+            iMiddle = self.bounds[2*iLargest] + iLeft/2
+            # The worker of iLargest can't claim beyond iMiddle from now on.
+            self.bounds[2*iLargest + 1] = iMiddle
+        finally:
+            lock.release()
+        self.AddShard(self.terms[iLargest], iMiddle, iStop)
+        self.splits += 1
+        return True
+
+    def Rebalance(self):
+        """
+            Give work to the idle workers, by splitting the running shards.
+        """
+        iIdle = self.processes - len(self.running) - len(self.queued)
+        while (iIdle > 0) and self.Split():
+            iIdle -= 1
+
+    def Start(self):
+        """
+            Start the worker processes. Threads of the caller, like an Instrumentation.Reporter,
+            should only be started after this, so that the processes aren't forked while they run.
+        """
+        if self.workers:
+            return
+        self.workers = [multiprocessing.Process(target=WorkerProcess, args=(self.fnMakeWorker, self.tasks, self.events, self.bounds))
+                        for i in xrange(self.processes)]
+        for process in self.workers:
+            process.daemon = True
+            process.start()
+
+    def Run(self, progress=None):
+        """
+            Run all the queued shards to completion, starting the worker processes if not done yet.
+            Returns a tuple (number of objects written, list of failures of the workers).
+
+            @param progress: Optional Instrumentation.Progress to advance as the workers report.
+        """
+        self.Start()
+        lProcesses = self.workers
+
+        iWritten = 0
+        lFailures = []
+        iExited = 0
+        bStopping = False
+        while iExited < self.processes:
+            if not bStopping:
+                self.Rebalance()
+                if not (self.queued or self.running):
+                    # All done: Let the workers go.
+                    bStopping = True
+                    for process in lProcesses:
+                        self.tasks.put(None)
+            try:
+                (sEvent, key, value) = self.events.get(timeout=1.0)
+            except Queue.Empty:
+                if len([process for process in lProcesses if process.is_alive()]) < self.processes - iExited:
+                    raise RuntimeError("A worker process died unexpectedly.")
+                continue
+            if sEvent == 'start':
+                self.queued.discard(key)
+                self.running.add(key)
+            elif sEvent == 'progress':
+                (iClaimed, iPid, dictMetrics) = value
+                Instrumentation.metrics.AddSource(iPid, dictMetrics)
+                if progress is not None:
+                    progress.Advance(iClaimed)
+            elif sEvent in ('done', 'failed'):
+                self.running.discard(key)
+                if sEvent == 'failed':
+                    (iFailed, sError) = value
+                    iStop = self.bounds[2*key + 1]
+                    print "Shard", key, "of", self.terms[key], "failed at position", iFailed, "with:", sError
+                    self.failures.append((self.terms[key], iFailed, iStop, sError))
+            elif sEvent == 'exit':
+                iExited += 1
+                (iProcessWritten, lProcessFailures, dictMetrics) = value
+                Instrumentation.metrics.AddSource(key, dictMetrics)
+                iWritten += iProcessWritten
+                lFailures.extend(lProcessFailures)
+
+        for process in lProcesses:
+            process.join()
+        return (iWritten, lFailures)
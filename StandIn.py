@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+"""
+StandIn.py
+
+Local stand-in HTTP servers for the services used by the fiTaxonomy scripts, so that
+their throughput can be measured without touching the live services or needing
+any ~/.fluidDBcredentials
+
+*   FluidInfoStandIn implements the part of the FluidInfo API used through fom:
+    PUT/GET /values, GET/POST /objects, tag values on /objects/<id>/<tagpath>
+    and the namespace descriptions. Objects live in memory only.
+*   EutilsStandIn serves esearch.fcgi (including the history server), efetch.fcgi,
+    elink.fcgi (llinks) and the Wikipedia api.php "pageids" query, all backed by
+    a taxdump directory used as fixture. The LinkOut entries and Wikipedia articles
+    are synthesized from the taxa: The Wikipedia PageId of a taxon is its TaxId.
+
+Every server counts its requests and connections, and records how long it took to answer
+each request. An artificial latency can be added to every response. Like the live services,
+they compress larger responses for clients that accept gzip.
+
+MakeSyntheticTaxdump() writes a small taxdump directory to be used as fixture.
+
+"""
+
+
+import re
+import time
+import json
+import uuid
+import gzip
+import urllib
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+from StringIO import StringIO
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError, e:
+    from xml.etree import ElementTree
+
+from TaxDump import iterTaxdump, IterDmpRows
+
+
+PRIMITIVE_CONTENT_TYPE = 'application/vnd.fluiddb.value+json'
+
+# Responses from this size on are compressed, for clients that accept gzip.
+iGzipMinSize = 1024
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Threaded HTTP server on a free local port, with request statistics.
+
+       Subclasses implement Handle(method, lPath, dictArgs, sBody) returning
+       a tuple (status, content type, body).
+
+        @param latency: Seconds to wait before answering each request. Defaults to 0.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.thread = None
+        self.ResetStats()
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def ResetStats(self):
+        self.lock.acquire()
+        try:
+            # Lists of (path, seconds), one per request
+            self.requests = []
+            self.bytesIn = 0
+            self.bytesOut = 0
+            self.connections = 0
+        finally:
+            self.lock.release()
+
+    def CountConnection(self):
+        self.lock.acquire()
+        try:
+            self.connections += 1
+        finally:
+            self.lock.release()
+
+    def Record(self, sPath, fSeconds, iBytesIn, iBytesOut):
+        self.lock.acquire()
+        try:
+            self.requests.append((sPath, fSeconds))
+            self.bytesIn += iBytesIn
+            self.bytesOut += iBytesOut
+        finally:
+            self.lock.release()
+
+    def Start(self):
+        """
+            Serve from a background thread.
+        """
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def Stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Dispatches all requests to StandInServer.Handle()"""
+
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one go: Otherwise Nagle's algorithm and delayed ACKs
+    # add tens of milliseconds to every keep-alive request.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.CountConnection()
+
+    def Dispatch(self):
+        tStart = time.time()
+        (sPath, sep, sQuery) = self.path.partition('?')
+        lPath = [urllib.unquote(sPart).decode('utf-8') for sPart in sPath.split('/') if sPart]
+        iLength = int(self.headers.getheader('content-length') or 0)
+        sBody = self.rfile.read(iLength) if iLength else ''
+        dictArgs = urlparse.parse_qs(sQuery, keep_blank_values=True)
+        if self.headers.getheader('content-type', '').startswith('application/x-www-form-urlencoded'):
+            for (sKey, lValues) in urlparse.parse_qs(sBody, keep_blank_values=True).iteritems():
+                dictArgs.setdefault(sKey, []).extend(lValues)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        try:
+            (iStatus, sContentType, sResponse) = self.server.Handle(self.command, lPath, dictArgs, sBody)
+        except Exception, e:
+            (iStatus, sContentType, sResponse) = (500, 'text/plain', repr(e))
+        if isinstance(sResponse, unicode):
+            sResponse = sResponse.encode('utf-8')
+        self.send_response(iStatus)
+        self.send_header('Content-Type', sContentType)
+        if (len(sResponse) >= iGzipMinSize) and ('gzip' in self.headers.getheader('accept-encoding', '')):
+            fileGzip = StringIO()
+            gzipFile = gzip.GzipFile(fileobj=fileGzip, mode='wb', compresslevel=6)
+            gzipFile.write(sResponse)
+            gzipFile.close()
+            sResponse = fileGzip.getvalue()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(sResponse)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(sResponse)
+        self.server.Record(sPath, time.time() - tStart, iLength, len(sResponse))
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = Dispatch
+
+    def log_message(self, format, *args):
+        pass
+
+
+def JsonResponse(value, iStatus=200):
+    return (iStatus, 'application/json', json.dumps(value))
+
+
+class FluidInfoStandIn(StandInServer):
+    """In-memory stand-in for the FluidInfo API.
+
+       Understands these queries only, optionally combined with "or":
+            fluiddb/about = "..."
+            has <tagpath>
+    """
+    def __init__(self, latency=0.0):
+        StandInServer.__init__(self, latency)
+        self.storeLock = threading.Lock()
+        # uid -> {tagpath: value}
+        self.objects = dict()
+        # about -> uid
+        self.abouts = dict()
+
+    def GetOrCreate(self, sAbout):
+        """
+            Returns the uid of the object with the given about tag value, creating it if needed.
+            Must be called with self.storeLock held.
+        """
+        sUid = self.abouts.get(sAbout)
+        if sUid is None:
+            sUid = str(uuid.uuid4())
+            self.abouts[sAbout] = sUid
+            self.objects[sUid] = {u'fluiddb/about': sAbout}
+        return sUid
+
+    def Query(self, sQuery, bCreate=False):
+        """
+            Returns the list of uids matching a query. Must be called with self.storeLock held.
+        """
+        lUids = []
+        for sTerm in re.split(r'\s+or\s+', sQuery.strip()):
+            sTerm = sTerm.strip().strip('()').strip()
+            m = re.match(r'^fluiddb/about\s*=\s*"((?:[^"\\]|\\.)*)"$', sTerm)
+            if m:
+                sAbout = re.sub(r'\\(.)', r'\1', m.group(1))
+                if bCreate:
+                    lUids.append(self.GetOrCreate(sAbout))
+                elif sAbout in self.abouts:
+                    lUids.append(self.abouts[sAbout])
+                continue
+            m = re.match(r'^has\s+(\S+)$', sTerm)
+            if m:
+                sTagPath = m.group(1)
+                lUids.extend([sUid for (sUid, dictTags) in self.objects.iteritems() if sTagPath in dictTags])
+                continue
+            raise ValueError("Query not understood by the stand-in: " + sQuery)
+        return lUids
+
+    def Handle(self, sMethod, lPath, dictArgs, sBody):
+        self.storeLock.acquire()
+        try:
+            if lPath == [u'values'] and sMethod == 'PUT':
+                for (sQuery, dictValues) in json.loads(sBody)['queries']:
+                    # Like FluidInfo, create the object of an about query if it doesn't exist.
+                    for sUid in self.Query(sQuery, bCreate=True):
+                        for (sTagPath, dictValue) in dictValues.iteritems():
+                            self.objects[sUid][sTagPath] = dictValue['value']
+                return (204, 'text/plain', '')
+
+            if lPath == [u'values'] and sMethod == 'GET':
+                lTags = [sTag.decode('utf-8') for sTag in dictArgs.get('tag', [])]
+                dictResults = dict()
+                for sUid in self.Query(dictArgs['query'][0].decode('utf-8')):
+                    dictTags = self.objects[sUid]
+                    dictResults[sUid] = dict([(sTag, {u'value': dictTags[sTag]}) for sTag in lTags if sTag in dictTags])
+                return JsonResponse({u'results': {u'id': dictResults}})
+
+            if lPath == [u'objects'] and sMethod == 'GET':
+                return JsonResponse({u'ids': self.Query(dictArgs['query'][0].decode('utf-8'))})
+
+            if lPath == [u'objects'] and sMethod == 'POST':
+                sAbout = json.loads(sBody).get(u'about') if sBody else None
+                sUid = self.GetOrCreate(sAbout) if sAbout is not None else str(uuid.uuid4())
+                self.objects.setdefault(sUid, dict())
+                return JsonResponse({u'id': sUid, u'URI': self.url + '/objects/' + sUid}, 201)
+
+            if len(lPath) == 2 and lPath[0] == u'objects' and sMethod == 'GET':
+                dictTags = self.objects.get(lPath[1])
+                if dictTags is None:
+                    return (404, 'text/plain', '')
+                return JsonResponse({u'tagPaths': dictTags.keys(), u'about': dictTags.get(u'fluiddb/about')})
+
+            if len(lPath) == 3 and lPath[0] == u'objects':
+                dictTags = self.objects.get(lPath[1])
+                sTagPath = lPath[2]
+                if sMethod == 'PUT':
+                    if dictTags is None:
+                        return (404, 'text/plain', '')
+                    dictTags[sTagPath] = json.loads(sBody)
+                    return (204, 'text/plain', '')
+                if (dictTags is None) or (sTagPath not in dictTags):
+                    return (404, 'text/plain', '')
+                if sMethod == 'DELETE':
+                    del dictTags[sTagPath]
+                    return (204, 'text/plain', '')
+                return (200, PRIMITIVE_CONTENT_TYPE, json.dumps(dictTags[sTagPath]))
+
+            if lPath and lPath[0] in (u'namespaces', u'tags', u'permissions', u'users'):
+                # Descriptions and such: Accept anything, remember nothing.
+                if sMethod == 'GET':
+                    return JsonResponse({u'description': u'', u'id': str(uuid.uuid4())})
+                return (204, 'text/plain', '')
+
+            return (404, 'text/plain', '')
+        finally:
+            self.storeLock.release()
+
+
+class EutilsStandIn(StandInServer):
+    """Stand-in for the NCBI E-Utilities and the Wikipedia API, backed by a taxdump fixture.
+
+       Serves the endpoints at <url>/entrez/eutils/<name>.fcgi and <url>/w/api.php
+       Understands Esearch terms made of clauses joined by AND, each one an atom or
+       several atoms joined by OR, with these atoms:
+            <rank>[Rank]  <code>[TXDV]  txid<TaxId>[Subtree]  <TaxId>[UID]  <from>:<to>[UID]
+
+        @param sDumpDir: The taxdump directory used as fixture.
+        @param latency: See StandInServer
+    """
+    def __init__(self, sDumpDir, latency=0.0):
+        StandInServer.__init__(self, latency)
+        self.taxdump = iterTaxdump(sDumpDir)
+        self.tree = self.taxdump.tree
+        # TaxId -> rows of names.dmp
+        self.names = dict()
+        for row in IterDmpRows(sDumpDir + '/names.dmp'):
+            self.names.setdefault(int(row[0]), []).append(row)
+        self.allTaxIds = [iTaxId for iTaxId in xrange(len(self.tree.parents)) if self.tree.Contains(iTaxId)]
+        # WebEnv -> list of TaxIds
+        self.history = dict()
+        self.historyLock = threading.Lock()
+
+    @property
+    def urlEutils(self):
+        return self.url + '/entrez/eutils/'
+
+    @property
+    def urlWikipediaApi(self):
+        return self.url + '/w/api.php'
+
+    def MatchAtom(self, iTaxId, sValue, sField):
+        sField = sField.lower()
+        if sField == 'rank':
+            return self.tree.GetRank(iTaxId) == sValue
+        if sField == 'txdv':
+            return self.taxdump.dictDivisions[self.tree.GetDivision(iTaxId)][0] == sValue
+        if sField == 'subtree':
+            return self.tree.IsInSubtree(iTaxId, int(sValue.replace('txid', '')))
+        if sField == 'uid':
+            if ':' in sValue:
+                (sFrom, sTo) = sValue.split(':')
+                return int(sFrom) <= iTaxId <= int(sTo)
+            return iTaxId == int(sValue)
+        raise ValueError("Field not understood by the stand-in: " + sField)
+
+    def Search(self, sTerm):
+        """
+            Returns the sorted list of TaxIds matching an Esearch term.
+        """
+        lClauses = [re.findall(r'([\w:]+)\[(\w+)\]', sClause) for sClause in sTerm.split(' AND ')]
+        return [iTaxId for iTaxId in self.allTaxIds
+                if all([any([self.MatchAtom(iTaxId, sValue, sField) for (sValue, sField) in lAtoms]) for lAtoms in lClauses])]
+
+    def Esearch(self, dictArgs):
+        lTaxIds = self.Search(dictArgs['term'][0])
+        eResult = ElementTree.Element('eSearchResult')
+        ElementTree.SubElement(eResult, 'Count').text = str(len(lTaxIds))
+        iStart = int(dictArgs.get('retstart', ['0'])[0])
+        iMax = int(dictArgs.get('retmax', ['20'])[0])
+        ElementTree.SubElement(eResult, 'RetMax').text = str(iMax)
+        ElementTree.SubElement(eResult, 'RetStart').text = str(iStart)
+        if dictArgs.get('usehistory', ['n'])[0] == 'y':
+            sWebEnv = 'NCID_' + uuid.uuid4().hex
+            self.historyLock.acquire()
+            try:
+                self.history[sWebEnv] = lTaxIds
+            finally:
+                self.historyLock.release()
+            ElementTree.SubElement(eResult, 'QueryKey').text = '1'
+            ElementTree.SubElement(eResult, 'WebEnv').text = sWebEnv
+        eIdList = ElementTree.SubElement(eResult, 'IdList')
+        for iTaxId in lTaxIds[iStart:iStart+iMax]:
+            ElementTree.SubElement(eIdList, 'Id').text = str(iTaxId)
+        return eResult
+
+    def Efetch(self, dictArgs):
+        if 'id' in dictArgs:
+            lTaxIds = [int(sId) for sId in dictArgs['id'][0].split(',')]
+        else:
+            lHistory = self.history[dictArgs['WebEnv'][0]]
+            iStart = int(dictArgs.get('retstart', ['0'])[0])
+            iMax = int(dictArgs.get('retmax', ['20'])[0])
+            lTaxIds = lHistory[iStart:iStart+iMax]
+        eTaxaSet = ElementTree.Element('TaxaSet')
+        for iTaxId in lTaxIds:
+            eTaxaSet.append(self.taxdump.MakeTaxonElement(iTaxId, self.names.get(iTaxId, [])))
+        return eTaxaSet
+
+    def MakeObjUrl(self, eParent, sUrl, sLinkName, sProvider, sProviderAbbr, iProviderId):
+        eObjUrl = ElementTree.SubElement(eParent, 'ObjUrl')
+        ElementTree.SubElement(eObjUrl, 'Url').text = sUrl
+        ElementTree.SubElement(eObjUrl, 'LinkName').text = sLinkName
+        eProvider = ElementTree.SubElement(eObjUrl, 'Provider')
+        ElementTree.SubElement(eProvider, 'Name').text = sProvider
+        ElementTree.SubElement(eProvider, 'NameAbbr').text = sProviderAbbr
+        ElementTree.SubElement(eProvider, 'Id').text = str(iProviderId)
+        ElementTree.SubElement(eProvider, 'Url').text = 'http://' + sProviderAbbr.lower() + '.example.org/'
+
+    def Elink(self, dictArgs):
+        sHolding = dictArgs.get('holding', [None])[0]
+        eResult = ElementTree.Element('eLinkResult')
+        eLinkSet = ElementTree.SubElement(eResult, 'LinkSet')
+        ElementTree.SubElement(eLinkSet, 'DbFrom').text = 'taxonomy'
+        eIdUrlList = ElementTree.SubElement(eLinkSet, 'IdUrlList')
+        for sId in dictArgs['id'][0].split(','):
+            iTaxId = int(sId)
+            eIdUrlSet = ElementTree.SubElement(eIdUrlList, 'IdUrlSet')
+            ElementTree.SubElement(eIdUrlSet, 'Id').text = sId
+            if not self.tree.Contains(iTaxId):
+                continue
+            sName = self.tree.GetName(iTaxId)
+            if sHolding in (None, 'iPhylo'):
+                self.MakeObjUrl(eIdUrlSet, 'http://en.wikipedia.org/wiki/index.html?curid=%d' % iTaxId,
+                                'Wikipedia', 'iPhylo', 'iPhylo', 7164)
+                self.MakeObjUrl(eIdUrlSet, 'http://www.bbc.co.uk/nature/species/' + sName.replace(' ', '_'),
+                                'BBC Wildlife Finder', 'iPhylo', 'iPhylo', 7164)
+            if sHolding in (None, 'EOL'):
+                self.MakeObjUrl(eIdUrlSet, 'http://eol.example.org/pages/%d' % iTaxId,
+                                'taxonomy/phylogenetic', 'Encyclopedia of Life', 'EOL', 5180)
+        return eResult
+
+    def WikipediaQuery(self, dictArgs):
+        eApi = ElementTree.Element('api')
+        ePages = ElementTree.SubElement(ElementTree.SubElement(eApi, 'query'), 'pages')
+        for sPageId in dictArgs['pageids'][0].split('|'):
+            ePage = ElementTree.SubElement(ePages, 'page')
+            ePage.set('pageid', sPageId)
+            if self.tree.Contains(int(sPageId)):
+                ePage.set('ns', '0')
+                ePage.set('title', self.tree.GetName(int(sPageId)))
+            else:
+                ePage.set('missing', '')
+        return eApi
+
+    def Handle(self, sMethod, lPath, dictArgs, sBody):
+        dictEndpoints = { u'esearch.fcgi' : self.Esearch
+                         ,u'efetch.fcgi'  : self.Efetch
+                         ,u'elink.fcgi'   : self.Elink
+                         ,u'api.php'      : self.WikipediaQuery }
+        fnEndpoint = dictEndpoints.get(lPath[-1] if lPath else None)
+        if fnEndpoint is None:
+            return (404, 'text/plain', '')
+        return (200, 'text/xml', '<?xml version="1.0"?>\n' + ElementTree.tostring(fnEndpoint(dictArgs)))
+
+
+def MakeSyntheticTaxdump(sDumpDir, iSpecies=1000, iSpeciesPerGenus=10):
+    """
+        Writes nodes.dmp, names.dmp and division.dmp of a synthetic taxonomy into sDumpDir:
+        The real lineage of the Primates down to the order, with iSpecies made-up species
+        in genera of iSpeciesPerGenus species each.
+    """
+    lRows = [ (1,       1,      'no rank',      8, 'root')
+             ,(131567,  1,      'no rank',      8, 'cellular organisms')
+             ,(2759,    131567, 'superkingdom', 1, 'Eukaryota')
+             ,(33208,   2759,   'kingdom',      1, 'Metazoa')
+             ,(7711,    33208,  'phylum',       10, 'Chordata')
+             ,(40674,   7711,   'class',        2, 'Mammalia')
+             ,(9443,    40674,  'order',        5, 'Primates') ]
+    iNextTaxId = 100000
+    iGenus = None
+    sGenus = None
+    for i in xrange(iSpecies):
+        if i % iSpeciesPerGenus == 0:
+            iGenus = iNextTaxId
+            sGenus = 'Genus%s' % ''.join([chr(ord('a') + int(c)) for c in str(i/iSpeciesPerGenus)])
+            lRows.append((iGenus, 9443, 'genus', 5, sGenus))
+            iNextTaxId += 1
+        lRows.append((iNextTaxId, iGenus, 'species', 5, sGenus + ' species' + ''.join([chr(ord('a') + int(c)) for c in str(i)])))
+        iNextTaxId += 1
+    lRows.sort()
+
+    fileNodes = open(sDumpDir + '/nodes.dmp', 'w')
+    fileNames = open(sDumpDir + '/names.dmp', 'w')
+    for (iTaxId, iParent, sRank, iDivision, sName) in lRows:
+        fileNodes.write('\t|\t'.join([str(iTaxId), str(iParent), sRank, '', str(iDivision)]) + '\t|\n')
+        fileNames.write('\t|\t'.join([str(iTaxId), sName, '', 'scientific name']) + '\t|\n')
+        if sRank == 'species':
+            fileNames.write('\t|\t'.join([str(iTaxId), sName.lower().replace('genus', 'common '), '', 'genbank common name']) + '\t|\n')
+            fileNames.write('\t|\t'.join([str(iTaxId), sName.replace('Genus', 'Synonymus'), '', 'synonym']) + '\t|\n')
+    fileNodes.close()
+    fileNames.close()
+
+    fileDivisions = open(sDumpDir + '/division.dmp', 'w')
+    for (iDivision, sCode, sName) in [ (1, 'INV', 'Invertebrates'), (2, 'MAM', 'Mammals'), (5, 'PRI', 'Primates')
+                                      ,(8, 'UNA', 'Unassigned'), (10, 'VRT', 'Vertebrates') ]:
+        fileDivisions.write('\t|\t'.join([str(iDivision), sCode, sName, '']) + '\t|\n')
+    fileDivisions.close()
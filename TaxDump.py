@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+TaxDump.py
+
+Offline source of NCBI Taxonomy records, streamed from a local copy of the
+"taxdump" files instead of paging through Esearch/Efetch.
+
+Download and unpack the dump into a directory:
+    ftp://ftp.ncbi.nih.gov/pub/taxonomy/taxdump.tar.gz
+
+The format of the *.dmp files is described in the readme.txt inside the archive.
+Only nodes.dmp, names.dmp and division.dmp are used.
+
+The taxa are handed out as <Taxon> ElementTrees shaped like the ones returned by
+Efetch, so that ImportTaxon() in PopulateTaxa.py consumes them unchanged.
+
+"""
+
+
+import os.path
+import mmap
+from itertools import groupby
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError, e:
+    from xml.etree import ElementTree
+
+from TaxonomyTree import TaxonomyTree
+
+
+# Maps the name classes of names.dmp to the <OtherNames> items of Efetch.
+# Name classes not listed here are ignored, as ImportTaxon() doesn't use them.
+dictNameClasses = { 'genbank common name' : 'GenbankCommonName'
+                   ,'common name'         : 'CommonName'
+                   ,'synonym'             : 'Synonym' }
+
+
+def IterDmpRows(sFileName):
+    """
+        Memory-maps a *.dmp file and yields its rows one by one,
+        each one as a list of (byte-)strings with the field values.
+
+        Fields are separated by "\\t|\\t" and each row is terminated by "\\t|\\n".
+    """
+    fileDmp = open(sFileName, 'rb')
+    try:
+        # mmap refuses to map empty files
+        if os.path.getsize(sFileName) == 0:
+            return
+        mm = mmap.mmap(fileDmp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            line = mm.readline()
+            while line:
+                if line.endswith('\t|\n'):
+                    line = line[:-3]
+                else:
+                    line = line.rstrip('\n')
+                yield line.split('\t|\t')
+                line = mm.readline()
+        finally:
+            mm.close()
+    finally:
+        fileDmp.close()
+
+
+def LoadDivisions(sDumpDir):
+    """
+        Reads division.dmp
+        Returns a dict mapping the division id to a tuple (code, name).
+        e.g. {5: ('PRI', 'Primates'), ...}
+    """
+    dictDivisions = dict()
+    for row in IterDmpRows(os.path.join(sDumpDir, 'division.dmp')):
+        dictDivisions[int(row[0])] = (row[1], unicode(row[2], 'utf-8', 'replace'))
+    return dictDivisions
+
+
+def LoadTaxonomyTree(sDumpDir):
+    """
+        Builds a TaxonomyTree from nodes.dmp and the scientific names of names.dmp
+    """
+    tree = TaxonomyTree()
+    for row in IterDmpRows(os.path.join(sDumpDir, 'nodes.dmp')):
+        tree.Add(int(row[0]), int(row[1]), row[2], int(row[4]))
+    for row in IterDmpRows(os.path.join(sDumpDir, 'names.dmp')):
+        if row[3] == 'scientific name':
+            tree.SetName(int(row[0]), unicode(row[1], 'utf-8', 'replace'))
+    return tree
+
+
+class iterTaxdump:
+    """Forward iterator over the taxa of a local NCBI taxdump.
+
+       Drop-in replacement for iterTaxa in PopulateTaxa.py, when a local copy of the
+       whole database is available: Same GetFirst()/GetNext() interface and same
+       <Taxon> ElementTrees, but without a single network round trip.
+
+       The taxonomy tree with the scientific names is loaded into memory on construction,
+       since it is needed to assemble the lineages. It's available as self.tree
+       The other names are streamed from names.dmp while iterating.
+
+        @param sDumpDir:    Directory containing the unpacked nodes.dmp, names.dmp and division.dmp
+
+        @param rank:        Only hand out taxa of this rank. e.g. "species"
+                            Defaults to None, meaning any rank.
+
+        @param division:    Only hand out taxa of this division, given by its code. e.g. "PRI"
+                            Equivalent to the [TXDV] field of Esearch queries.
+                            Defaults to None, meaning any division.
+
+        @param subtree:     Only hand out taxa below the taxon with this TaxId, including itself.
+                            e.g. 9443 for the Primates. Equivalent to the [Subtree] field of Esearch queries.
+                            Defaults to None, meaning the whole tree.
+
+        @param lineage:     Whether to include the <LineageEx> items in the <Taxon> ElementTrees.
+                            Not needed if the lineage is derived from self.tree instead.
+                            Defaults to True.
+    """
+    def __init__(self, sDumpDir, rank=None, division=None, subtree=None, lineage=True):
+        self.sDumpDir = sDumpDir
+        self.rank = rank
+        self.division = division
+        self.subtree = subtree
+        self.lineage = lineage
+        self.start = 0
+        self.count = 0
+        self.iterator = None
+
+        self.dictDivisions = LoadDivisions(sDumpDir)
+        self.tree = LoadTaxonomyTree(sDumpDir)
+
+        if subtree is not None:
+            for iTaxId in self.tree.IterSubtree(subtree, rank):
+                if self.IsSelected(iTaxId):
+                    self.count += 1
+        else:
+            for iTaxId in xrange(len(self.tree.parents)):
+                if self.tree.Contains(iTaxId) and self.IsSelected(iTaxId):
+                    self.count += 1
+
+    def IsSelected(self, iTaxId):
+        """
+            Whether a node matches the filter criteria.
+        """
+        if (self.rank is not None) and (self.tree.GetRank(iTaxId) != self.rank):
+            return False
+        if (self.division is not None) and (self.dictDivisions[self.tree.GetDivision(iTaxId)][0] != self.division):
+            return False
+        if (self.subtree is not None) and not self.tree.IsInSubtree(iTaxId, self.subtree):
+            return False
+        return True
+
+    def MakeTaxonElement(self, iTaxId, rowsNames):
+        """
+            Assembles the <Taxon> ElementTree for a taxon, as Efetch would send it.
+
+            @param iTaxId: The TaxId of the taxon.
+            @param rowsNames: The rows of names.dmp belonging to that taxon.
+        """
+        tree = self.tree
+
+        eTaxon = ElementTree.Element('Taxon')
+        ElementTree.SubElement(eTaxon, 'TaxId').text = str(iTaxId)
+        ElementTree.SubElement(eTaxon, 'ScientificName').text = tree.GetName(iTaxId)
+
+        eOtherNames = ElementTree.SubElement(eTaxon, 'OtherNames')
+        for row in rowsNames:
+            sItem = dictNameClasses.get(row[3])
+            if sItem is not None:
+                ElementTree.SubElement(eOtherNames, sItem).text = unicode(row[1], 'utf-8', 'replace')
+
+        ElementTree.SubElement(eTaxon, 'ParentTaxId').text = str(tree.GetParent(iTaxId))
+        ElementTree.SubElement(eTaxon, 'Rank').text = tree.GetRank(iTaxId)
+        ElementTree.SubElement(eTaxon, 'Division').text = self.dictDivisions[tree.GetDivision(iTaxId)][1]
+
+        if self.lineage:
+            eLineageEx = ElementTree.SubElement(eTaxon, 'LineageEx')
+            for iAncestor in tree.GetLineage(iTaxId):
+                eAncestor = ElementTree.SubElement(eLineageEx, 'Taxon')
+                ElementTree.SubElement(eAncestor, 'TaxId').text = str(iAncestor)
+                ElementTree.SubElement(eAncestor, 'ScientificName').text = tree.GetName(iAncestor)
+                ElementTree.SubElement(eAncestor, 'Rank').text = tree.GetRank(iAncestor)
+
+        return eTaxon
+
+    def IterTaxa(self, iStart=0):
+        """
+            Generator yielding the <Taxon> ElementTrees of all the selected taxa,
+            in the order of names.dmp, which is sorted by TaxId.
+
+            @param iStart: Number of selected taxa to skip first.
+        """
+        iSkip = iStart
+        iLastTaxId = 0
+        rows = IterDmpRows(os.path.join(self.sDumpDir, 'names.dmp'))
+        for iTaxId, rowsNames in groupby(rows, lambda row: int(row[0])):
+            # Grouping by TaxId only works if names.dmp is sorted!
+            assert(iTaxId > iLastTaxId)
+            iLastTaxId = iTaxId
+            if self.IsSelected(iTaxId):
+                if iSkip:
+                    iSkip -= 1
+                    continue
+                yield self.MakeTaxonElement(iTaxId, rowsNames)
+
+    def GetNext(self):
+        """
+            Get the next selected Taxon.
+            Returns None if there are no taxa left.
+        """
+        if self.iterator is None:
+            self.iterator = self.IterTaxa()
+        try:
+            xmlTaxonData = self.iterator.next()
+        except StopIteration:
+            return None
+        self.start += 1
+        return xmlTaxonData
+
+    def GetFirst(self, iStart=0):
+        """
+            Get the first selected Taxon.
+            Returns None if no taxon matches the filter criteria.
+
+            @param iStart: Skip that many taxa first, e.g. to resume an interrupted import.
+        """
+        self.start = iStart
+        self.iterator = self.IterTaxa(iStart)
+        return self.GetNext()
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+TaxonSnapshot.py
+
+Compact local snapshot of the taxa imported by PopulateTaxa.py, so that later tools can
+iterate over them without querying FluidInfo and reading each object over HTTP.
+
+The snapshot is a single file of columns, sorted by TaxId:
+    TaxId, ParentTaxId, rank and division as fixed-size arrays, and the about tag value and
+    scientific name of each taxon as indexes into a table of strings, which is stored as an
+    array of offsets into the UTF-8 encoded string data.
+A JSON header lists where each column starts, relative to the end of the header,
+plus the rank and division names.
+
+The reader maps the file into memory, so that opening even a snapshot of the whole
+NCBI Taxonomy costs next to nothing, and only the pages actually read get loaded.
+
+Usage:
+    snapshot = TaxonSnapshotWriter('taxa.snapshot')
+    snapshot.Add(9606, 9605, u'species', u'Primates', u'homo sapiens', u'Homo sapiens')
+    snapshot.Close()
+
+    for taxon in TaxonSnapshot('taxa.snapshot'):
+        print taxon.TaxId, taxon.about
+
+"""
+
+
+import os
+import sys
+import json
+import mmap
+import struct
+from array import array
+from collections import namedtuple
+
+
+sMagic = 'FITAXSN1'
+
+# The columns, with their array typecodes.
+lColumns = [ ('taxids',     'i')
+            ,('parents',    'i')
+            ,('ranks',      'B')
+            ,('divisions',  'B')
+            ,('abouts',     'i')
+            ,('names',      'i')
+            ,('stroffsets', 'i')
+            ,('strdata',    'c') ]
+
+# The rows handed out by TaxonSnapshot. The names of the attributes match those
+# of the fom NcbiTaxon objects, so that they can be used in their place.
+SnapshotTaxon = namedtuple('SnapshotTaxon', 'TaxId ParentTaxId Rank Division about ScientificName')
+
+
+def GetDataStart(iHeaderLength):
+    """
+        Returns the file offset of the columns, after the magic, the header length and the header.
+    """
+    return (len(sMagic) + 4 + iHeaderLength + 7)/8*8
+
+
+class TaxonSnapshotWriter:
+    """Gathers the taxa of a snapshot in memory, and writes the file on Close().
+
+       The taxa go straight into the column arrays, in the order they're added, and
+       are only sorted by TaxId on Close(), unless they were added in that order.
+       Taxa added several times keep the values added last.
+       The file is replaced atomically, so that readers never see a partial one.
+
+        @param sPath: The snapshot file.
+    """
+    def __init__(self, sPath):
+        self.sPath = os.path.expanduser(sPath)
+        self.columns = dict([(sColumn, array(sTypeCode)) for (sColumn, sTypeCode) in lColumns])
+        self.columns['stroffsets'].append(0)
+        self.rankTable = []
+        self.divisionTable = []
+        # Whether the TaxIds were added in strictly ascending order so far.
+        self.ordered = True
+        # The number of taxa written, once closed.
+        self.count = None
+
+    def AddString(self, sString):
+        """
+            Appends sString to the string table, encoded as UTF-8. Returns its index.
+        """
+        offsets = self.columns['stroffsets']
+        self.columns['strdata'].fromstring(sString.encode('utf-8'))
+        offsets.append(len(self.columns['strdata']))
+        return len(offsets) - 2
+
+    def Add(self, iTaxId, iParentTaxId, sRank, sDivision, sAbout, sName):
+        if sRank not in self.rankTable:
+            self.rankTable.append(sRank)
+        if sDivision not in self.divisionTable:
+            self.divisionTable.append(sDivision)
+        assert(len(self.rankTable) <= 256 and len(self.divisionTable) <= 256)
+        taxids = self.columns['taxids']
+        if taxids and (iTaxId <= taxids[-1]):
+            self.ordered = False
+        taxids.append(iTaxId)
+        self.columns['parents'].append(iParentTaxId)
+        self.columns['ranks'].append(self.rankTable.index(sRank))
+        self.columns['divisions'].append(self.divisionTable.index(sDivision))
+        iAbout = self.AddString(sAbout)
+        self.columns['abouts'].append(iAbout)
+        # Shared with the about tag value, if the scientific name is all lowercase already.
+        self.columns['names'].append(iAbout if sName == sAbout else self.AddString(sName))
+
+    def SortRows(self):
+        """
+            Sorts the rows of the columns by TaxId, keeping only the row added last of each TaxId.
+            The string table stays as it is.
+        """
+        taxids = self.columns['taxids']
+        # sorted() is stable, so the rows of a TaxId stay in the order they were added.
+        lOrder = sorted(xrange(len(taxids)), key=taxids.__getitem__)
+        lOrder = [iRow for (i, iRow) in enumerate(lOrder)
+                  if (i + 1 == len(lOrder)) or (taxids[lOrder[i + 1]] != taxids[iRow])]
+        for sColumn in ('taxids', 'parents', 'ranks', 'divisions', 'abouts', 'names'):
+            column = self.columns[sColumn]
+            self.columns[sColumn] = array(column.typecode, [column[iRow] for iRow in lOrder])
+
+    def Close(self):
+        if not self.ordered:
+            self.SortRows()
+        self.count = len(self.columns['taxids'])
+
+        # The data is stored little-endian, whatever the platform.
+        lData = []
+        for (sColumn, sTypeCode) in lColumns:
+            column = self.columns[sColumn]
+            if sys.byteorder != 'little':
+                column.byteswap()
+            lData.append(column.tostring())
+        dictHeader = { 'count'      : self.count
+                      ,'strings'    : len(self.columns['stroffsets']) - 1
+                      ,'ranks'      : self.rankTable
+                      ,'divisions'  : self.divisionTable
+                      ,'columns'    : dict() }
+        # Each column aligned to 8 bytes.
+        iOffset = 0
+        for ((sColumn, sTypeCode), sData) in zip(lColumns, lData):
+            dictHeader['columns'][sColumn] = [iOffset, len(sData)]
+            iOffset = (iOffset + len(sData) + 7)/8*8
+        sHeader = json.dumps(dictHeader)
+        iDataStart = GetDataStart(len(sHeader))
+
+        sTempPath = self.sPath + '.tmp'
+        fileSnapshot = open(sTempPath, 'wb')
+        try:
+            fileSnapshot.write(sMagic + struct.pack('<I', len(sHeader)) + sHeader)
+            for ((sColumn, sTypeCode), sData) in zip(lColumns, lData):
+                fileSnapshot.seek(iDataStart + dictHeader['columns'][sColumn][0])
+                fileSnapshot.write(sData)
+        finally:
+            fileSnapshot.close()
+        os.rename(sTempPath, self.sPath)
+
+
+class TaxonSnapshot:
+    """Read-only, memory-mapped view of a snapshot written by TaxonSnapshotWriter.
+
+       Iterating yields a SnapshotTaxon per taxon, in the order of their TaxIds.
+       Single taxa are accessed by their position with Get(), or by TaxId with Find().
+
+        @param sPath: The snapshot file.
+    """
+    def __init__(self, sPath):
+        fileSnapshot = open(os.path.expanduser(sPath), 'rb')
+        try:
+            self.mm = mmap.mmap(fileSnapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fileSnapshot.close()
+        if self.mm[:8] != sMagic:
+            raise ValueError("Not a taxon snapshot: " + sPath)
+        (iHeaderLength,) = struct.unpack_from('<I', self.mm, 8)
+        dictHeader = json.loads(self.mm[12:12 + iHeaderLength])
+        iDataStart = GetDataStart(iHeaderLength)
+        self.count = dictHeader['count']
+        self.strings = dictHeader['strings']
+        self.rankTable = dictHeader['ranks']
+        self.divisionTable = dictHeader['divisions']
+        self.columns = dict()
+        for (sColumn, sTypeCode) in lColumns:
+            (iOffset, iLength) = dictHeader['columns'][sColumn]
+            self.columns[sColumn] = (iDataStart + iOffset, sTypeCode, struct.Struct('<' + sTypeCode))
+
+    def __len__(self):
+        return self.count
+
+    def GetValue(self, sColumn, i):
+        """
+            Returns the i-th value of a column, straight from the mapped file.
+        """
+        (iOffset, sTypeCode, packer) = self.columns[sColumn]
+        return packer.unpack_from(self.mm, iOffset + i*packer.size)[0]
+
+    def GetColumn(self, sColumn, iStart, iStop):
+        """
+            Returns the values [iStart:iStop] of a column as an array.
+        """
+        (iOffset, sTypeCode, packer) = self.columns[sColumn]
+        column = array(sTypeCode)
+        column.fromstring(self.mm[iOffset + iStart*packer.size:iOffset + iStop*packer.size])
+        if sys.byteorder != 'little':
+            column.byteswap()
+        return column
+
+    def GetString(self, iString):
+        iStart = self.GetValue('stroffsets', iString)
+        iStop = self.GetValue('stroffsets', iString + 1)
+        (iOffset, sTypeCode, packer) = self.columns['strdata']
+        return self.mm[iOffset + iStart:iOffset + iStop].decode('utf-8')
+
+    def Get(self, i):
+        """
+            Returns the SnapshotTaxon at position i.
+        """
+        return SnapshotTaxon( self.GetValue('taxids', i)
+                             ,self.GetValue('parents', i)
+                             ,self.rankTable[self.GetValue('ranks', i)]
+                             ,self.divisionTable[self.GetValue('divisions', i)]
+                             ,self.GetString(self.GetValue('abouts', i))
+                             ,self.GetString(self.GetValue('names', i)) )
+
+    def Find(self, iTaxId):
+        """
+            Returns the SnapshotTaxon with the given TaxId, or None if it isn't in the snapshot.
+        """
+        # Binary search over the sorted TaxIds
+        iLow = 0
+        iHigh = self.count
+        while iLow < iHigh:
+            iMiddle = (iLow + iHigh)/2
+            if self.GetValue('taxids', iMiddle) < iTaxId:
+                iLow = iMiddle + 1
+            else:
+                iHigh = iMiddle
+        if (iLow < self.count) and (self.GetValue('taxids', iLow) == iTaxId):
+            return self.Get(iLow)
+        return None
+
+    def __iter__(self):
+        return self.Iter()
+
+    def Iter(self, blocksize=10000):
+        """
+            Yields all the taxa as SnapshotTaxon, reading the columns block by block.
+        """
+        # All the strings will be needed anyway.
+        offsets = self.GetColumn('stroffsets', 0, self.strings + 1)
+        iData = self.columns['strdata'][0]
+        mm = self.mm
+        for iStart in xrange(0, self.count, blocksize):
+            iStop = min(self.count, iStart + blocksize)
+            lBlock = [self.GetColumn(sColumn, iStart, iStop) for sColumn in ('taxids', 'parents', 'ranks', 'divisions', 'abouts', 'names')]
+            for (iTaxId, iParent, iRank, iDivision, iAbout, iName) in zip(*lBlock):
+                yield SnapshotTaxon(iTaxId, iParent, self.rankTable[iRank], self.divisionTable[iDivision],
+                                    mm[iData + offsets[iAbout]:iData + offsets[iAbout + 1]].decode('utf-8'),
+                                    mm[iData + offsets[iName]:iData + offsets[iName + 1]].decode('utf-8'))
+
+    def Close(self):
+        self.mm.close()
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+TaxonomyTree.py
+
+Compact in-memory index of the NCBI taxonomy tree, built from ParentTaxId data.
+
+Parent, rank and division of every taxon are kept in arrays indexed by TaxId, and
+the scientific names as a single UTF-8 encoded string with an array of offsets into it,
+rather than as millions of separate objects. Lineages are computed by walking up the tree, memoizing the
+ancestor paths of the inner nodes, which are shared by all their descendants.
+
+This allows to derive the Lineage/LineageIds tags locally, and to select subtrees
+(e.g. all species under Primates) without any Esearch query.
+
+"""
+
+
+from array import array
+
+
+# TaxId of the root node, which is its own parent.
+iRootTaxId = 1
+
+
+class TaxonomyTree:
+    """TaxId-indexed taxonomy tree.
+
+       Fill it with Add(), e.g. from nodes.dmp and names.dmp as done by
+       TaxDump.LoadTaxonomyTree(), then query it.
+    """
+    def __init__(self):
+        # Indexed by TaxId. A parent of 0 marks unused TaxIds.
+        self.parents = array('i')
+        self.ranks = array('B')
+        self.divisions = array('b')
+        self.names = array('i')
+        # Interned table of rank names
+        self.rankTable = []
+        self.dictRankIds = dict()
+        # The scientific names, one after the other, encoded as UTF-8. self.names holds the
+        # index of each one, from self.nameOffsets[index] to self.nameOffsets[index+1]
+        self.nameData = array('c')
+        self.nameOffsets = array('i', [0])
+        # Ancestor paths of inner nodes: TaxId -> tuple of TaxIds
+        self.lineages = dict()
+        # Children index, built on demand. See BuildChildren()
+        self.childOffsets = None
+        self.children = None
+        self.count = 0
+
+    def Grow(self, iTaxId):
+        """
+            Makes room in the arrays for TaxIds up to iTaxId.
+        """
+        iMissing = iTaxId + 1 - len(self.parents)
+        if iMissing > 0:
+            # Grow geometrically, to keep the number of reallocations low.
+            iMissing = max(iMissing, len(self.parents)/2)
+            self.parents.extend(array('i', [0])*iMissing)
+            self.ranks.extend(array('B', [0])*iMissing)
+            self.divisions.extend(array('b', [-1])*iMissing)
+            self.names.extend(array('i', [-1])*iMissing)
+
+    def AddName(self, sName):
+        """
+            Appends sName to the name data. Returns its index.
+            The scientific names are unique, so there's nothing to gain from interning them.
+        """
+        self.nameData.fromstring(sName.encode('utf-8'))
+        self.nameOffsets.append(len(self.nameData))
+        return len(self.nameOffsets) - 2
+
+    def Add(self, iTaxId, iParentTaxId, sRank, iDivision=-1):
+        """
+            Adds a node to the tree.
+        """
+        self.Grow(iTaxId)
+        if self.parents[iTaxId] == 0:
+            self.count += 1
+        self.parents[iTaxId] = iParentTaxId
+        iRank = self.dictRankIds.get(sRank)
+        if iRank is None:
+            iRank = len(self.rankTable)
+            self.rankTable.append(sRank)
+            self.dictRankIds[sRank] = iRank
+        self.ranks[iTaxId] = iRank
+        self.divisions[iTaxId] = iDivision
+        # Invalidate the derived indexes
+        self.lineages.clear()
+        self.childOffsets = None
+        self.children = None
+
+    def SetName(self, iTaxId, sName):
+        """
+            Sets the scientific name of a node.
+        """
+        self.Grow(iTaxId)
+        self.names[iTaxId] = self.AddName(sName)
+
+    def Contains(self, iTaxId):
+        return (0 < iTaxId < len(self.parents)) and (self.parents[iTaxId] != 0)
+
+    def GetParent(self, iTaxId):
+        return self.parents[iTaxId]
+
+    def GetRank(self, iTaxId):
+        return self.rankTable[self.ranks[iTaxId]]
+
+    def GetDivision(self, iTaxId):
+        return self.divisions[iTaxId]
+
+    def GetName(self, iTaxId):
+        """
+            Returns the scientific name of a node, or None if it wasn't set.
+        """
+        iName = self.names[iTaxId]
+        if iName < 0:
+            return None
+        return self.nameData[self.nameOffsets[iName]:self.nameOffsets[iName + 1]].tostring().decode('utf-8')
+
+    def GetLineage(self, iTaxId):
+        """
+            Returns the tuple of ancestor TaxIds of the given taxon, starting at the top.
+            Just like the <LineageEx> of Efetch, it includes neither the root node
+            nor the taxon itself.
+            If an ancestor isn't in the tree, e.g. in an incomplete taxdump, the lineage
+            only starts below it. Taxa not in the tree have an empty lineage.
+        """
+        if not self.Contains(iTaxId):
+            return ()
+        iParent = self.parents[iTaxId]
+        if iParent == iRootTaxId or iTaxId == iRootTaxId or not self.Contains(iParent):
+            return ()
+        lineage = self.lineages.get(iParent)
+        if lineage is None:
+            # Walk up until an ancestor with a known path, or the top of the tree,
+            # or a gap in it, then memoize on the way back down.
+            lPath = []
+            iNode = iParent
+            while self.Contains(iNode) and (iNode != iRootTaxId) and (iNode not in self.lineages):
+                lPath.append(iNode)
+                iNode = self.parents[iNode]
+            lineage = self.lineages.get(iNode, ())
+            for iNode in reversed(lPath):
+                lineage = lineage + (iNode,)
+                self.lineages[iNode] = lineage
+        return lineage
+
+    def GetLineageNames(self, iTaxId):
+        """
+            Returns the list of scientific names of the ancestors of the given taxon. See GetLineage()
+        """
+        return [self.GetName(iAncestor) for iAncestor in self.GetLineage(iTaxId)]
+
+    def IsInSubtree(self, iTaxId, iAncestor):
+        """
+            Whether iTaxId is iAncestor itself or one of its descendants.
+        """
+        return (iTaxId == iAncestor) or (iAncestor == iRootTaxId) or (iAncestor in self.GetLineage(iTaxId))
+
+    def BuildChildren(self):
+        """
+            Builds the children index in compressed form: The children of a node are
+            self.children[self.childOffsets[iTaxId]:self.childOffsets[iTaxId+1]]
+        """
+        iSize = len(self.parents)
+        offsets = array('i', [0])*(iSize + 1)
+        for iTaxId in xrange(iSize):
+            iParent = self.parents[iTaxId]
+            if iParent != 0 and iTaxId != iRootTaxId:
+                offsets[iParent + 1] += 1
+        for i in xrange(iSize):
+            offsets[i + 1] += offsets[i]
+        children = array('i', [0])*offsets[iSize]
+        fill = array('i', offsets)
+        for iTaxId in xrange(iSize):
+            iParent = self.parents[iTaxId]
+            if iParent != 0 and iTaxId != iRootTaxId:
+                children[fill[iParent]] = iTaxId
+                fill[iParent] += 1
+        self.childOffsets = offsets
+        self.children = children
+
+    def GetChildren(self, iTaxId):
+        if self.children is None:
+            self.BuildChildren()
+        return self.children[self.childOffsets[iTaxId]:self.childOffsets[iTaxId + 1]]
+
+    def IterSubtree(self, iAncestor, rank=None):
+        """
+            Yields the TaxIds of iAncestor and all its descendants, in depth-first order.
+
+            @param rank: Only yield taxa of this rank. e.g. "species"
+        """
+        iRank = None
+        if rank is not None:
+            iRank = self.dictRankIds.get(rank)
+            if iRank is None:
+                return
+        lStack = [iAncestor]
+        while lStack:
+            iTaxId = lStack.pop()
+            if (iRank is None) or (self.ranks[iTaxId] == iRank):
+                yield iTaxId
+            lStack.extend(reversed(self.GetChildren(iTaxId)))